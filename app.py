@@ -1,7 +1,24 @@
+import time
+_RUN_T0 = time.perf_counter()   # 啟動計時：放在其他 import 之前
+
 import streamlit as st
 import pandas as pd
+import numpy as np
+from contextlib import contextmanager
 from datetime import date, datetime
+from difflib import SequenceMatcher
+import bisect
+import functools
+import io
+import json
 import math
+import os
+import pickle
+import random
+import re
+import sqlite3
+import threading
+import uuid
 
 # ==========================================
 # 0. 基礎設定 (系統核心)
@@ -9,17 +26,161 @@ import math
 #    - 移除 Spinner / Toast 等「轉場效果」
 #    - 儘量避免 st.rerun()（能即時更新就即時更新）
 #    - 強化日期解析、避免 SettingWithCopyWarning
-#    - Google Sheet 寫入改用一次 update，較穩定
+#    - Google Sheet 寫入改為差異同步（只送變更的儲存格 / 新增列 / 刪除列）
 # ==========================================
 st.set_page_config(page_title="新生與經費管理系統", layout="wide", page_icon="🏫")
 
-# 嘗試匯入 gspread
+
+@st.cache_resource
+def startup_timings() -> dict:
+    """
+    程序層級的啟動耗時（秒）：每個階段只記第一次（冷啟動）的值，側邊欄顯示。
+    """
+    return {}
+
+
+def _mark_startup(stage: str, seconds: float):
+    startup_timings().setdefault(stage, round(seconds, 3))
+
+
+_mark_startup("載入套件", time.perf_counter() - _RUN_T0)
+_RUN_T1 = time.perf_counter()
+
+# ---------- 效能量測 ----------
+# 常駐開啟：每個量測點只多一次 perf_counter 與 dict 更新，每次執行結束寫一行 JSONL
 try:
-    import gspread
-    from oauth2client.service_account import ServiceAccountCredentials
-    HAS_GSPREAD = True
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
 except Exception:
-    HAS_GSPREAD = False
+    def get_script_run_ctx(suppress_warning=False):
+        return None
+
+PERF_LOG = "kindergarten_perf.jsonl"
+PERF_LOG_MAX_BYTES = 5 * 2 ** 20   # 超過就輪替成 .1
+
+
+def _new_perf_record() -> dict:
+    return {"t0": None, "spans": {}, "counters": {}}
+
+
+@st.cache_resource
+def _perf_process() -> dict:
+    """
+    程序層級：各量測點跨執行的累計（次數 / 總秒數 / 最大值），
+    以及背景執行緒（雲端同步、預取）尚未寫入紀錄檔的量測。
+    """
+    return {"lock": threading.Lock(), "agg": {}, "counters": {}, "bg": _new_perf_record(), "bg_last": None}
+
+
+def _perf_record() -> dict:
+    # 畫面執行緒（含按鈕 callback）寫到這個 session 的本次執行；背景執行緒寫到程序層級
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return _perf_process()["bg"]
+    rec = st.session_state.get("_perf_run")
+    if rec is None:
+        rec = st.session_state["_perf_run"] = _new_perf_record()
+    return rec
+
+
+@contextmanager
+def perf_span(name: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        sec = time.perf_counter() - t0
+        spans = _perf_record()["spans"]
+        spans[name] = spans.get(name, 0.0) + sec
+
+
+def perf_count(name: str, n: int = 1):
+    counters = _perf_record()["counters"]
+    counters[name] = counters.get(name, 0) + n
+
+
+def _perf_write(entry: dict):
+    proc = _perf_process()
+    with proc["lock"]:
+        for name, sec in entry["spans"].items():
+            a = proc["agg"].setdefault(name, [0, 0.0, 0.0])
+            a[0] += 1
+            a[1] += sec
+            a[2] = max(a[2], sec)
+        for name, n in entry["counters"].items():
+            proc["counters"][name] = proc["counters"].get(name, 0) + n
+        try:
+            if os.path.exists(PERF_LOG) and os.path.getsize(PERF_LOG) > PERF_LOG_MAX_BYTES:
+                os.replace(PERF_LOG, PERF_LOG + ".1")
+            with open(PERF_LOG, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except Exception:
+            pass
+
+
+def perf_begin_run(t0: float = None):
+    rec = st.session_state.get("_perf_run")
+    if rec is None or rec["t0"] is not None:
+        # 上次執行沒跑到結尾（st.stop / 例外），丟掉重來
+        rec = st.session_state["_perf_run"] = _new_perf_record()
+    rec["t0"] = _RUN_T0 if t0 is None else t0
+
+
+def perf_end_run(page: str):
+    """
+    每次執行結束時呼叫：本次紀錄（含同一次 rerun 裡 callback 的量測）寫入累計與紀錄檔。
+    """
+    rec = st.session_state.get("_perf_run")
+    if not rec or rec["t0"] is None:
+        return
+    entry = {
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "session": st.session_state.setdefault("_perf_sid", uuid.uuid4().hex[:6]),
+        "page": page,
+        "total": round(time.perf_counter() - rec["t0"], 4),
+        "spans": {k: round(v, 4) for k, v in rec["spans"].items()},
+        "counters": dict(rec["counters"]),
+    }
+    _perf_write(entry)
+    st.session_state["_perf_last"] = entry
+    st.session_state["_perf_run"] = _new_perf_record()
+
+
+def perf_fragment(name: str):
+    """
+    st.fragment 加上量測。片段單獨重跑時主程式不會執行，由片段自己開始 / 結束一次紀錄
+    （page 記為「片段：name」）；整頁執行或外層片段重跑時只記成其中一段 span。
+    """
+    def deco(fn):
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            rec = st.session_state.get("_perf_run")
+            if rec is not None and rec["t0"] is not None:
+                with perf_span(f"片段：{name}"):
+                    return fn(*args, **kwargs)
+            perf_begin_run(time.perf_counter())
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                perf_end_run(f"片段：{name}")
+        return st.fragment(run)
+    return deco
+
+
+def perf_flush_background(thread_name: str):
+    # 背景執行緒做完一輪後呼叫；沒有量測就不寫
+    proc = _perf_process()
+    rec, proc["bg"] = proc["bg"], _new_perf_record()
+    if not rec["spans"] and not rec["counters"]:
+        return
+    entry = {
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "thread": thread_name,
+        "spans": {k: round(v, 4) for k, v in rec["spans"].items()},
+        "counters": dict(rec["counters"]),
+    }
+    _perf_write(entry)
+    proc["bg_last"] = entry
+
+# gspread / oauth2client 很重：第一次需要雲端時才匯入（見 _gspread_modules）
 
 # 嘗試匯入 st_keyup
 try:
@@ -43,8 +204,13 @@ st.markdown("""
     }
 </style>
 """, unsafe_allow_html=True)
+_mark_startup("頁面設定與樣式", time.perf_counter() - _RUN_T1)
 
 NEW_STATUS_OPTIONS = ["預約參觀", "排隊等待", "確認入學", "確定不收"]
+CONTACT_OPTIONS = ["未聯繫", "已聯繫"]
+PRIO_OPTIONS = ["優", "中", "差"]
+# 資料管理中心：每個狀態群組一頁顯示幾張卡片
+CARD_PAGE_SIZES = [10, 20, 50, 100]
 
 if "calc_memory" not in st.session_state:
     st.session_state["calc_memory"] = {}
@@ -62,9 +228,16 @@ if "msg_ok" not in st.session_state:
 # 1. 資料存取邏輯
 # ==========================================
 SHEET_NAME = "kindergarten_db"
-LOCAL_CSV = "kindergarten_local_db.csv"
+LOCAL_DB = "kindergarten_local_db.sqlite3"
+LOCAL_CSV = "kindergarten_local_db.csv"   # 舊版本機檔，首次啟動時匯入 SQLite
+SNAPSHOT_FILE = "kindergarten_snapshot.pkl"   # 整理後資料表的二進位快照（依資料版本標記）
+ARCHIVE_SHEET = "封存"   # 冷資料工作表
+CLOUD_REVALIDATE_SEC = 300
 FINAL_COLS = ["報名狀態", "聯繫狀態", "登記日期", "幼兒姓名", "家長稱呼", "電話",
-              "幼兒生日", "預計入學資訊", "推薦人", "備註", "重要性"]
+              "幼兒生日", "預計入學資訊", "推薦人", "備註", "重要性", "紀錄ID", "版本"]
+# 紀錄ID：每筆資料的永久編號；版本：每次修改 +1，用於儲存時偵測衝突
+ID_COL = "紀錄ID"
+VER_COL = "版本"
 
 
 def _safe_str(x) -> str:
@@ -100,10 +273,72 @@ def parse_roc_date_str(s: str):
         return None
 
 
+def _safe_strs(s: pd.Series) -> pd.Series:
+    # _safe_str 的向量化版本
+    s = s.fillna("").astype(str).str.strip()
+    return s.mask(s.str.lower().eq("nan"), "")
+
+
+def normalize_phones(s: pd.Series) -> pd.Series:
+    # normalize_phone 的向量化版本
+    s = _safe_strs(s)
+    return s.mask(s.str.len().eq(9) & s.str.startswith("9"), "0" + s)
+
+
+def parse_roc_dates(s: pd.Series) -> pd.DataFrame:
+    """
+    parse_roc_date_str 的向量化版本，回傳 y / m / d 三欄（西元年，可為空的整數）。
+    常見格式一次解析；少數不規則字串逐筆交給 parse_roc_date_str，結果與逐筆完全相同。
+    """
+    s = _safe_strs(s).str.replace("-", "/", regex=False).str.replace(".", "/", regex=False)
+    parts = s.str.extract(r"^\s*([+-]?[0-9]+)\s*/\s*([+-]?[0-9]+)\s*/\s*([+-]?[0-9]+)\s*$")
+    y = pd.to_numeric(parts[0], errors="coerce") + 1911
+    m = pd.to_numeric(parts[1], errors="coerce")
+    d = pd.to_numeric(parts[2], errors="coerce")
+
+    leap = ((y % 4 == 0) & (y % 100 != 0)) | (y % 400 == 0)
+    dim = m.map({1: 31, 2: 28, 3: 31, 4: 30, 5: 31, 6: 30, 7: 31, 8: 31, 9: 30, 10: 31, 11: 30, 12: 31})
+    dim = dim + ((m == 2) & leap).astype(int)
+    ok = y.between(1, 9999) & m.between(1, 12) & (d >= 1) & (d <= dim)
+
+    out = pd.DataFrame({
+        "y": y.where(ok).astype("Int32"),
+        "m": m.where(ok).astype("Int32"),
+        "d": d.where(ok).astype("Int32"),
+    }, index=s.index)
+
+    odd = s.ne("") & parts[0].isna()
+    for i, v in s[odd].items():
+        dt = parse_roc_date_str(v)
+        if dt:
+            out.loc[i, ["y", "m", "d"]] = [dt.year, dt.month, dt.day]
+    return out
+
+
 def to_roc_str(d: date) -> str:
     return f"{d.year-1911}/{d.month:02d}/{d.day:02d}"
 
 
+def new_record_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+def _as_version(x) -> int:
+    try:
+        return int(_safe_str(x) or 1)
+    except Exception:
+        return 1
+
+
+def _admin_password() -> str:
+    # 管理者密碼（可看效能面板）：secrets 的 admin_password，或環境變數 KG_ADMIN_PASSWORD
+    try:
+        pw = _safe_str(st.secrets.get("admin_password", ""))
+    except Exception:
+        pw = ""
+    return pw or _safe_str(os.environ.get("KG_ADMIN_PASSWORD"))
+
+
 def check_password():
     if "password_correct" not in st.session_state:
         st.session_state.password_correct = False
@@ -118,22 +353,32 @@ def check_password():
             pwd = st.text_input("請輸入通關密碼", type="password")
             ok = st.form_submit_button("登入", type="primary", use_container_width=True)
         if ok:
-            if pwd == "1234":
+            admin_pw = _admin_password()
+            if pwd == "1234" or (admin_pw and pwd == admin_pw):
                 st.session_state.password_correct = True
+                st.session_state["is_admin"] = bool(admin_pw) and pwd == admin_pw
+                st.session_state["_login_t0"] = time.perf_counter()
                 # 不用 spinner / toast
             else:
                 st.error("密碼錯誤")
     return st.session_state.password_correct
 
 
-if not check_password():
-    st.stop()
+@st.cache_resource
+def _gspread_modules():
+    # 延遲匯入：沒有設定雲端金鑰的環境完全不載入
+    t0 = time.perf_counter()
+    try:
+        import gspread
+        from oauth2client.service_account import ServiceAccountCredentials
+    except Exception:
+        return None
+    _mark_startup("載入 gspread", time.perf_counter() - t0)
+    return gspread, ServiceAccountCredentials
 
 
 @st.cache_resource
 def get_gsheet_client():
-    if not HAS_GSPREAD:
-        return None
     try:
         scope = [
             "https://spreadsheets.google.com/feeds",
@@ -141,48 +386,327 @@ def get_gsheet_client():
         ]
         if "gcp_service_account" not in st.secrets:
             return None
+        mods = _gspread_modules()
+        if mods is None:
+            return None
+        gspread, ServiceAccountCredentials = mods
+        t0 = time.perf_counter()
         creds = ServiceAccountCredentials.from_json_keyfile_dict(
             dict(st.secrets["gcp_service_account"]), scope
         )
-        return gspread.authorize(creds)
+        client = gspread.authorize(creds)
+        _mark_startup("雲端授權", time.perf_counter() - t0)
+        return client
     except Exception:
         return None
 
 
-def connect_to_gsheets_students():
+# ---------- 雲端閘道 ----------
+# 所有 Google Sheets 請求都經過 sheets_call：配額節流、暫時性錯誤重試、延遲與錯誤統計。
+# 試算表 / 工作表控制代碼每個程序只開一次（以試算表 ID 開啟，不再每次用名稱搜尋 Drive）。
+SHEETS_REQ_PER_MIN = 60   # Sheets API 每位使用者每分鐘的請求配額
+SHEETS_BURST = 10
+SHEETS_MAX_RETRIES = 5
+SHEETS_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+@st.cache_resource
+def _sheets_gateway() -> dict:
+    """
+    程序內共用的閘道狀態。book 為試算表控制代碼（測試時可直接放入記憶體中的假物件），
+    sheets 為 {工作表名稱: 控制代碼}（None 代表第一個工作表）。
+    """
+    return {
+        "lock": threading.Lock(),
+        "tokens": float(SHEETS_BURST),
+        "refill_at": time.monotonic(),
+        "book": None,
+        "sheets": {},
+        "ops": {},   # 操作 → {"calls", "errors", "retries", "sec", "max"}
+        "throttled_sec": 0.0,
+        "last_error": "",
+    }
+
+
+def _take_token(gw: dict):
+    # 權杖桶：每秒補 SHEETS_REQ_PER_MIN / 60 個、最多存 SHEETS_BURST 個，沒有權杖就等
+    rate = SHEETS_REQ_PER_MIN / 60
+    while True:
+        with gw["lock"]:
+            now = time.monotonic()
+            gw["tokens"] = min(SHEETS_BURST, gw["tokens"] + (now - gw["refill_at"]) * rate)
+            gw["refill_at"] = now
+            if gw["tokens"] >= 1:
+                gw["tokens"] -= 1
+                return
+            wait = (1 - gw["tokens"]) / rate
+            gw["throttled_sec"] += wait
+        time.sleep(wait)
+
+
+def _sheets_metric(gw: dict, op: str, sec: float, error: str = "", retry: bool = False):
+    with gw["lock"]:
+        m = gw["ops"].setdefault(op, {"calls": 0, "errors": 0, "retries": 0, "sec": 0.0, "max": 0.0})
+        m["calls"] += 1
+        m["sec"] += sec
+        m["max"] = max(m["max"], sec)
+        if error:
+            m["errors"] += 1
+            m["retries"] += int(retry)
+            gw["last_error"] = f"{datetime.now():%H:%M:%S} {op}：{error}"
+    perf_count("Sheets API")
+
+
+def _api_status(e: Exception) -> int:
+    # gspread.exceptions.APIError 帶有 HTTP 回應
+    return getattr(getattr(e, "response", None), "status_code", 0) or 0
+
+
+def sheets_call(op: str, fn, *args, idempotent: bool = True, **kwargs):
+    """
+    送出一個 Sheets 請求：先取權杖，429 / 5xx / 連線錯誤以抖動的指數退避重試。
+    非冪等請求（新增列、刪除列、新增工作表）只在 429（請求未被處理）時重試，避免重複寫入。
+    其他錯誤照常拋出，並記在閘道的錯誤統計。
+    """
+    gw = _sheets_gateway()
+    for attempt in range(SHEETS_MAX_RETRIES + 1):
+        _take_token(gw)
+        t0 = time.perf_counter()
+        try:
+            out = fn(*args, **kwargs)
+        except Exception as e:
+            status = _api_status(e)
+            transient = status in SHEETS_RETRY_STATUS or (not status and isinstance(e, OSError))
+            retry = attempt < SHEETS_MAX_RETRIES and (status == 429 or (idempotent and transient))
+            _sheets_metric(gw, op, time.perf_counter() - t0, f"{status or type(e).__name__} {e}"[:200], retry)
+            if status in (401, 403, 404):
+                # 權限或檔案有變：下次重新開啟控制代碼
+                gw["book"], gw["sheets"] = None, {}
+            if not retry:
+                raise
+            time.sleep(min(32, 2 ** attempt) * (0.5 + random.random()))
+            continue
+        _sheets_metric(gw, op, time.perf_counter() - t0)
+        return out
+
+
+def _sheet_key() -> str:
+    # 試算表 ID：secrets 有設定就用，否則用第一次以名稱開啟時記下的 ID
+    try:
+        key = _safe_str(st.secrets.get("gsheet_key", ""))
+    except Exception:
+        key = ""
+    if key:
+        return key
+    with _db() as conn:
+        return _meta_get(conn, "sheet_key")
+
+
+def _open_book():
+    gw = _sheets_gateway()
+    if gw["book"] is not None:
+        return gw["book"]
     c = get_gsheet_client()
     if not c:
         return None
+    key = _sheet_key()
+    if key:
+        book = sheets_call("open_by_key", c.open_by_key, key)
+    else:
+        book = sheets_call("open", c.open, SHEET_NAME)
+        with _db() as conn:
+            _meta_set(conn, "sheet_key", book.id)
+    gw["book"] = book
+    return book
+
+
+def open_worksheet(title: str = None, create: bool = False):
+    """
+    取得工作表控制代碼（title=None 為第一個工作表），一次列出全部工作表並快取。
+    create=True 時不存在就建立並寫入標題列。失敗回傳 None（錯誤記在閘道統計）。
+    """
+    gw = _sheets_gateway()
+    ws = gw["sheets"].get(title)
+    if ws is not None:
+        return ws
     try:
-        sh = c.open(SHEET_NAME)
-        return sh.sheet1
-    except Exception:
+        book = _open_book()
+        if book is None:
+            return None
+        sheets = sheets_call("worksheets", book.worksheets)
+        found = {s.title: s for s in sheets}
+        if sheets:
+            found[None] = sheets[0]
+        if title not in found and create:
+            ws = sheets_call("add_worksheet", book.add_worksheet, idempotent=False,
+                             title=title, rows=1, cols=len(FINAL_COLS))
+            sheets_call("append_row", ws.append_row, FINAL_COLS, idempotent=False)
+            found[title] = ws
+        gw["sheets"] = found
+        return found.get(title)
+    except Exception as e:
+        gw["last_error"] = f"{datetime.now():%H:%M:%S} 開啟工作表：{e}"[:300]
         return None
 
 
-@st.cache_data(ttl=300)
-def load_registered_data():
-    # 先試 Google Sheet
-    sheet = connect_to_gsheets_students()
-    df = pd.DataFrame()
+def sheets_metrics() -> dict:
+    gw = _sheets_gateway()
+    with gw["lock"]:
+        return {
+            "ops": {k: dict(v) for k, v in gw["ops"].items()},
+            "throttled_sec": gw["throttled_sec"],
+            "last_error": gw["last_error"],
+        }
 
-    if sheet:
-        try:
-            data = sheet.get_all_values()
-            if data and len(data) >= 1:
-                header = data[0]
-                rows = data[1:] if len(data) > 1 else []
-                df = pd.DataFrame(rows, columns=header)
-        except Exception:
-            df = pd.DataFrame()
 
-    # 退回本機 CSV
-    if df.empty:
-        try:
-            df = pd.read_csv(LOCAL_CSV, dtype=str)
-        except Exception:
-            df = pd.DataFrame(columns=FINAL_COLS)
+def connect_to_gsheets_students():
+    return open_worksheet()
+
+
+def connect_to_gsheets_archive():
+    # 封存工作表（同一份試算表內，沒有就建立並寫入標題列）
+    return open_worksheet(ARCHIVE_SHEET, create=True)
 
+
+@st.cache_resource
+def _gsheet_sync_state() -> dict:
+    """
+    雲端工作表的最後同步快照（含標題列）與同步計數。
+    values 為 None 代表快照未知，下次儲存前會先讀一次雲端。
+    """
+    return {
+        "values": None,
+        "last": None,
+        "total": {"saves": 0, "cells": 0, "requests": 0},
+    }
+
+
+def _col_letter(n: int) -> str:
+    s = ""
+    while n > 0:
+        n, r = divmod(n - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+
+def _a1_range(row: int, c1: int, c2: int) -> str:
+    # row / c1 / c2 皆為 1 起算
+    if c1 == c2:
+        return f"{_col_letter(c1)}{row}"
+    return f"{_col_letter(c1)}{row}:{_col_letter(c2)}{row}"
+
+
+def _row_cell_ranges(sheet_row: int, old_row: list, new_row: list) -> list:
+    # 將同一列中連續變更的儲存格合併成一個範圍
+    cells = []
+    width = len(new_row)
+    c = 0
+    while c < width:
+        if old_row[c] == new_row[c]:
+            c += 1
+            continue
+        start = c
+        while c < width and old_row[c] != new_row[c]:
+            c += 1
+        cells.append((_a1_range(sheet_row, start + 1, c), [new_row[start:c]]))
+    return cells
+
+
+def _merge_row_ranges(rows) -> list:
+    # 將 1 起算的列號合併為連續範圍，由下往上排列（刪除時列號才不會位移）
+    ranges = []
+    for r in sorted(set(rows), reverse=True):
+        if ranges and ranges[-1][0] == r + 1:
+            ranges[-1] = (r, ranges[-1][1])
+        else:
+            ranges.append((r, r))
+    return ranges
+
+
+def diff_sheet_values(old_values: list, new_values: list, key_col=None) -> dict:
+    """
+    比對雲端快照與要送出的內容（兩者皆含標題列），回傳：
+      cells  : [(A1 範圍, [[值...]]), ...]  只含有變更的連續儲存格
+      delete : [(起列, 迄列), ...]          1 起算、含迄列，由下往上排列
+      append : [[值...], ...]               接在表尾的新列
+    key_col 為紀錄ID 欄位位置；有編號的列以編號對應，修改過的列也能精準比對。
+    """
+    width = len(new_values[0]) if new_values else 0
+
+    def _norm(row):
+        row = ["" if v is None else str(v) for v in row][:width]
+        return row + [""] * (width - len(row))
+
+    def _key(row):
+        if key_col is not None and row[key_col]:
+            return row[key_col]
+        return tuple(row)
+
+    old = [_norm(r) for r in old_values]
+    new = [_norm(r) for r in new_values]
+
+    pairs, deleted, inserted = [], [], []
+    sm = SequenceMatcher(None, [_key(r) for r in old], [_key(r) for r in new], autojunk=False)
+    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+        n = min(i2 - i1, j2 - j1)
+        pairs.extend(zip(range(i1, i1 + n), range(j1, j1 + n)))
+        deleted.extend(range(i1 + n, i2))
+        inserted.extend(range(j1 + n, j2))
+
+    # 新列若不在表尾（中間插入），改以位置逐列比對，避免整表重寫
+    if inserted and inserted != list(range(len(new) - len(inserted), len(new))):
+        n = min(len(old), len(new))
+        pairs = list(zip(range(n), range(n)))
+        deleted = list(range(n, len(old)))
+        inserted = list(range(n, len(new)))
+
+    cells = []
+    for i, j in pairs:
+        if old[i] != new[j]:
+            cells.extend(_row_cell_ranges(j + 1, old[i], new[j]))
+
+    return {
+        "cells": cells,
+        "delete": _merge_row_ranges(i + 1 for i in deleted),
+        "append": [new[j] for j in inserted],
+    }
+
+
+def push_sheet_diff(sheet, diff: dict, width: int) -> dict:
+    """
+    將 diff_sheet_values 的結果送到雲端：刪除列一次、更新儲存格一次、新增列一次。
+    回傳本次送出的儲存格數與請求數。
+    """
+    stats = {"cells": 0, "requests": 0, "appended": len(diff["append"]), "deleted": 0}
+
+    if width > getattr(sheet, "col_count", width):
+        sheets_call("add_cols", sheet.add_cols, width - sheet.col_count, idempotent=False)
+        stats["requests"] += 1
+
+    if diff["delete"]:
+        reqs = [{
+            "deleteDimension": {
+                "range": {"sheetId": sheet.id, "dimension": "ROWS", "startIndex": a - 1, "endIndex": b}
+            }
+        } for a, b in diff["delete"]]
+        sheets_call("delete_rows", sheet.spreadsheet.batch_update, {"requests": reqs}, idempotent=False)
+        stats["requests"] += 1
+        stats["deleted"] = sum(b - a + 1 for a, b in diff["delete"])
+
+    if diff["cells"]:
+        sheets_call("batch_update", sheet.batch_update, [{"range": rng, "values": vals} for rng, vals in diff["cells"]])
+        stats["requests"] += 1
+        stats["cells"] += sum(len(vals[0]) for _, vals in diff["cells"])
+
+    if diff["append"]:
+        sheets_call("append_rows", sheet.append_rows, diff["append"], value_input_option="RAW", idempotent=False)
+        stats["requests"] += 1
+        stats["cells"] += sum(len(r) for r in diff["append"])
+
+    return stats
+
+
+def _normalize_frame(df: pd.DataFrame) -> pd.DataFrame:
     df = df.fillna("").astype(str)
 
     # 確保欄位完整
@@ -190,55 +714,1624 @@ def load_registered_data():
         if c not in df.columns:
             df[c] = ""
 
-    df["電話"] = df["電話"].apply(normalize_phone)
+    df["電話"] = normalize_phones(df["電話"])
     df["聯繫狀態"] = df["聯繫狀態"].replace("", "未聯繫")
     df["報名狀態"] = df["報名狀態"].replace("", "排隊等待")
     df["重要性"] = df["重要性"].replace("", "中")
+    return df
+
+
+# 載入時一次建好的型別欄位（顯示用字串欄位保持不變）
+TYPED_COLS = ["dob_y", "dob_m", "dob_d", "dob", "reg_date", "status_cat", "status_group",
+              "contact_cat", "is_contacted", "prio", "phone_key"]
 
-    df = df[FINAL_COLS]
+
+def _add_typed_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    解析生日 / 登記日期、狀態與優先度轉成類別 / 數值、電話正規化鍵，全部向量化，
+    每個資料版本只做一次；各頁面直接用這些欄位篩選排序，不必每次重跑逐列解析。
+    """
+    def _ymd_to_datetime(p):
+        ymd = pd.DataFrame({"year": p["y"], "month": p["m"], "day": p["d"]}).astype("float64")
+        return pd.to_datetime(ymd, errors="coerce")
+
+    dob = parse_roc_dates(df["幼兒生日"])
+    df["dob_y"], df["dob_m"], df["dob_d"] = dob["y"], dob["m"], dob["d"]
+    df["dob"] = _ymd_to_datetime(dob)
+    df["reg_date"] = _ymd_to_datetime(parse_roc_dates(df["登記日期"]))
+
+    status = df["報名狀態"]
+    df["status_cat"] = status.astype("category")
+    # 不在選項內的狀態併入「排隊等待」組
+    df["status_group"] = pd.Categorical(
+        status.where(status.isin(NEW_STATUS_OPTIONS), "排隊等待"), categories=NEW_STATUS_OPTIONS
+    )
+    df["contact_cat"] = df["聯繫狀態"].astype("category")
+    df["is_contacted"] = df["聯繫狀態"].eq("已聯繫")
+    df["prio"] = df["重要性"].map({p: i for i, p in enumerate(PRIO_OPTIONS)}).fillna(1).astype("int8")
+    df["phone_key"] = normalize_phones(df["電話"]).str.replace(r"\D", "", regex=True)
     return df
 
 
-def sync_data_to_gsheets(new_df: pd.DataFrame) -> bool:
+def _prepare_save_df(new_df: pd.DataFrame) -> pd.DataFrame:
+    save_df = new_df.copy()
+
+    # 移除系統內部欄位（若存在）
+    for c in TYPED_COLS + ["original_index", "sort_val", "sort_temp", "search_rank"]:
+        if c in save_df.columns:
+            save_df = save_df.drop(columns=[c])
+
+    # 確保欄位完整 + 排序
+    for c in FINAL_COLS:
+        if c not in save_df.columns:
+            save_df[c] = ""
+
+    save_df["重要性"] = save_df["重要性"].replace("", "中").fillna("中")
+    save_df = save_df[FINAL_COLS].fillna("").astype(str)
+
+    # 沒有編號（新資料 / 舊資料）或編號重複者補發新編號
+    ids = save_df[ID_COL]
+    missing = ids.eq("") | ids.duplicated()
+    if missing.any():
+        save_df.loc[missing, ID_COL] = [new_record_id() for _ in range(int(missing.sum()))]
+    save_df[VER_COL] = save_df[VER_COL].replace("", "1")
+    return save_df
+
+
+# ---------- 本機 SQLite ----------
+def _q(col: str) -> str:
+    return '"' + col + '"'
+
+
+_DB_COLS = ", ".join(_q(c) for c in FINAL_COLS)
+_DB_MARKS = ", ".join("?" for _ in FINAL_COLS)
+
+
+@st.cache_resource
+def _local_db_path() -> str:
+    """
+    建立資料表與索引（每個程序只做一次）；本機庫是空的而舊版 CSV 存在時自動匯入。
+    """
+    t0 = time.perf_counter()
+    conn = sqlite3.connect(LOCAL_DB, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            col_defs = ", ".join(
+                f"{_q(c)} TEXT PRIMARY KEY" if c == ID_COL else f"{_q(c)} TEXT NOT NULL DEFAULT ''"
+                for c in FINAL_COLS
+            )
+            conn.execute(f"CREATE TABLE IF NOT EXISTS registrations ({col_defs}, pos INTEGER NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_reg_pos ON registrations(pos)")
+            # 檢視篩選與電話查詢都在共用資料表 / 家庭索引上做，不查 SQL；舊版建立的欄位索引只會拖慢寫入
+            for name in ("idx_reg_phone", "idx_reg_status", "idx_reg_contact", "idx_reg_dob"):
+                conn.execute(f"DROP INDEX IF EXISTS {name}")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO meta (k, v) VALUES ('data_version', '0')")
+            # 本機庫的識別碼：重建資料庫後舊快照的版本號不會誤判為相同
+            conn.execute("INSERT OR IGNORE INTO meta (k, v) VALUES ('db_uid', ?)", (uuid.uuid4().hex,))
+            # 每個資料版本動到哪些 紀錄ID（ids 為 JSON；NULL = 不明），共用資料表與各 session 據此只更新那幾列
+            conn.execute("CREATE TABLE IF NOT EXISTS change_log (version INTEGER PRIMARY KEY, ids TEXT)")
+            # 尚未送到雲端的變更（每筆資料最多一列，舊列 / 新列以 JSON 存）
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cloud_outbox (rid TEXT PRIMARY KEY, old TEXT, new TEXT, "
+                "seq INTEGER NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "failed INTEGER NOT NULL DEFAULT 0, error TEXT NOT NULL DEFAULT '')"
+            )
+
+            # 送到雲端時發生衝突的本機版本（local 為 JSON 列，NULL = 本機刪除），使用者選擇保留或捨棄之前一直留著
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cloud_conflicts (rid TEXT PRIMARY KEY, local TEXT, "
+                "reason TEXT NOT NULL, at TEXT NOT NULL)"
+            )
+
+            # 封存（冷資料）：欄位與主表相同；尚未附加到雲端封存工作表的列放在 archive_outbox
+            conn.execute(f"CREATE TABLE IF NOT EXISTS registrations_archive ({col_defs})")
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_arc_phone ON registrations_archive("電話")')
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS archive_outbox (rid TEXT PRIMARY KEY, new TEXT NOT NULL, "
+                "seq INTEGER NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT NOT NULL DEFAULT '')"
+            )
+            conn.execute("INSERT OR IGNORE INTO meta (k, v) VALUES ('archive_version', '0')")
+
+            empty = conn.execute("SELECT COUNT(*) FROM registrations").fetchone()[0] == 0
+            if empty and os.path.exists(LOCAL_CSV):
+                try:
+                    legacy = _prepare_save_df(_normalize_frame(pd.read_csv(LOCAL_CSV, dtype=str)))
+                    _db_write_frame(conn, legacy)
+                except Exception:
+                    pass
+    finally:
+        conn.close()
+    _mark_startup("開啟本機庫", time.perf_counter() - t0)
+    return LOCAL_DB
+
+
+@contextmanager
+def _db():
+    # 每次操作開一條連線（執行緒安全）；with 區塊結束即 commit，例外則 rollback
+    conn = sqlite3.connect(_local_db_path(), timeout=30)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+CHANGE_LOG_KEEP = 500   # 保留最近幾個版本的變更紀錄；落後更多的讀取端整表重建
+
+
+def _bump_data_version(conn, ids=None):
+    # 與資料寫入同一個交易記下這一版動到的 紀錄ID（None = 不明，例如整表重排）
+    conn.execute("UPDATE meta SET v = CAST(v AS INTEGER) + 1 WHERE k = 'data_version'")
+    ver = int(conn.execute("SELECT v FROM meta WHERE k = 'data_version'").fetchone()[0])
+    conn.execute(
+        "INSERT OR REPLACE INTO change_log (version, ids) VALUES (?, ?)",
+        (ver, None if ids is None else json.dumps(list(ids), ensure_ascii=False)),
+    )
+    conn.execute("DELETE FROM change_log WHERE version <= ?", (ver - CHANGE_LOG_KEEP,))
+
+
+def get_data_version() -> int:
+    with _db() as conn:
+        return int(conn.execute("SELECT v FROM meta WHERE k = 'data_version'").fetchone()[0])
+
+
+def _changed_ids(conn, since: int, until: int):
+    # since（不含）到 until 之間動過的 紀錄ID；缺版本或有不明的整批變動回傳 None
+    if since > until:
+        return None
+    rows = conn.execute(
+        "SELECT ids FROM change_log WHERE version > ? AND version <= ?", (since, until)
+    ).fetchall()
+    if len(rows) != until - since or any(r[0] is None for r in rows):
+        return None
+    ids = set()
+    for r in rows:
+        ids.update(json.loads(r[0]))
+    return ids
+
+
+def changed_ids_since(version: int):
+    """
+    資料版本 version 之後（到目前）被新增 / 修改 / 刪除的 紀錄ID 集合；
+    變更紀錄已清掉或有整批變動時回傳 None（呼叫端視為全部都可能變了）。
+    """
+    with _db() as conn:
+        return _changed_ids(conn, int(version), int(_meta_get(conn, "data_version", "0")))
+
+
+def _meta_get(conn, k: str, default: str = "") -> str:
+    row = conn.execute("SELECT v FROM meta WHERE k = ?", (k,)).fetchone()
+    return row[0] if row else default
+
+
+def _meta_set(conn, k: str, v: str):
+    conn.execute("INSERT OR REPLACE INTO meta (k, v) VALUES (?, ?)", (k, str(v)))
+
+
+def _db_read(conn, where: str = "", params=()) -> pd.DataFrame:
+    df = pd.read_sql_query(
+        f"SELECT {_DB_COLS} FROM registrations {where} ORDER BY pos", conn, params=list(params)
+    )
+    df = df.fillna("").astype(str)
+    df.index = pd.Index(df[ID_COL].tolist())
+    return df
+
+
+def _db_read_ids(conn, ids) -> pd.DataFrame:
+    ids = list(ids)
+    parts = []
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        parts.append(_db_read(conn, f"WHERE {_q(ID_COL)} IN ({', '.join('?' for _ in chunk)})", chunk))
+    return pd.concat(parts) if parts else _db_read(conn, "WHERE 0")
+
+
+def _db_insert(conn, save_df: pd.DataFrame):
+    start = conn.execute("SELECT COALESCE(MAX(pos), -1) + 1 FROM registrations").fetchone()[0]
+    conn.executemany(
+        f"INSERT OR REPLACE INTO registrations ({_DB_COLS}, pos) VALUES ({_DB_MARKS}, ?)",
+        [list(r) + [start + i] for i, r in enumerate(save_df[FINAL_COLS].values.tolist())],
+    )
+    _bump_data_version(conn, save_df[ID_COL].tolist())
+
+
+def _db_write_frame(conn, save_df: pd.DataFrame) -> list:
+    """
+    以 紀錄ID 比對整張表：只寫入有變動 / 新增的列、刪除已不存在的列。
+    回傳內容有變動的列 [(紀錄ID, 舊列或 None, 新列或 None), ...]。
+    """
+    new = save_df[FINAL_COLS].copy()
+    new.index = pd.Index(new[ID_COL].tolist())
+    old = pd.read_sql_query(f"SELECT {_DB_COLS}, pos FROM registrations ORDER BY pos", conn)
+    old = old.fillna("").astype({c: str for c in FINAL_COLS})
+    old.index = pd.Index(old[ID_COL].tolist())
+
+    gone = old.index.difference(new.index)
+    common = new.index[new.index.isin(old.index)]
+    added = new.index[~new.index.isin(old.index)]
+
+    # 共同列的相對順序若改變（例如雲端被重新排序），整批重編 pos
+    common_set = set(common)
+    reorder = list(common) != [i for i in old.index if i in common_set]
+    if reorder:
+        pos = pd.Series(range(len(new)), index=new.index)
+        changed_ids = list(new.index)
+    else:
+        pos = old["pos"].astype(int).reindex(new.index)
+        start = int(old["pos"].max()) + 1 if len(old) else 0
+        pos.loc[added] = range(start, start + len(added))
+        diff = new.loc[common, FINAL_COLS].ne(old.loc[common, FINAL_COLS]).any(axis=1)
+        changed_ids = list(common[diff.values]) + list(added)
+
+    if changed_ids:
+        rows = new.loc[changed_ids, FINAL_COLS].values.tolist()
+        conn.executemany(
+            f"INSERT OR REPLACE INTO registrations ({_DB_COLS}, pos) VALUES ({_DB_MARKS}, ?)",
+            [r + [int(p)] for r, p in zip(rows, pos.loc[changed_ids].tolist())],
+        )
+    if len(gone):
+        conn.executemany(f"DELETE FROM registrations WHERE {_q(ID_COL)} = ?", [(i,) for i in gone])
+    if changed_ids or len(gone):
+        # 重排 pos 時各列位置都變了，讀取端只能整表重建
+        _bump_data_version(conn, None if reorder else changed_ids + list(gone))
+
+    ops = [(rid, o, None) for rid, o in zip(gone, old.loc[gone, FINAL_COLS].values.tolist())]
+    old_rows = old[FINAL_COLS].reindex(changed_ids)
+    known = old_rows[ID_COL].notna().tolist()
+    for rid, o, w, k in zip(changed_ids, old_rows.values.tolist(),
+                            new.loc[changed_ids, FINAL_COLS].values.tolist(), known):
+        o = o if k else None
+        if o != w:
+            ops.append((rid, o, w))
+    return ops
+
+
+# 各頁面需要的列：由共用資料表篩出，每份資料表每個檢視只算一次
+_VIEW_MASKS = {
+    "uncontacted": lambda df: ~df["is_contacted"],
+    "contacted": lambda df: df["is_contacted"],
+    "active": lambda df: df["報名狀態"].ne("確定不收"),
+}
+
+
+def _query_frame(view: str, version: int) -> pd.DataFrame:
+    df = _load_frame(version)
+    if view == "all":
+        return df
+    views = _shared_store()["views"]
+    hit = views.get(view)
+    if hit is not None and hit[0] is df:
+        return hit[1]
+    out = df.loc[_VIEW_MASKS[view](df).to_numpy()]
+    views[view] = (df, out)
+    return out
+
+
+# ---------- 雲端 ----------
+def _record_sync_stats(state: dict, stats: dict):
+    state["last"] = stats
+    state["total"]["saves"] += 1
+    state["total"]["cells"] += stats["cells"]
+    state["total"]["requests"] += stats["requests"]
+
+
+def _cloud_enabled() -> bool:
+    return get_gsheet_client() is not None
+
+
+def _push_table_to_cloud(save_df: pd.DataFrame):
+    # 整表差異同步（僅用於舊資料補發編號；一般儲存走背景同步佇列）
+    sheet = connect_to_gsheets_students()
+    if not sheet:
+        return
+    state = _gsheet_sync_state()
+    try:
+        values = [FINAL_COLS] + save_df[FINAL_COLS].values.tolist()
+        snap_reads = 0
+        if state["values"] is None:
+            state["values"] = sheets_call("get_all_values", sheet.get_all_values)
+            snap_reads = 1
+        # 只送差異，不再 clear() 後整表重寫（雲端不會出現空窗）
+        diff = diff_sheet_values(state["values"], values, key_col=FINAL_COLS.index(ID_COL))
+        stats = push_sheet_diff(sheet, diff, len(FINAL_COLS))
+        stats["requests"] += snap_reads
+        state["values"] = values
+        _record_sync_stats(state, stats)
+    except Exception:
+        # 雲端失敗不影響本機保存；快照不可信，下次重新讀取
+        state["values"] = None
+
+
+# ---------- 背景同步（write-behind） ----------
+# 儲存時與本機資料同一個交易寫入 cloud_outbox，畫面立即返回；
+# 背景執行緒合併同一筆的多次修改後批次送到雲端，失敗則退避重試。
+SYNC_MAX_ATTEMPTS = 6
+SYNC_COALESCE_SEC = 0.5
+
+
+def _outbox_put(conn, rid: str, old, new):
+    """
+    排入一筆雲端變更。old 為 None 代表新增，new 為 None 代表刪除。
+    同一筆尚未送出時與先前的變更合併：保留最早的舊列（含版本）、採用最新的新列。
+    """
+    if not _cloud_enabled():
+        return
+    row = conn.execute("SELECT old FROM cloud_outbox WHERE rid = ?", (rid,)).fetchone()
+    if row is not None:
+        old = json.loads(row[0]) if row[0] is not None else None
+        if old is None and new is None:
+            # 新增後又刪除：雲端從未有過，直接取消
+            conn.execute("DELETE FROM cloud_outbox WHERE rid = ?", (rid,))
+            return
+    conn.execute(
+        "INSERT OR REPLACE INTO cloud_outbox (rid, old, new, seq, attempts, failed, error) "
+        "VALUES (?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM cloud_outbox), 0, 0, '')",
+        (rid, None if old is None else json.dumps(old), None if new is None else json.dumps(new)),
+    )
+
+
+def _push_outbox_batch(sheet, batch: list, verify: bool = True) -> tuple:
+    """
+    batch: [(rid, old, new), ...]。依雲端目前的 紀錄ID 欄定位，
+    一次刪除、一次更新儲存格、一次新增。回傳 (統計, 衝突清單)。
+    verify=False 只用於全是第一次送出的新增列：不必先讀雲端的 紀錄ID 欄，直接一次 append。
+    """
+    remote = _fetch_remote_versions(sheet)[1] if verify else {}
+    ver_c = FINAL_COLS.index(VER_COL)
+    rows, deletes, appends, conflicts = {}, [], [], []
+
+    for rid, old, new in batch:
+        base = _as_version(old[ver_c]) if old is not None else None
+        target = _as_version(new[ver_c]) if new is not None else None
+        if rid in remote:
+            row_no, remote_ver = remote[rid]
+            if new is not None and remote_ver == target:
+                continue   # 先前的重試已寫入
+            if base is not None and remote_ver != base:
+                conflicts.append((rid, "雲端已被他人修改"))
+                continue
+            if new is None:
+                deletes.append(row_no)
+            else:
+                rows[row_no] = (old or [""] * len(FINAL_COLS), new)
+        elif new is not None:
+            if old is not None:
+                conflicts.append((rid, "雲端已被他人刪除"))
+                continue
+            appends.append(new)
+
+    cells = []
+    for row_no, (o, w) in rows.items():
+        shift = sum(1 for d in deletes if d < row_no)
+        cells.extend(_row_cell_ranges(row_no - shift, o, w))
+    diff = {"cells": cells, "delete": _merge_row_ranges(deletes), "append": appends}
+    stats = push_sheet_diff(sheet, diff, len(FINAL_COLS))
+    stats["requests"] += 1
+    return stats, conflicts
+
+
+def _sync_worker_loop(worker: dict):
+    while True:
+        worker["wake"].wait(timeout=5)
+        worker["wake"].clear()
+        time.sleep(SYNC_COALESCE_SEC)   # 讓連續的儲存併成一批
+        try:
+            perf_flush_background("gsheet-sync")   # 上一輪的量測
+            _sync_worker_step(worker)
+        except Exception as e:
+            # 本機庫被鎖住、憑證錯誤等：記下錯誤，下一輪再試（執行緒結束的話之後的儲存都會卡在佇列）
+            worker["last_error"] = f"{datetime.now():%H:%M:%S} {e}"
+
+
+def _sync_worker_step(worker: dict):
+    # 封存的列先附加到封存工作表，再從主表刪除
+    try:
+        _push_archive_outbox(worker)
+    except Exception as e:
+        worker["last_error"] = f"{datetime.now():%H:%M:%S} 封存：{e}"
+
+    with _db() as conn:
+        batch = conn.execute(
+            "SELECT rid, old, new, seq, attempts FROM cloud_outbox WHERE failed = 0 ORDER BY seq"
+        ).fetchall()
+        known_rev = _meta_get(conn, "cloud_revision")
+    if not batch:
+        try:
+            if worker.get("seeded"):   # 首次雲端下載完成後才封存
+                maybe_archive()
+        except Exception as e:
+            worker["last_error"] = f"{datetime.now():%H:%M:%S} 封存：{e}"
+        # 佇列清空後才做定期的雲端修訂檢查
+        if worker["force_pull"] or time.time() - worker["last_check"] >= CLOUD_REVALIDATE_SEC:
+            force, worker["force_pull"] = worker["force_pull"], False
+            worker["last_check"] = time.time()
+            try:
+                _pull_from_cloud(force=force)
+            except Exception as e:
+                worker["last_error"] = f"{datetime.now():%H:%M:%S} {e}"
+        return
+
+    sheet = connect_to_gsheets_students()
+    ops = [(rid, json.loads(o) if o is not None else None, json.loads(n) if n is not None else None)
+           for rid, o, n, _, _ in batch]
+    try:
+        if not sheet:
+            raise RuntimeError("無法連線到 Google Sheet")
+        rev_before = _cloud_revision(sheet)
+        # 新增列第一次送出：雲端不可能已有這些編號，直接 append。
+        # 重試、或啟動後的第一批（上次可能送出後來不及刪佇列就結束）仍要核對
+        append_only = worker["appends_safe"] and all(o is None and a == 0 for _, o, _, _, a in batch)
+        with perf_span("雲端同步批次"):
+            stats, conflicts = _push_outbox_batch(sheet, ops, verify=not append_only)
+        perf_count("同步筆數", len(ops))
+        stats["requests"] += 1
+        # 送出前雲端修訂與上次拉取時相同 → 送出後的新修訂只含自己的寫入，
+        # 記下它，下次檢查就不必為了自己的寫入再整表下載
+        if rev_before == known_rev and not conflicts:
+            rev_after = _cloud_revision(sheet)
+            stats["requests"] += 1
+            with _db() as conn:
+                _meta_set(conn, "cloud_revision", rev_after)
+    except Exception as e:
+        attempts = max(a for *_, a in batch) + 1
+        with _db() as conn:
+            conn.executemany(
+                "UPDATE cloud_outbox SET attempts = attempts + 1, error = ?, failed = attempts + 1 >= ? "
+                "WHERE rid = ? AND seq = ?",
+                [(str(e)[:300], SYNC_MAX_ATTEMPTS, rid, seq) for rid, _, _, seq, _ in batch],
+            )
+        worker["last_error"] = f"{datetime.now():%H:%M:%S} {e}"
+        if attempts < SYNC_MAX_ATTEMPTS:
+            # 指數退避 + 抖動
+            time.sleep(min(60, 2 ** attempts) * (0.5 + random.random()))
+            worker["wake"].set()
+        return
+
+    conflicted = dict(conflicts)
+    with _db() as conn:
+        # 送出期間若同一筆又有新修改，保留它並以剛送出的內容作為新的舊列
+        for (rid, _, new), (_, _, _, seq, _) in zip(ops, batch):
+            cur = conn.execute("SELECT seq FROM cloud_outbox WHERE rid = ?", (rid,)).fetchone()
+            if cur is None:
+                continue
+            if rid in conflicted:
+                # 衝突：本機這一版搬到 cloud_conflicts 保留，等使用者決定；之後的強制拉取只會蓋掉主表那一列。
+                # 送出後又改過的，舊列不動，下一批照樣衝突、再搬過去
+                if cur[0] == seq:
+                    _save_conflict(conn, rid, new, conflicted[rid])
+                    conn.execute("DELETE FROM cloud_outbox WHERE rid = ?", (rid,))
+            elif cur[0] == seq:
+                conn.execute("DELETE FROM cloud_outbox WHERE rid = ?", (rid,))
+            else:
+                conn.execute(
+                    "UPDATE cloud_outbox SET old = ? WHERE rid = ?",
+                    (None if new is None else json.dumps(new), rid),
+                )
+
+    state = _gsheet_sync_state()
+    state["values"] = None
+    _record_sync_stats(state, stats)
+    worker["last_success"] = datetime.now()
+    worker["appends_safe"] = True
+    if conflicts:
+        # 雲端版本較新：馬上拉回雲端資料（本機版本已留在 cloud_conflicts）
+        worker["force_pull"] = True
+
+
+@st.cache_resource
+def get_sync_worker() -> dict:
+    """
+    程序內唯一的背景同步執行緒（啟動時也會把上次未送完的變更送出）。
+    """
+    worker = {
+        "wake": threading.Event(),
+        "last_success": None,
+        "last_error": None,
+        "last_check": 0.0,   # 0 = 啟動後立即在背景檢查一次
+        "force_pull": False,
+        "appends_safe": False,
+        "archive_appends_safe": False,   # 封存工作表的同一個保護
+    }
+    t = threading.Thread(target=_sync_worker_loop, args=(worker,), name="gsheet-sync", daemon=True)
+    worker["thread"] = t
+    t.start()
+    worker["wake"].set()
+    return worker
+
+
+def _notify_sync_worker():
+    if _cloud_enabled():
+        get_sync_worker()["wake"].set()
+
+
+def get_sync_status() -> dict:
+    with _db() as conn:
+        pending, failed = conn.execute(
+            "SELECT COALESCE(SUM(failed = 0), 0), COALESCE(SUM(failed = 1), 0) FROM cloud_outbox"
+        ).fetchone()
+        err = conn.execute(
+            "SELECT error FROM cloud_outbox WHERE failed = 1 ORDER BY seq DESC LIMIT 1"
+        ).fetchone()
+        conflicts = conn.execute("SELECT COUNT(*) FROM cloud_conflicts").fetchone()[0]
+    return {"pending": int(pending), "failed": int(failed), "failed_error": err[0] if err else "",
+            "conflicts": int(conflicts)}
+
+
+def _save_conflict(conn, rid: str, local, reason: str):
+    conn.execute(
+        "INSERT OR REPLACE INTO cloud_conflicts (rid, local, reason, at) VALUES (?, ?, ?, ?)",
+        (rid, None if local is None else json.dumps(local), reason, datetime.now().isoformat(timespec="seconds")),
+    )
+
+
+def list_cloud_conflicts() -> pd.DataFrame:
+    """
+    雲端衝突清單：紀錄ID、幼兒姓名（本機版本）、原因、時間與本機版本的整列（local，None = 本機刪除）。
+    """
+    with _db() as conn:
+        rows = conn.execute("SELECT rid, local, reason, at FROM cloud_conflicts ORDER BY at").fetchall()
+    name_c = FINAL_COLS.index("幼兒姓名")
+    return pd.DataFrame(
+        [(rid, json.loads(local)[name_c] if local else "（本機已刪除）", reason, at, json.loads(local) if local else None)
+         for rid, local, reason, at in rows],
+        columns=[ID_COL, "幼兒姓名", "原因", "時間", "local"],
+    )
+
+
+def resolve_cloud_conflict(rid: str, keep_local: bool) -> str:
+    """
+    處理一筆雲端衝突。keep_local=False 採用雲端版本（丟掉本機副本）；
+    keep_local=True 以雲端目前的內容為基準重新套用本機版本，照一般修改排入同步佇列。
+    回傳給使用者的訊息；雲端資料還沒拉回本機時先不處理。
+    """
+    with _db() as conn:
+        row = conn.execute("SELECT local FROM cloud_conflicts WHERE rid = ?", (rid,)).fetchone()
+        if row is None:
+            return "這筆衝突已處理過。"
+        local = json.loads(row[0]) if row[0] is not None else None
+        cur = _db_read_ids(conn, [rid])
+        if not keep_local:
+            conn.execute("DELETE FROM cloud_conflicts WHERE rid = ?", (rid,))
+            return "已採用雲端版本。"
+    if local is not None and rid in cur.index and cur.loc[rid, FINAL_COLS].tolist() == local:
+        return "雲端資料尚未取回，請稍後再試。"
+
+    if local is None:
+        res = apply_record_patches([{"id": rid, "base": cur.at[rid, VER_COL], "delete": True}]) if rid in cur.index \
+            else {"ok": True}
+    elif rid in cur.index:
+        res = apply_record_patches([{"id": rid, "base": cur.at[rid, VER_COL], "set": dict(zip(FINAL_COLS, local))}])
+    else:
+        # 雲端已刪除：以本機版本重新新增
+        res = {"ok": insert_records([dict(zip(FINAL_COLS, local))])}
+    if not res["ok"] or res.get("conflicts"):
+        return "重新套用失敗，請稍後再試。"
+    with _db() as conn:
+        conn.execute("DELETE FROM cloud_conflicts WHERE rid = ?", (rid,))
+    return "已保留本機版本，將重新送到雲端。"
+
+
+def retry_failed_sync():
+    with _db() as conn:
+        conn.execute("UPDATE cloud_outbox SET failed = 0, attempts = 0 WHERE failed = 1")
+    _notify_sync_worker()
+
+
+def _cloud_revision(sheet) -> str:
+    # Drive 檔案的 modifiedTime，一次輕量的中繼資料請求
+    return _safe_str(sheets_call("get_lastUpdateTime", sheet.spreadsheet.get_lastUpdateTime))
+
+
+def _pull_from_cloud(force: bool = False) -> bool:
+    """
+    先比對雲端修訂時間，雲端有變動（或 force）才整表下載，差異寫入本機庫。
+    尚在同步佇列中的列以本機為準，不會被雲端舊資料蓋掉。
+    """
+    sheet = connect_to_gsheets_students()
+    if not sheet:
+        return False
+    rev = _cloud_revision(sheet)
+    with _db() as conn:
+        if not force and rev and rev == _meta_get(conn, "cloud_revision"):
+            return False
+
+    with perf_span("雲端整表下載"):
+        data = sheets_call("get_all_values", sheet.get_all_values)
+    if not data:
+        return False
+
+    # 記下雲端目前內容，下次整表同步只送差異
+    _gsheet_sync_state()["values"] = [list(r) for r in data]
+    df = pd.DataFrame(data[1:], columns=data[0])
+
+    df = _normalize_frame(df)
+    # 舊資料第一次載入時補發編號並寫回，之後編號永久不變
+    ids = df[ID_COL]
+    needs_ids = bool((ids.eq("") | ids.duplicated()).any())
+    df = _prepare_save_df(df)
+    if needs_ids:
+        _push_table_to_cloud(df)
+        rev = _cloud_revision(sheet)
+
+    with _db() as conn:
+        pending = {r[0] for r in conn.execute("SELECT rid FROM cloud_outbox")}
+        if pending:
+            local = _db_read_ids(conn, pending)
+            df = pd.concat([df.loc[~df[ID_COL].isin(pending)], local[FINAL_COLS]], ignore_index=True)
+        if not df.empty:
+            _db_write_frame(conn, df)
+        _meta_set(conn, "cloud_revision", rev)
+    _pull_archive_from_cloud()
+    return True
+
+
+def _ensure_local_data():
+    """
+    本機庫有資料時直接使用，雲端檢查交給背景執行緒（不擋畫面）；
+    只有第一次啟動、本機庫還是空的時候才同步下載一次。
+    """
+    if not _cloud_enabled():
+        return
+    worker = get_sync_worker()
+    if worker.get("seeded"):
+        return
+    with _db() as conn:
+        empty = conn.execute("SELECT COUNT(*) FROM registrations").fetchone()[0] == 0
+    if empty:
+        t0 = time.perf_counter()
+        try:
+            _pull_from_cloud(force=True)
+        except Exception:
+            pass
+        worker["last_check"] = time.time()
+        _mark_startup("首次雲端下載", time.perf_counter() - t0)
+    worker["seeded"] = True
+
+
+def _snapshot_tag(conn) -> str:
+    return f"{_meta_get(conn, 'db_uid')}:{_meta_get(conn, 'data_version')}"
+
+
+# ---------- 新增列日誌（append-only） ----------
+# 快照之後新增的列依序附加在日誌檔；冷啟動時接在快照後面，不必整表重建
+JOURNAL_FILE = "kindergarten_snapshot.journal"
+JOURNAL_COMPACT_ROWS = 2000   # 快照之後累積超過此筆數，就在背景把日誌併回快照
+
+
+def _journal_append(base: str, tag: str, rows: list):
+    # 一筆紀錄一次 write（O_APPEND），中途當掉只會留下讀不出來的尾巴
+    blob = pickle.dumps({"base": base, "tag": tag, "rows": rows}, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(JOURNAL_FILE, "ab") as f:
+        f.write(blob)
+
+
+def _journal_read() -> dict:
+    # 前一版標記 → 紀錄；讀到不完整的尾巴就停
+    entries = {}
+    try:
+        with open(JOURNAL_FILE, "rb") as f:
+            while True:
+                e = pickle.load(f)
+                entries[e["base"]] = e
+    except Exception:
+        pass
+    return entries
+
+
+def _journal_tail(base_tag: str, tag: str):
+    # 沿著日誌從 base_tag 接到 tag，回傳途中新增的列；中間有其他修改（接不上）回傳 None
+    entries = _journal_read()
+    rows = []
+    while base_tag != tag:
+        e = entries.get(base_tag)
+        if e is None:
+            return None
+        rows += e["rows"]
+        base_tag = e["tag"]
+    return rows
+
+
+def _tag_version(tag: str):
+    uid, _, ver = (tag or "").partition(":")
+    return uid, _as_version(ver)
+
+
+def _write_snapshot(tag: str, df: pd.DataFrame):
     try:
-        save_df = new_df.copy()
+        tmp = f"{SNAPSHOT_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump({"tag": tag, "frame": df}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, SNAPSHOT_FILE)
+    except Exception:
+        pass
+
+
+def _compact_journal(tag: str, df: pd.DataFrame):
+    """
+    把日誌併回快照：先寫新快照，再只留下比它新的日誌紀錄。
+    （與其他程序同時附加時可能丟掉一筆，下次載入接不上就整表重建，不會讀錯資料）
+    """
+    with perf_span("日誌壓縮"):
+        _write_snapshot(tag, df)
+        uid, ver = _tag_version(tag)
+        keep = [e for e in _journal_read().values()
+                if _tag_version(e["base"])[0] == uid and _tag_version(e["base"])[1] >= ver]
+        tmp = f"{JOURNAL_FILE}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            for e in keep:
+                pickle.dump(e, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, JOURNAL_FILE)
+    perf_flush_background("snapshot-compact")
+
+
+def _extend_frame(base_tag, frame, tag: str):
+    """
+    frame（標記 base_tag）+ 日誌中之後新增的列 → 標記 tag 的資料表，只整理新增的那幾列。
+    回傳 (資料表, 新增筆數)；接不上回傳 (None, 0)。
+    """
+    if frame is None or not base_tag:
+        return None, 0
+    rows = _journal_tail(base_tag, tag)
+    if rows is None:
+        return None, 0
+    if not rows:
+        return frame, 0
+    new = pd.DataFrame(rows, columns=FINAL_COLS)
+    new.index = pd.Index(new[ID_COL].tolist())
+    if any(rid in frame.index for rid in new.index):
+        return None, 0
+    df = pd.concat([frame, _add_typed_columns(new)])
+    # 類別欄位的類別依內容而定，接上之後重新轉一次
+    df["status_cat"] = df["報名狀態"].astype("category")
+    df["contact_cat"] = df["聯繫狀態"].astype("category")
+    return df, len(rows)
+
+
+# ---------- 共用資料表 ----------
+# 全程序只有一份資料表，所有 session 直接讀同一份（不複製）；寫入後依 change_log 只重讀動過的列，
+# 換成新的一份（copy-on-write），正在使用舊表的頁面不受影響。
+STORE_PATCH_MAX = 5000   # 一次要補讀的列超過此數就整表重建
 
-        # 移除系統內部欄位（若存在）
-        for c in ["is_contacted", "original_index", "sort_val", "sort_temp"]:
-            if c in save_df.columns:
-                save_df = save_df.drop(columns=[c])
 
-        # 確保欄位完整 + 排序
-        for c in FINAL_COLS:
-            if c not in save_df.columns:
-                save_df[c] = ""
+@st.cache_resource
+def _shared_store() -> dict:
+    # frame 為最新一份資料表（呼叫端不可原地修改）；views 為各檢視的篩選結果；
+    # derived 為各衍生結構目前的狀態（依變動事件增量更新，見「變動事件」一節）
+    return {"lock": threading.Lock(), "tag": None, "version": None, "frame": None,
+            "views": {}, "derived": {}, "since_snapshot": 0}
 
-        save_df["重要性"] = save_df["重要性"].replace("", "中").fillna("中")
-        save_df = save_df[FINAL_COLS].fillna("").astype(str)
 
-        # 先寫本機
-        save_df.to_csv(LOCAL_CSV, index=False, encoding="utf-8-sig")
+def _patch_frame(frame: pd.DataFrame, ids, fresh: pd.DataFrame) -> pd.DataFrame:
+    """
+    把 ids 這些紀錄換成 fresh（本機庫中的最新列，含型別欄位）：原本就有的就地換值、
+    新的依序接在後面、fresh 中沒有的視為已刪除。回傳新的一份，frame 本身不動。
+    """
+    have = set(fresh.index)
+    ids = list(ids)
+    at = frame.index.get_indexer(ids)
+    upd = [(p, rid) for rid, p in zip(ids, at) if p >= 0 and rid in have]
+    gone = [p for rid, p in zip(ids, at) if p >= 0 and rid not in have]
+    known = {rid for rid, p in zip(ids, at) if p >= 0}
+    added = [rid for rid in fresh.index if rid not in known]
+
+    # 淺拷貝後再 iloc 寫入，靠 pandas 3 的 Copy-on-Write 才不會改到 frame（requirements 已要求 pandas>=3）
+    df = frame.copy(deep=False)
+    if upd:
+        pos = np.array([p for p, _ in upd], dtype=np.int64)
+        src = fresh.loc[[rid for _, rid in upd]]
+        for j, c in enumerate(df.columns):
+            if c not in ("status_cat", "contact_cat"):
+                df.iloc[pos, j] = src[c].to_numpy()
+    if gone:
+        keep = np.ones(len(df), dtype=bool)
+        keep[gone] = False
+        df = df.iloc[keep]
+    if added:
+        df = pd.concat([df, fresh.loc[added, df.columns]])
+    # 類別欄位的類別依內容而定，換值之後重新轉一次
+    df["status_cat"] = df["報名狀態"].astype("category")
+    df["contact_cat"] = df["聯繫狀態"].astype("category")
+    return df
+
 
-        # 再寫雲端（若可用）
-        sheet = connect_to_gsheets_students()
-        if sheet:
+def _load_frame(version: int = None) -> pd.DataFrame:
+    """
+    回傳共用資料表。version 為呼叫端讀到的資料版本，共用表已是這一版就直接回傳，不碰本機庫；
+    否則依序嘗試（快照內含型別欄位，冷啟動也不必重新解析）：
+      1. 共用表 + change_log：只重讀這幾版動過的列
+      2. 磁碟快照（pickle，毫秒級）+ 新增列日誌
+      3. 從本機庫重建並寫回快照、清掉日誌
+    累積變動太多列時在背景把目前的資料表寫回快照。
+    """
+    store = _shared_store()
+    if version is not None and store["frame"] is not None and store["version"] == version:
+        return store["frame"]
+
+    t0 = time.perf_counter()
+    with store["lock"]:
+        fresh = None
+        with _db() as conn:
+            conn.execute("BEGIN")   # 版本、變更紀錄、補讀的列來自同一個時間點
+            tag = _snapshot_tag(conn)
+            if store["frame"] is not None and store["tag"] == tag:
+                return store["frame"]
+            old_uid, old_ver = _tag_version(store["tag"])
+            uid, ver = _tag_version(tag)
+            ids = _changed_ids(conn, old_ver, ver) if store["frame"] is not None and old_uid == uid else None
+            if ids is not None and len(ids) <= STORE_PATCH_MAX:
+                fresh = _db_read_ids(conn, ids)
+
+        df, derived = None, {}
+        if fresh is not None:
+            old = store["frame"]
+            fresh = _add_typed_columns(fresh)
+            df = _patch_frame(old, ids, fresh)
+            if store["derived"]:
+                at = old.index.get_indexer(list(ids))
+                derived = _publish_changes(store["derived"], old.iloc[at[at >= 0]], at[at >= 0], fresh, df)
+            since = store["since_snapshot"] + len(ids)
+            perf_count("共用表補讀列數", len(ids))
+            _mark_startup("讀取資料表（補讀變動）", time.perf_counter() - t0)
+        else:
             try:
-                values = [FINAL_COLS] + save_df.values.tolist()
-                # 一次更新 A1，較穩定、速度也較好
-                sheet.clear()
-                sheet.update("A1", values)
+                with open(SNAPSHOT_FILE, "rb") as f:
+                    snap = pickle.load(f)
+                if "dob" in snap["frame"].columns:
+                    df, since = _extend_frame(snap["tag"], snap["frame"], tag)
             except Exception:
-                # 雲端失敗不影響本機保存
                 pass
+            if df is not None:
+                _mark_startup("讀取資料表（快照）", time.perf_counter() - t0)
+
+        if df is None:
+            with _db() as conn:
+                tag = _snapshot_tag(conn)
+                df = _add_typed_columns(_db_read(conn))
+            _write_snapshot(tag, df)
+            if os.path.exists(JOURNAL_FILE):
+                os.remove(JOURNAL_FILE)
+            since = 0
+            _mark_startup("讀取資料表（重建）", time.perf_counter() - t0)
+        elif since > JOURNAL_COMPACT_ROWS:
+            threading.Thread(target=_compact_journal, args=(tag, df), name="snapshot-compact", daemon=True).start()
+            since = 0
+
+        store.update(tag=tag, version=_tag_version(tag)[1], frame=df, views={}, derived=derived, since_snapshot=since)
+    return df
+
+
+# ---------- 變動事件（衍生結構增量維護） ----------
+# 所有寫入（整表儲存、新增 / 匯入、逐筆修改、封存）都在 change_log 記下動過的紀錄ID；
+# 共用表補讀這些列時，比對新舊列產生「每筆每欄一個」的變動事件，交給登記的衍生結構各自更新，
+# 不再每次從整張表重算。整表重建（變動太多、快照、換資料庫）時衍生結構清空，下次使用才整表建立。
+FEED_FIELDS = [c for c in FINAL_COLS if c not in (ID_COL, VER_COL)]
+_FEED_SUBSCRIBERS = {}
+
+
+def subscribe_changes(name: str, init, apply, probe=None):
+    """
+    登記一個衍生結構：
+      init(frame)          從整張表建立狀態
+      apply(state, batch)  依一批變動回傳新狀態（不可原地修改舊狀態）；回傳 None = 丟掉，下次使用時整表重建
+      probe(state, frame)  一致性檢查時拿來比對的值（預設為狀態本身）
+    batch 為 {"events": 變動事件表, "old": 變動前的列, "old_pos": 這些列在舊共用表中的位置,
+    "new": 變動後的列, "frame": 新的共用表}，old / new 皆含型別欄位；新增的紀錄只在 new、刪除的只在 old。
+    """
+    _FEED_SUBSCRIBERS[name] = {"init": init, "apply": apply, "probe": probe or (lambda state, frame: state)}
+
+
+def change_events(old: pd.DataFrame, new: pd.DataFrame) -> pd.DataFrame:
+    """
+    變動前後的列 → 變動事件（op / 紀錄ID / 欄位 / 舊值 / 新值），每筆紀錄每個欄位一列：
+    insert / delete 列出全部欄位，update 只列值有變的欄位（只有版本變的紀錄不產生事件）。
+    """
+    a = old[FEED_FIELDS].to_numpy(dtype=object)
+    b = new[FEED_FIELDS].to_numpy(dtype=object)
+    in_new = old.index.isin(new.index)
+    in_old = new.index.isin(old.index)
+    cols = np.array(FEED_FIELDS, dtype=object)
+    n_f = len(FEED_FIELDS)
+    parts = []
+
+    def add(op, ids, rows, cols_at, before, after):
+        parts.append(pd.DataFrame({"op": op, ID_COL: ids[rows], "欄位": cols[cols_at], "舊值": before, "新值": after}))
+
+    ins = np.flatnonzero(~in_old)
+    if len(ins):
+        r, c = np.repeat(ins, n_f), np.tile(np.arange(n_f), len(ins))
+        add("insert", new.index.to_numpy(dtype=object), r, c, None, b[r, c])
+    both = np.flatnonzero(in_new)
+    if len(both):
+        pa = a[both]
+        pb = b[new.index.get_indexer(old.index[both])]
+        changed = (pa != pb) & ~(pd.isna(pa) & pd.isna(pb))
+        r, c = np.nonzero(changed)
+        add("update", old.index.to_numpy(dtype=object)[both], r, c, pa[r, c], pb[r, c])
+    gone = np.flatnonzero(~in_new)
+    if len(gone):
+        r, c = np.repeat(gone, n_f), np.tile(np.arange(n_f), len(gone))
+        add("delete", old.index.to_numpy(dtype=object), r, c, a[r, c], None)
+    if not parts:
+        return pd.DataFrame(columns=["op", ID_COL, "欄位", "舊值", "新值"])
+    return pd.concat(parts, ignore_index=True)
+
+
+def _publish_changes(derived: dict, old: pd.DataFrame, old_pos: np.ndarray, new: pd.DataFrame,
+                     frame: pd.DataFrame) -> dict:
+    # 共用表補讀後呼叫（持有 store 鎖）：每個已建立的衍生結構各自套用這一批變動
+    batch = {"events": change_events(old, new), "old": old, "new": new, "frame": frame, "old_pos": old_pos}
+    perf_count("變動事件數", len(batch["events"]))
+    out = {}
+    for name, state in derived.items():
+        sub = _FEED_SUBSCRIBERS.get(name)
+        if sub is None or state is None:
+            continue
+        try:
+            with perf_span(f"增量更新：{name}"):
+                state = sub["apply"](state, batch)
+        except Exception:
+            state = None   # 更新失敗就丟掉，下次使用時整表重建
+        if state is not None:
+            out[name] = state
+    return out
+
+
+def _derived(name: str):
+    # (共用表, 衍生結構狀態)，兩者對應同一個資料版本
+    _ensure_local_data()
+    _load_frame(get_data_version())
+    store = _shared_store()
+    with store["lock"]:
+        frame = store["frame"]
+        state = store["derived"].get(name)
+        if state is None:
+            with perf_span(f"{name}（整表）"):
+                state = _FEED_SUBSCRIBERS[name]["init"](frame)
+            store["derived"][name] = state
+        return frame, state
+
+
+def derived_state(name: str):
+    """
+    取得衍生結構目前的狀態（已追上最新資料版本）。回傳的是共用物件，請勿直接修改。
+    """
+    return _derived(name)[1]
+
+
+def _probe_diff(got, want) -> str:
+    if isinstance(got, dict) and isinstance(want, dict):
+        keys = [k for k in set(got) | set(want) if got.get(k) != want.get(k)]
+        return "；".join(f"{k}: {repr(got.get(k))[:200]} ≠ {repr(want.get(k))[:200]}" for k in keys[:5])
+    return f"{repr(got)[:200]} ≠ {repr(want)[:200]}"
+
+
+def check_derived_consistency(names=None) -> dict:
+    """
+    一致性檢查（測試 / 基準程式用）：每個衍生結構目前增量維護的狀態與整表重算的結果比對。
+    回傳 {名稱: 不一致說明}，全部一致時為空 dict。
+    """
+    out = {}
+    for name, sub in list(_FEED_SUBSCRIBERS.items()):
+        if names is not None and name not in names:
+            continue
+        frame, state = _derived(name)
+        got, want = sub["probe"](state, frame), sub["probe"](sub["init"](frame), frame)
+        if got != want:
+            out[name] = _probe_diff(got, want)
+    return out
+
+
+# 卡片分頁與狀態群組：每列一個代碼 = 是否已聯繫 × 狀態組，順序與共用表一致
+def _partition_codes(rows: pd.DataFrame) -> np.ndarray:
+    return (rows["is_contacted"].to_numpy(dtype=np.int8) * len(NEW_STATUS_OPTIONS)
+            + rows["status_group"].cat.codes.to_numpy(dtype=np.int8))
+
+
+def _partition_init(frame: pd.DataFrame) -> dict:
+    return {"codes": _partition_codes(frame)}
+
+
+def _partition_apply(state: dict, batch: dict):
+    # 與 _patch_frame 相同的換法：刪除的列拿掉、新增的接在最後、修改的就地換代碼
+    old, new, frame = batch["old"], batch["new"], batch["frame"]
+    codes = state["codes"]
+    gone = batch["old_pos"][~old.index.isin(new.index)]
+    if len(gone):
+        codes = np.delete(codes, gone)
+    added = ~new.index.isin(old.index)
+    codes = np.concatenate([codes, np.zeros(int(added.sum()), dtype=np.int8)])
+    if len(codes) != len(frame):
+        return None
+    # 修改的列在新表中的位置 = 舊位置 - 前面被刪掉的列數
+    upd_old = batch["old_pos"][old.index.isin(new.index)]
+    upd_ids = old.index[old.index.isin(new.index)]
+    pos = np.empty(len(new), dtype=np.int64)
+    pos[new.index.get_indexer(upd_ids)] = upd_old - np.searchsorted(np.sort(gone), upd_old)
+    pos[added] = len(frame) - added.sum() + np.arange(added.sum())
+    codes[pos] = _partition_codes(new)
+    return {"codes": codes}
+
+
+def _partition_probe(state: dict, frame: pd.DataFrame) -> dict:
+    codes = pd.Series(state["codes"], index=frame.index)
+    return {int(k): ids.tolist() for k, ids in codes.groupby(codes, sort=True).groups.items()}
+
+
+subscribe_changes("分頁分組", _partition_init, _partition_apply, _partition_probe)
+
+
+def view_partition(view: str, groups) -> pd.DataFrame:
+    """
+    檢視（uncontacted / contacted / all）中屬於 groups 這些狀態組的列，順序與共用表相同。
+    由「分頁分組」的每列代碼直接挑出列位置，不必先切出檢視再逐列比對狀態。
+    """
+    frame, part = _derived("分頁分組")
+    flags = {"uncontacted": (0,), "contacted": (1,), "all": (0, 1)}[view]
+    want = [f * len(NEW_STATUS_OPTIONS) + NEW_STATUS_OPTIONS.index(g) for f in flags for g in groups]
+    return frame.iloc[np.flatnonzero(np.isin(part["codes"], want))]
+
+
+def load_registered_data() -> pd.DataFrame:
+    """
+    回傳以 紀錄ID 為 index 的資料表（df.at[紀錄ID, 欄位] 為 O(1) 查找）。
+    除 FINAL_COLS 的顯示字串外另含 TYPED_COLS 型別欄位。
+    全程序共用同一份、不複製：要修改請先 .copy()，寫入一律走 insert_records / apply_record_patches 等。
+    """
+    with perf_span("載入資料"):
+        _ensure_local_data()
+        return _load_frame(get_data_version())
+
+
+def query_registrations(view: str) -> pd.DataFrame:
+    """
+    只取頁面需要的列：all / uncontacted（非已聯繫）/ contacted / active（非確定不收）。
+    """
+    with perf_span("查詢檢視"):
+        _ensure_local_data()
+        return _query_frame(view, get_data_version())
 
-        # 清 cache，讓畫面下一次讀到最新
-        load_registered_data.clear()
+
+def sync_data_to_gsheets(new_df: pd.DataFrame) -> bool:
+    """
+    整表儲存：本機只寫有變動的列，雲端變更交給背景同步，不等待網路。
+    """
+    try:
+        save_df = _prepare_save_df(new_df)
+
+        with _db() as conn:
+            for rid, old, new in _db_write_frame(conn, save_df):
+                _outbox_put(conn, rid, old, new)
+
+        _notify_sync_worker()
+        return True
+    except Exception as e:
+        st.session_state["msg_error"] = f"儲存錯誤: {e}"
+        return False
+
+
+def _outbox_put_new(conn, rows: list):
+    # 新增列一次排入雲端佇列（新編號不會已在佇列中，不必逐筆合併）
+    if not rows or not _cloud_enabled():
+        return
+    start = conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM cloud_outbox").fetchone()[0]
+    id_c = FINAL_COLS.index(ID_COL)
+    conn.executemany(
+        "INSERT OR REPLACE INTO cloud_outbox (rid, old, new, seq, attempts, failed, error) "
+        "VALUES (?, NULL, ?, ?, 0, 0, '')",
+        [(row[id_c], json.dumps(row), start + i) for i, row in enumerate(rows)],
+    )
+
+
+def insert_records(rows: list) -> bool:
+    """
+    新增資料（append-only）：本機一次交易寫入並附加到日誌，下次載入只把新增的列接到快取的資料表後面；
+    雲端由背景同步以一次 append_rows 送出。成本與資料量無關。
+    """
+    try:
+        save_df = _prepare_save_df(_normalize_frame(pd.DataFrame(rows)))
+        values = save_df[FINAL_COLS].values.tolist()
+        with _db() as conn:
+            _db_insert(conn, save_df)
+            _outbox_put_new(conn, values)
+            # 寫入交易內讀到的版本就是這次新增造成的（前一版 = 減一）
+            tag = _snapshot_tag(conn)
+        uid, ver = _tag_version(tag)
+        try:
+            _journal_append(f"{uid}:{ver - 1}", tag, values)
+        except Exception:
+            pass   # 只是少了捷徑，下次載入會整表重建
+
+        _notify_sync_worker()
         return True
     except Exception as e:
         st.session_state["msg_error"] = f"儲存錯誤: {e}"
         return False
 
 
+# ---------- 批次匯入 ----------
+IMPORT_CHUNK_ROWS = 2000
+# 來源欄名 → FINAL_COLS（Google 表單 / 舊 Excel 常見的寫法）
+IMPORT_ALIASES = {
+    "報名狀態": ["報名狀態", "狀態"],
+    "聯繫狀態": ["聯繫狀態", "聯絡狀態"],
+    "登記日期": ["登記日期", "時間戳記", "填表日期", "報名日期", "日期"],
+    "幼兒姓名": ["幼兒姓名", "姓名", "幼兒", "孩子姓名", "小孩姓名", "學生姓名"],
+    "家長稱呼": ["家長稱呼", "家長", "家長姓名", "聯絡人"],
+    "電話": ["電話", "手機", "聯絡電話", "行動電話", "家長電話"],
+    "幼兒生日": ["幼兒生日", "生日", "出生日期", "出生年月日"],
+    "預計入學資訊": ["預計入學資訊", "預計入學", "入學年段"],
+    "推薦人": ["推薦人", "介紹人"],
+    "備註": ["備註", "說明", "留言", "其他"],
+    "重要性": ["重要性", "優先"],
+}
+IMPORT_COLS = [c for c in FINAL_COLS if c not in (ID_COL, VER_COL)]
+
+
+def _dedupe_header(header) -> list:
+    out, seen = [], {}
+    for i, h in enumerate(header):
+        h = _safe_str(h) or f"欄{i + 1}"
+        seen[h] = seen.get(h, 0) + 1
+        out.append(h if seen[h] == 1 else f"{h}_{seen[h]}")
+    return out
+
+
+def _csv_encoding(f) -> str:
+    # Excel 存的 CSV 常是 Big5（cp950）；只看開頭一段判斷
+    head = f.read(65536)
+    f.seek(0)
+    try:
+        head.decode("utf-8")
+        return "utf-8-sig"
+    except UnicodeDecodeError as e:
+        # 截斷在多位元組字元中間不算錯
+        return "utf-8-sig" if e.start >= len(head) - 3 else "cp950"
+
+
+def iter_import_chunks(f, filename: str, chunk_rows: int = IMPORT_CHUNK_ROWS):
+    """
+    逐段讀取上傳檔（每段 chunk_rows 列，全部字串），不把整個檔案載入記憶體。
+    xlsx 用 openpyxl 唯讀模式逐列讀第一個工作表；csv 用 pandas chunksize。
+    """
+    f.seek(0)
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        from openpyxl import load_workbook   # 只有匯入 Excel 時才載入
+        wb = load_workbook(f, read_only=True, data_only=True)
+        try:
+            rows = wb.worksheets[0].iter_rows(values_only=True)
+            header = _dedupe_header(next(rows, ()))
+            width = len(header)
+            buf = []
+            for r in rows:
+                r = tuple(r[:width]) + (None,) * (width - len(r))
+                if all(v is None or _safe_str(v) == "" for v in r):
+                    continue
+                buf.append(r)
+                if len(buf) >= chunk_rows:
+                    yield pd.DataFrame(buf, columns=header).fillna("").astype(str)
+                    buf = []
+            if buf:
+                yield pd.DataFrame(buf, columns=header).fillna("").astype(str)
+        finally:
+            wb.close()
+    else:
+        # 自己包文字層：pandas 讀完會關掉它開的 handle，連帶關掉上傳檔
+        text = io.TextIOWrapper(f, encoding=_csv_encoding(f), newline="")
+        try:
+            for chunk in pd.read_csv(text, dtype=str, keep_default_na=False, chunksize=chunk_rows):
+                chunk.columns = _dedupe_header(chunk.columns)
+                yield chunk
+        finally:
+            text.detach()
+
+
+def guess_import_mapping(columns) -> dict:
+    # {FINAL_COLS 欄位: 來源欄名或 None}
+    cols = [_safe_str(c) for c in columns]
+    mapping = {}
+    for target in IMPORT_COLS:
+        mapping[target] = next((c for a in IMPORT_ALIASES[target] for c in cols if c == a), None)
+    return mapping
+
+
+def _import_dates(s: pd.Series) -> pd.Series:
+    # 只取日期部分（時間戳記 / Excel 日期帶時間），民國或西元都轉成「民國/月/日」，解析不了保留原字串
+    raw = _safe_strs(s)
+    tok = raw.str.split().str[0].fillna("")
+    # 填的是西元年：先換成民國年再解析（閏年判斷才會正確）
+    yr = pd.to_numeric(tok.str.extract(r"^(\d{4})[/\-.]", expand=False), errors="coerce")
+    west = yr.ge(1912)
+    tok = tok.mask(west, (yr - 1911).astype("Int64").astype(str) + tok.str[4:])
+    ymd = parse_roc_dates(tok)
+    y = ymd["y"]
+    ok = y.notna() & (y > 1911)
+    out = ((y - 1911).astype("string") + "/" + ymd["m"].astype("string").str.zfill(2)
+           + "/" + ymd["d"].astype("string").str.zfill(2))
+    return out.where(ok, raw).astype(object)
+
+
+def prepare_import_chunk(raw: pd.DataFrame, mapping: dict) -> pd.DataFrame:
+    """
+    一段來源資料 → 可直接寫入的 FINAL_COLS 資料表（向量化）：
+    對應欄位、略過空白列、日期與電話正規化、空白的預計入學資訊依生日批次推算、發新編號。
+    """
+    df = pd.DataFrame({c: raw[src] if src else "" for c, src in mapping.items() if c in IMPORT_COLS},
+                      index=raw.index)
+    df = _normalize_frame(df.assign(**{ID_COL: "", VER_COL: "1"}))
+    df = df.loc[df["幼兒姓名"].ne("") | df["電話"].ne("")].copy()
+    if df.empty:
+        return df[FINAL_COLS]
+
+    if not mapping.get("報名狀態"):
+        df["報名狀態"] = "預約參觀"   # 與新增報名頁相同
+    df["幼兒生日"] = _import_dates(df["幼兒生日"])
+    df["登記日期"] = _import_dates(df["登記日期"]).replace("", to_roc_str(date.today()))
+
+    need_plan = df["預計入學資訊"].eq("")
+    if need_plan.any():
+        ymd = parse_roc_dates(df.loc[need_plan, "幼兒生日"])
+        roadmaps = admission_roadmaps(pd.DataFrame(
+            {"dob_y": ymd["y"], "dob_m": ymd["m"], "dob_d": ymd["d"]}, index=ymd.index))
+        df.loc[need_plan, "預計入學資訊"] = [
+            (roadmaps.get(i) or ["待確認"])[0] for i in df.index[need_plan]
+        ]
+
+    df[ID_COL] = [new_record_id() for _ in range(len(df))]
+    return df[FINAL_COLS].reset_index(drop=True)
+
+
+def import_registrations(chunks, progress=None) -> dict:
+    """
+    chunks 為 prepare_import_chunk 的結果（可為產生器）。
+    整批在同一個本機交易寫入，全部成功才生效；雲端由背景同步一次 append_rows 送出。
+    回傳 {"ok": bool, "rows": 筆數, "error": 訊息}。
+    """
+    total = 0
+    try:
+        with perf_span("批次匯入"), _db() as conn:
+            for save_df in chunks:
+                if save_df.empty:
+                    continue
+                _db_insert(conn, save_df)
+                _outbox_put_new(conn, save_df.values.tolist())
+                total += len(save_df)
+                if progress:
+                    progress(total)
+        _notify_sync_worker()
+        return {"ok": True, "rows": total, "error": ""}
+    except Exception as e:
+        return {"ok": False, "rows": 0, "error": str(e)}
+
+
+# ---------- 匯出 ----------
+# 按下下載時才產生，依資料版本存在磁碟：同一版本同一格式只產生一次
+EXPORT_DIR = "kindergarten_exports"
+EXPORT_CHUNK_ROWS = 5000
+_export_lock = threading.Lock()
+
+
+def _export_tag() -> str:
+    with _db() as conn:
+        return f"{_meta_get(conn, 'db_uid')[:8]}_{_meta_get(conn, 'data_version')}"
+
+
+def _write_export_csv(df: pd.DataFrame, path: str):
+    # 分段寫入檔案，不先組成一整個字串
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        f.write(",".join(FINAL_COLS) + "\n")
+        for lo in range(0, len(df), EXPORT_CHUNK_ROWS):
+            df.iloc[lo:lo + EXPORT_CHUNK_ROWS][FINAL_COLS].to_csv(f, header=False, index=False)
+
+
+def _write_export_xlsx(df: pd.DataFrame, path: str, year: int):
+    """
+    指定學年：每個「班級 × 報名狀態」一個工作表（沒有班級的歸「未分班」）。
+    openpyxl write_only 模式逐列寫出，不在記憶體中保留整本活頁簿。
+    """
+    from openpyxl import Workbook   # 只有匯出 Excel 時才載入
+    grade = grades_for_years(df, [year])[int(year)].fillna("未分班")
+    order = {g: i for i, g in enumerate(GRADE_LIST[::-1] + ["未分班"])}
+    keys = pd.DataFrame({"grade": grade, "status": df["status_group"].astype(str)}, index=df.index)
+
+    wb = Workbook(write_only=True)
+    groups = sorted(keys.groupby(["grade", "status"], sort=False).groups.items(),
+                    key=lambda kv: (order.get(kv[0][0], len(order)), NEW_STATUS_OPTIONS.index(kv[0][1])))
+    for (g, status), idx in groups:
+        ws = wb.create_sheet(title=re.sub(r"[\\/*?:\[\]]", "_", f"{g}-{status}")[:31])
+        ws.append(FINAL_COLS)
+        for row in df.loc[idx, FINAL_COLS].itertuples(index=False, name=None):
+            ws.append(row)
+    if not groups:
+        wb.create_sheet(title="無資料").append(FINAL_COLS)
+    wb.save(path)
+
+
+def export_file(kind: str, year: int = None) -> str:
+    """
+    kind: "csv" 或 "xlsx"（xlsx 需指定學年）。回傳磁碟上的匯出檔路徑；
+    資料版本沒變就直接用上次產生的檔案，舊版本的檔案在產生新檔時清掉。
+    """
+    tag = _export_tag()
+    name = f"registrations_{tag}.csv" if kind == "csv" else f"registrations_{tag}_{int(year)}.xlsx"
+    path = os.path.join(EXPORT_DIR, name)
+    if os.path.exists(path):
+        return path
+    with _export_lock, perf_span(f"匯出 {kind}"):
+        if os.path.exists(path):
+            return path
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        df = load_registered_data()
+        tmp = f"{path}.{os.getpid()}.tmp"
+        if kind == "csv":
+            _write_export_csv(df, tmp)
+        else:
+            _write_export_xlsx(df, tmp, year)
+        os.replace(tmp, path)
+        for old in os.listdir(EXPORT_DIR):
+            if not old.startswith(f"registrations_{tag}"):
+                try:
+                    os.remove(os.path.join(EXPORT_DIR, old))
+                except Exception:
+                    pass
+    return path
+
+
+def export_bytes(kind: str, year: int = None) -> bytes:
+    """
+    下載按鈕用：export_file 的內容。st.download_button 會把整份內容放進記憶體送給瀏覽器，
+    無法串流；產生檔案時仍是分塊寫入磁碟。
+    """
+    with open(export_file(kind, year), "rb") as f:
+        return f.read()
+
+
+# ---------- 封存（冷資料） ----------
+# 確定不收（登記超過寬限天數）與已畢業 / 超齡的幼兒移到封存表，日常頁面只處理在學 / 招生中的資料
+ARCHIVE_REJECT_GRACE_DAYS = 90
+ARCHIVE_EVERY_DAYS = 7
+
+
+def archive_mask(df: pd.DataFrame) -> pd.Series:
+    # df 需含型別欄位
+    cutoff = pd.Timestamp(date.today()) - pd.Timedelta(days=ARCHIVE_REJECT_GRACE_DAYS)
+    rejected = df["報名狀態"].eq("確定不收") & (df["reg_date"].isna() | (df["reg_date"] < cutoff))
+    graduated = grades_from_dob(df, current_academic_year()).eq("畢業/超齡")
+    return rejected | graduated
+
+
+def archive_records() -> int:
+    """
+    把符合條件的列從主表搬到封存表（同一個交易），雲端：主表刪除走原本的同步佇列，
+    封存工作表的附加走 archive_outbox。回傳搬移筆數。
+    """
+    with perf_span("封存"), _db() as conn:
+        conn.execute("BEGIN IMMEDIATE")   # 讀取到寫入之間不讓其他人插進來
+        hot = _add_typed_columns(_db_read(conn))
+        cold = hot.loc[archive_mask(hot), FINAL_COLS]
+        if not cold.empty:
+            values = cold.values.tolist()
+            conn.executemany(
+                f"INSERT OR REPLACE INTO registrations_archive ({_DB_COLS}) VALUES ({_DB_MARKS})", values
+            )
+            conn.executemany(f"DELETE FROM registrations WHERE {_q(ID_COL)} = ?", [(rid,) for rid in cold.index])
+            if _cloud_enabled():
+                for rid, row in zip(cold.index, values):
+                    _outbox_put(conn, rid, row, None)
+                start = conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM archive_outbox").fetchone()[0]
+                conn.executemany(
+                    "INSERT OR REPLACE INTO archive_outbox (rid, new, seq) VALUES (?, ?, ?)",
+                    [(rid, json.dumps(row), start + i) for i, (rid, row) in enumerate(zip(cold.index, values))],
+                )
+            _bump_data_version(conn, cold.index.tolist())
+            conn.execute("UPDATE meta SET v = CAST(v AS INTEGER) + 1 WHERE k = 'archive_version'")
+        _meta_set(conn, "archived_on", date.today().isoformat())
+    perf_count("封存筆數", len(cold))
+    _notify_sync_worker()
+    return len(cold)
+
+
+def maybe_archive() -> int:
+    # 距上次封存滿 ARCHIVE_EVERY_DAYS 天才執行（同步執行緒在首次雲端下載後、空閒時呼叫；
+    # 未連雲端時在登入後呼叫）。主表還是空的（尚未下載）就不動，免得記下封存日期把真正的封存延後
+    with _db() as conn:
+        last = _meta_get(conn, "archived_on")
+        empty = conn.execute("SELECT COUNT(*) FROM registrations").fetchone()[0] == 0
+    if empty or (last and (date.today() - date.fromisoformat(last)).days < ARCHIVE_EVERY_DAYS):
+        return 0
+    return archive_records()
+
+
+def _push_archive_outbox(worker: dict):
+    # 封存列一次 append 到封存工作表。重試、或啟動後的第一批（上次可能附加後來不及刪佇列就結束）
+    # 先核對雲端已有的編號，避免重複附加
+    with _db() as conn:
+        batch = conn.execute("SELECT rid, new, seq, attempts FROM archive_outbox ORDER BY seq").fetchall()
+    if not batch:
+        return
+    sheet = connect_to_gsheets_archive()
+    try:
+        if not sheet:
+            raise RuntimeError("無法連線到封存工作表")
+        ops = [(rid, None, json.loads(n)) for rid, n, _, _ in batch]
+        _push_outbox_batch(sheet, ops, verify=not worker["archive_appends_safe"] or any(a for *_, a in batch))
+    except Exception as e:
+        with _db() as conn:
+            conn.executemany("UPDATE archive_outbox SET attempts = attempts + 1, error = ? WHERE rid = ?",
+                             [(str(e)[:300], rid) for rid, *_ in batch])
+        raise
+    with _db() as conn:
+        conn.executemany("DELETE FROM archive_outbox WHERE rid = ? AND seq = ?", [(rid, seq) for rid, _, seq, _ in batch])
+    worker["archive_appends_safe"] = True
+
+
+def _pull_archive_from_cloud():
+    # 封存工作表是各裝置共用的封存清單：整表換成雲端內容（尚未送出的本機封存列保留）
+    ws = open_worksheet(ARCHIVE_SHEET)
+    if ws is None:
+        return
+    try:
+        data = sheets_call("get_all_values", ws.get_all_values)
+    except Exception:
+        return
+    if not data:
+        return
+    df = _prepare_save_df(_normalize_frame(pd.DataFrame(data[1:], columns=data[0])))
+    with _db() as conn:
+        pending = {r[0] for r in conn.execute("SELECT rid FROM archive_outbox")}
+        conn.execute(
+            f"DELETE FROM registrations_archive WHERE {_q(ID_COL)} NOT IN (SELECT rid FROM archive_outbox)"
+        )
+        conn.executemany(
+            f"INSERT OR REPLACE INTO registrations_archive ({_DB_COLS}) VALUES ({_DB_MARKS})",
+            df.loc[~df[ID_COL].isin(pending), FINAL_COLS].values.tolist(),
+        )
+        conn.execute("UPDATE meta SET v = CAST(v AS INTEGER) + 1 WHERE k = 'archive_version'")
+
+
+def get_archive_status() -> dict:
+    with _db() as conn:
+        return {
+            "hot": conn.execute("SELECT COUNT(*) FROM registrations").fetchone()[0],
+            "archived": conn.execute("SELECT COUNT(*) FROM registrations_archive").fetchone()[0],
+            "pending": conn.execute("SELECT COUNT(*) FROM archive_outbox").fetchone()[0],
+            "last": _meta_get(conn, "archived_on"),
+            "version": int(_meta_get(conn, "archive_version", "0")),
+        }
+
+
+@st.cache_data(max_entries=2)
+def _archive_frame(version: int) -> pd.DataFrame:
+    with _db() as conn:
+        df = pd.read_sql_query(f"SELECT {_DB_COLS} FROM registrations_archive", conn).fillna("").astype(str)
+    df.index = pd.Index(df[ID_COL].tolist())
+    return _add_typed_columns(df)
+
+
+@st.cache_resource(max_entries=2)
+def _archive_search_index(version: int) -> dict:
+    return build_search_index(_archive_frame(version))
+
+
+def search_archive(kw: str) -> pd.DataFrame:
+    """
+    「包含封存資料」時用：在封存表中搜尋，依命中欄位排序，只在勾選時才讀封存表 / 建索引。
+    """
+    version = get_archive_status()["version"]
+    with perf_span("搜尋封存"):
+        pos = search_index(_archive_search_index(version), kw)
+        return _archive_frame(version).iloc[pos][FINAL_COLS]
+
+
+def _fetch_remote_versions(sheet):
+    """
+    只讀雲端的 紀錄ID / 版本 兩欄（一次請求），回傳 (編號清單, {編號: (列號, 版本)})。
+    列號為 1 起算（第 1 列為標題）。
+    """
+    c1 = _col_letter(FINAL_COLS.index(ID_COL) + 1)
+    c2 = _col_letter(FINAL_COLS.index(VER_COL) + 1)
+    rows = sheets_call("get", sheet.get, f"{c1}:{c2}")
+    ids, pos = [], {}
+    for n, r in enumerate(rows, start=1):
+        rid = _safe_str(r[0]) if len(r) > 0 else ""
+        ids.append(rid)
+        if n > 1 and rid:
+            pos[rid] = (n, _as_version(r[1] if len(r) > 1 else ""))
+    return ids, pos
+
+
+def apply_record_patches(patches: list) -> dict:
+    """
+    以列為單位套用修改，並以版本號偵測衝突（樂觀鎖）。
+    patches: [{"id": 紀錄ID, "base": 畫面上的版本, "set": {欄位: 新值}} 或
+              {"id": 紀錄ID, "base": 畫面上的版本, "delete": True}]
+    回傳 {"ok": bool, "updated": [...], "deleted": [...], "conflicts": [(紀錄ID, 原因)],
+          "changed": {紀錄ID: [實際變更的欄位]}}
+    本機交易完成即返回；雲端由背景同步送出，雲端端的衝突在側邊欄顯示。
+    """
+    result = {"ok": True, "updated": [], "deleted": [], "conflicts": [], "changed": {}}
+    if not patches:
+        return result
+
+    try:
+        with _db() as conn:
+            # 只讀要修改的列
+            cur = _db_read_ids(conn, [_safe_str(p.get("id")) for p in patches])
+
+            for p in patches:
+                rid = _safe_str(p.get("id"))
+                base = _as_version(p.get("base"))
+                if rid not in cur.index:
+                    result["conflicts"].append((rid, "已被他人刪除"))
+                    continue
+
+                old_row = cur.loc[rid, FINAL_COLS].tolist()
+                if p.get("delete"):
+                    n = conn.execute(
+                        f"DELETE FROM registrations WHERE {_q(ID_COL)} = ? AND {_q(VER_COL)} = ?",
+                        (rid, str(base)),
+                    ).rowcount
+                    if not n:
+                        result["conflicts"].append((rid, "已被他人修改"))
+                        continue
+                    result["deleted"].append(rid)
+                    _outbox_put(conn, rid, old_row, None)
+                    continue
+
+                changes = {k: _safe_str(v) for k, v in p.get("set", {}).items()
+                           if k in FINAL_COLS and k not in (ID_COL, VER_COL)
+                           and _safe_str(cur.at[rid, k]) != _safe_str(v)}
+                if not changes:
+                    continue
+                changes[VER_COL] = str(base + 1)
+                # 單列交易更新，WHERE 版本 = 原版本 擋掉其他人同時的修改
+                n = conn.execute(
+                    f"UPDATE registrations SET {', '.join(_q(k) + ' = ?' for k in changes)} "
+                    f"WHERE {_q(ID_COL)} = ? AND {_q(VER_COL)} = ?",
+                    list(changes.values()) + [rid, str(base)],
+                ).rowcount
+                if not n:
+                    result["conflicts"].append((rid, "已被他人修改"))
+                    continue
+                result["updated"].append(rid)
+                result["changed"][rid] = [k for k in changes if k != VER_COL]
+                _outbox_put(conn, rid, old_row, [changes.get(c, v) for c, v in zip(FINAL_COLS, old_row)])
+
+            if result["updated"] or result["deleted"]:
+                _bump_data_version(conn, result["updated"] + result["deleted"])
+
+        _notify_sync_worker()
+    except Exception as e:
+        result["ok"] = False
+        st.session_state["msg_error"] = f"儲存錯誤: {e}"
+    return result
+
+
+def report_patch_result(res: dict, names: dict = None):
+    """
+    依 apply_record_patches 結果顯示訊息；names 為 {紀錄ID: 幼兒姓名}。
+    """
+    names = names or {}
+    if not res["ok"]:
+        st.error("儲存失敗，請檢查網路或權限。")
+        return
+    if res["updated"] or res["deleted"]:
+        # 逐筆列出改了哪些欄位（太多時只列前面幾筆）
+        changed = res.get("changed", {})
+        lines = [f"{names.get(rid, rid)}：{'、'.join(changed.get(rid, []))}" for rid in res["updated"]]
+        lines += [f"{names.get(rid, rid)}：已刪除" for rid in res["deleted"]]
+        if len(lines) > 20:
+            lines = lines[:20] + [f"…等共 {len(lines)} 筆"]
+        st.success(f"✅ 已更新 {len(res['updated'])} 筆、刪除 {len(res['deleted'])} 筆\n\n" + "\n\n".join(lines))
+    if res["conflicts"]:
+        lines = [f"{names.get(rid, rid)}：{why}" for rid, why in res["conflicts"]]
+        st.warning("⚠️ 以下資料在您編輯期間已被其他人變更，未覆蓋，請重新整理後再修改：\n\n" + "\n\n".join(lines))
+    if not (res["updated"] or res["deleted"] or res["conflicts"]):
+        st.info("系統沒有偵測到任何資料變更。")
+
+
 # ==========================================
 # 2. 核心計算邏輯
 # ==========================================
@@ -285,11 +2378,392 @@ def get_grade_for_year(birth_date: date, target_roc_year: int) -> str:
     return "畢業/超齡"
 
 
-def calculate_admission_roadmap(dob: date):
+GRADE_LIST = ["托嬰中心", "幼幼班", "小班", "中班", "大班"]
+_AGE_GRADE = {1: "托嬰中心", 2: "幼幼班", 3: "小班", 4: "中班", 5: "大班", 6: "畢業/超齡"}
+
+
+def current_academic_year() -> int:
     today = date.today()
     cur_roc = today.year - 1911
     if today.month < 8:
         cur_roc -= 1
+    return cur_roc
+
+
+def grades_from_dob(df: pd.DataFrame, target_roc_year: int) -> pd.Series:
+    """
+    get_grade_for_year 的向量化版本（同樣以 9/2 為切點），用 dob_y / dob_m / dob_d 欄位。
+    沒有生日的列回傳 None。
+    """
+    m, d = df["dob_m"], df["dob_d"]
+    offset = ((m > 9) | ((m == 9) & (d >= 2))).astype("Int32")
+    age = target_roc_year - (df["dob_y"] - 1911) - offset
+    grade = age.clip(lower=1, upper=6).map(_AGE_GRADE)
+    return grade.astype(object).where(df["dob_y"].notna(), None)
+
+
+def grades_for_years(df: pd.DataFrame, years) -> pd.DataFrame:
+    """
+    一次算出每位幼兒在各學年的班級（欄位為學年）。
+    規則與名單頁逐列邏輯相同：預計入學資訊含「N 學年 - 班級」時以它為準，否則依生日推算。
+    """
+    plan = df["預計入學資訊"]
+    plan_grade = plan.str.split(" - ").str[1].str.strip()
+    out = {}
+    for y in years:
+        y = int(y)
+        g = plan_grade.where(plan.str.contains(f"{y} 學年", regex=False) & plan_grade.fillna("").ne(""))
+        out[y] = g.astype(object).where(g.notna(), grades_from_dob(df, y))
+    return pd.DataFrame(out, index=df.index)
+
+
+def admission_roadmaps(df: pd.DataFrame) -> dict:
+    """
+    calculate_admission_roadmap 的批次版本：回傳 {紀錄ID: [「N 學年 - 班級」, ...]}，
+    沒有生日的列不列入。
+    """
+    cur = current_academic_year()
+    known = df.loc[df["dob_y"].notna()]
+    cols = {cur + i: grades_from_dob(known, cur + i) for i in range(6)}
+    out = {}
+    for rid, gs in zip(known.index, zip(*[cols[y].tolist() for y in cols])):
+        roadmap = [f"{y} 學年 - {g}" for y, g in zip(cols, gs) if "畢業" not in g]
+        out[rid] = roadmap if roadmap else ["年齡不符"]
+    return out
+
+
+def build_roster(df: pd.DataFrame, target_roc_year: int) -> dict:
+    """
+    指定學年的名單：排除確定不收，只留在園班級（托嬰～大班）。
+    回傳 {"conf": 確認入學, "pend": 其他}，兩者皆附「班級」欄，順序與原資料相同。
+    """
+    grade = grades_for_years(df, [target_roc_year])[int(target_roc_year)]
+    status = df["報名狀態"]
+    keep = ~status.str.contains("確定不收", regex=False) & grade.isin(GRADE_LIST)
+    sel = df.loc[keep, FINAL_COLS].copy()
+    sel["班級"] = grade[keep]
+    is_conf = status[keep].str.contains("確認入學", regex=False)
+    return {"conf": sel.loc[is_conf], "pend": sel.loc[~is_conf]}
+
+
+@st.cache_resource(max_entries=16)
+def _roster_cache(target_roc_year: int, version: int) -> dict:
+    active = _query_frame("active", version)
+    roster = build_roster(active, target_roc_year)
+    roster["n_active"] = len(active)
+    roster["by_grade"] = dict(list(roster["conf"].groupby("班級", sort=False)))
+    roster["counts"] = {g: int(n) for g, n in roster["conf"]["班級"].value_counts().items()}
+    return roster
+
+
+def get_roster(target_roc_year: int) -> dict:
+    """
+    (學年, 資料版本) 的物化名單：conf / pend（附班級）、by_grade、counts、n_active。
+    每個版本只算一次，跨使用者與頁面共用；存檔後資料版本改變即自動失效。
+    回傳的是共用物件，請勿直接修改。
+    """
+    _ensure_local_data()
+    return _roster_cache(int(target_roc_year), get_data_version())
+
+
+# ---------- 多年度招生推估 ----------
+# 師生比：3-6 歲混齡 115 學年起 1:12（之前 1:15）、2-3 歲幼幼 1:8
+RATIO_MIXED_OLD = 15
+RATIO_MIXED_NEW = 12
+RATIO_SWITCH_YEAR = 115
+RATIO_TODDLER = 8
+MIXED_GRADES = ["小班", "中班", "大班"]
+# 推估用的狀態（確定不收不列入）：確認入學全數計入，其餘乘上轉換率
+PROJ_STATUSES = ["確認入學", "排隊等待", "預約參觀"]
+# 情境參數；ratio_mixed = 0 代表依學年套用新舊制
+PROJECTION_DEFAULTS = {"name": "基準", "cap_mixed": 90, "cap_toddler": 16, "conv_wait": 0.5,
+                       "conv_visit": 0.2, "ratio_mixed": 0, "ratio_toddler": RATIO_TODDLER}
+
+
+def mixed_ratio(roc_year: int) -> int:
+    return RATIO_MIXED_NEW if roc_year >= RATIO_SWITCH_YEAR else RATIO_MIXED_OLD
+
+
+def cohort_counts(df: pd.DataFrame, years) -> np.ndarray:
+    """
+    一次算出各學年、各班級、各狀態的人數：回傳陣列 [學年, GRADE_LIST, PROJ_STATUSES]。
+    班級依 grades_for_years（預計入學資訊優先，否則依生日），幼兒逐年往上升班。
+    """
+    years = [int(y) for y in years]
+    out = np.zeros((len(years), len(GRADE_LIST), len(PROJ_STATUSES)), dtype=np.int64)
+    if df.empty:
+        return out
+    grade = grades_for_years(df, years)
+    g_code = np.stack([grade[y].map({g: i for i, g in enumerate(GRADE_LIST)}).fillna(-1).to_numpy(dtype=np.int64)
+                       for y in years])
+    s_code = df["status_group"].map({s: i for i, s in enumerate(PROJ_STATUSES)}).astype(float).fillna(-1)
+    s_code = np.broadcast_to(s_code.to_numpy(dtype=np.int64), g_code.shape)
+    y_code = np.broadcast_to(np.arange(len(years))[:, None], g_code.shape)
+    ok = (g_code >= 0) & (s_code >= 0)
+    np.add.at(out, (y_code[ok], g_code[ok], s_code[ok]), 1)
+    return out
+
+
+def evaluate_scenarios(counts: np.ndarray, years, scenarios: list) -> pd.DataFrame:
+    """
+    多個情境一次以陣列運算求出：各學年預估人數、缺額（名額 - 預估）與所需師資（依名額）。
+    scenarios 為 PROJECTION_DEFAULTS 格式的 dict 清單。
+    """
+    years = np.array([int(y) for y in years])
+    sc = pd.DataFrame([{**PROJECTION_DEFAULTS, **s} for s in scenarios])
+
+    def col(k):
+        return sc[k].to_numpy(dtype=float)[:, None]   # [情境, 1]
+
+    conf, wait, visit = (counts[..., i] for i in range(len(PROJ_STATUSES)))   # [學年, 班級]
+    expected = conf + col("conv_wait")[:, :, None] * wait + col("conv_visit")[:, :, None] * visit
+    mix = [GRADE_LIST.index(g) for g in MIXED_GRADES]
+    tod = GRADE_LIST.index("幼幼班")
+    exp_mixed, exp_toddler = expected[:, :, mix].sum(axis=2), expected[:, :, tod]
+
+    ratio_mixed = np.where(col("ratio_mixed") > 0, col("ratio_mixed"),
+                           np.where(years >= RATIO_SWITCH_YEAR, RATIO_MIXED_NEW, RATIO_MIXED_OLD))
+    ratio_toddler = np.maximum(col("ratio_toddler"), 1)
+    cap_mixed = np.broadcast_to(col("cap_mixed"), exp_mixed.shape)
+    cap_toddler = np.broadcast_to(col("cap_toddler"), exp_toddler.shape)
+    t_mixed = np.ceil(cap_mixed / ratio_mixed)
+    t_toddler = np.ceil(cap_toddler / ratio_toddler)
+
+    n_s, n_y = exp_mixed.shape
+    return pd.DataFrame({
+        "情境": np.repeat(sc["name"].to_numpy(dtype=object), n_y),
+        "學年": np.tile(years, n_s),
+        "確認小中大": np.tile(conf[:, mix].sum(axis=1), n_s),
+        "預估小中大": exp_mixed.ravel().round(1),
+        "小中大缺額": (cap_mixed - exp_mixed).ravel().round(1),
+        "小中大師生比": np.broadcast_to(ratio_mixed, exp_mixed.shape).ravel().astype(int),
+        "小中大師資": t_mixed.ravel().astype(int),
+        "確認幼幼": np.tile(conf[:, tod], n_s),
+        "預估幼幼": exp_toddler.ravel().round(1),
+        "幼幼缺額": (cap_toddler - exp_toddler).ravel().round(1),
+        "幼幼師資": t_toddler.ravel().astype(int),
+        "師資合計": (t_mixed + t_toddler).ravel().astype(int),
+    })
+
+
+@st.cache_data(max_entries=8)
+def _cohort_counts(version: int, start_year: int, horizon: int) -> np.ndarray:
+    return cohort_counts(_query_frame("active", version), range(start_year, start_year + horizon))
+
+
+@st.cache_data(max_entries=64)
+def _projection(version: int, start_year: int, horizon: int, scenarios: tuple) -> pd.DataFrame:
+    counts = _cohort_counts(version, start_year, horizon)
+    return evaluate_scenarios(counts, range(start_year, start_year + horizon), [dict(s) for s in scenarios])
+
+
+def project_enrollment(start_year: int, horizon: int, scenarios: list) -> pd.DataFrame:
+    """
+    多年度推估：每個情境依 (資料版本, 情境) 快取，只改一個情境時其他情境直接取快取；
+    各學年 / 班級 / 狀態人數每個資料版本只統計一次。
+    """
+    _ensure_local_data()
+    version = get_data_version()
+    with perf_span("招生推估"):
+        parts = [_projection(version, int(start_year), int(horizon), (tuple(sorted({**PROJECTION_DEFAULTS, **s}.items())),))
+                 for s in scenarios]
+    return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+
+
+# ---------- 招生統計（增量維護） ----------
+# 統計以「鍵 → 筆數」存在共用資料表旁：共用表補讀變動列時減去舊列、加上新列的貢獻，
+# 不再對整張表 groupby；開啟儀表板只讀這份計數（大小與鍵的種類有關，與資料筆數無關）。
+BACKLOG_BUCKETS = [(7, "7 天內"), (30, "8–30 天"), (90, "31–90 天"), (None, "超過 90 天")]
+STATS_REF_TOP = 10
+_EPOCH = pd.Timestamp("1970-01-01")
+
+
+def _admission_stats_of(df: pd.DataFrame) -> dict:
+    """
+    df（含型別欄位）各統計鍵的筆數，可相加減；df 可以是整張表，也可以只是變動前 / 後的那幾列。
+    回傳 {類別: {鍵: 筆數}}：
+      status / contacted   狀態組（全部 / 已聯繫）
+      month                (民國年, 月) 依登記日期
+      ref / ref_conf       推薦人（全部 / 確認入學）
+      backlog              未聯繫且非確定不收：登記日（1970 起的日序，無日期為 -1）
+      cohort               (conf/pend, 入學年次)：非確定不收、依生日
+      plan                 (conf/pend, 學年, 班級, 入學年次 或 -1)：預計入學資訊指定了學年的列
+    """
+    out = {}
+    if df.empty:
+        return out
+
+    def add(kind: str, keys):
+        # keys 為 Series 或 DataFrame（多欄成為 tuple 鍵）
+        t = out.setdefault(kind, {})
+        for k, n in keys.value_counts().items():
+            k = tuple(x.item() if hasattr(x, "item") else x for x in k) if isinstance(k, tuple) else k
+            t[k] = t.get(k, 0) + int(n)
+
+    group = df["status_group"].astype(str)
+    contacted = df["is_contacted"].to_numpy(dtype=bool)
+    add("status", group)
+    add("contacted", group[contacted])
+
+    reg = df["reg_date"]
+    has_reg = reg.notna()
+    add("month", pd.DataFrame({"y": reg.dt.year[has_reg] - 1911, "m": reg.dt.month[has_reg]}).astype(int))
+
+    raw = df["報名狀態"].astype(str)
+    is_conf = raw.str.contains("確認入學", regex=False)
+    ref = df["推薦人"].astype(str).str.strip()
+    has_ref = ref.ne("")
+    add("ref", ref[has_ref])
+    add("ref_conf", ref[has_ref & is_conf])
+
+    backlog = ~contacted & group.ne("確定不收").to_numpy()
+    day = ((reg - _EPOCH) // pd.Timedelta(days=1)).astype(float).fillna(-1).astype(int)
+    add("backlog", day[backlog])
+
+    # 與 grades_from_dob / grades_for_years 相同的規則：某學年的年齡 = 學年 - 入學年次
+    active = ~raw.str.contains("確定不收", regex=False)
+    kind = pd.Series(np.where(is_conf, "conf", "pend"), index=df.index)
+    m, d = df["dob_m"], df["dob_d"]
+    offset = ((m > 9) | ((m == 9) & (d >= 2))).astype("Int32")
+    cohort = (df["dob_y"] - 1911 + offset).astype(float)
+    has_dob = active & cohort.notna()
+    add("cohort", pd.DataFrame({"k": kind[has_dob], "c": cohort[has_dob].astype(int)}))
+
+    plan = df["預計入學資訊"].astype(str)
+    plan_year = plan.str.extract(r"(\d+) 學年", expand=False)
+    # 沒有任何一列含「 - 」時 str[1] 整欄是 NaN（float），先補空字串再 strip
+    plan_grade = plan.str.split(" - ").str[1].fillna("").astype(str).str.strip()
+    has_plan = active & plan_year.notna() & plan_grade.ne("")
+    add("plan", pd.DataFrame({
+        "k": kind[has_plan], "y": plan_year[has_plan].astype(int), "g": plan_grade[has_plan],
+        "c": cohort[has_plan].fillna(-1).astype(int),
+    }))
+    return {kind: t for kind, t in out.items() if t}
+
+
+def _stats_merge(stats: dict, deltas: list) -> dict:
+    # deltas 為 [(計數, +1 / -1), ...]；回傳新的一份（正在讀舊統計的頁面不受影響）
+    out = {k: dict(t) for k, t in stats.items()}
+    for delta, sign in deltas:
+        for kind, d in delta.items():
+            t = out.setdefault(kind, {})
+            for k, n in d.items():
+                v = t.get(k, 0) + sign * n
+                if v:
+                    t[k] = v
+                else:
+                    t.pop(k, None)
+    return {kind: t for kind, t in out.items() if t}
+
+
+def _stats_apply(stats: dict, batch: dict) -> dict:
+    # 只減去變動列的舊值、加上新值
+    return _stats_merge(stats, [(_admission_stats_of(batch["old"]), -1), (_admission_stats_of(batch["new"]), 1)])
+
+
+subscribe_changes("招生統計", _admission_stats_of, _stats_apply)
+
+
+def admission_stats() -> dict:
+    """
+    目前資料的招生統計計數（格式見 _admission_stats_of）。由變動事件增量增減，
+    只有冷啟動 / 整表重建後第一次開啟才掃描整張表。
+    """
+    return derived_state("招生統計")
+
+
+def stats_funnel(stats: dict) -> pd.DataFrame:
+    # 轉換漏斗：預約參觀 → 排隊等待 → 確認入學 / 確定不收；「累計到達」= 目前在這一階段或之後
+    now = {s: stats.get("status", {}).get(s, 0) for s in NEW_STATUS_OPTIONS}
+    total = sum(now.values())
+    reached = {
+        "預約參觀": total,
+        "排隊等待": now["排隊等待"] + now["確認入學"] + now["確定不收"],
+        "確認入學": now["確認入學"],
+        "確定不收": now["確定不收"],
+    }
+    return pd.DataFrame({
+        "階段": NEW_STATUS_OPTIONS,
+        "目前人數": [now[s] for s in NEW_STATUS_OPTIONS],
+        "已聯繫": [stats.get("contacted", {}).get(s, 0) for s in NEW_STATUS_OPTIONS],
+        "累計到達": [reached[s] for s in NEW_STATUS_OPTIONS],
+        "到達率": [round(reached[s] / total, 3) if total else 0.0 for s in NEW_STATUS_OPTIONS],
+    })
+
+
+def stats_monthly(stats: dict) -> pd.DataFrame:
+    months = sorted(stats.get("month", {}).items())
+    return pd.DataFrame({"月份": [f"{y}/{m:02d}" for (y, m), _ in months], "登記數": [n for _, n in months]})
+
+
+def stats_referrers(stats: dict, top: int = STATS_REF_TOP) -> pd.DataFrame:
+    conf = stats.get("ref_conf", {})
+    rows = sorted(stats.get("ref", {}).items(), key=lambda kv: (-conf.get(kv[0], 0), -kv[1], kv[0]))[:top]
+    return pd.DataFrame({
+        "推薦人": [r for r, _ in rows],
+        "推薦數": [n for _, n in rows],
+        "確認入學": [conf.get(r, 0) for r, _ in rows],
+        "轉換率": [round(conf.get(r, 0) / n, 3) for r, n in rows],
+    })
+
+
+def stats_backlog(stats: dict, today: date = None) -> pd.DataFrame:
+    # 待聯繫等待天數：依登記日分組計數，只走過不同的日期
+    today_n = (pd.Timestamp(today or date.today()) - _EPOCH).days
+    counts = {label: 0 for _, label in BACKLOG_BUCKETS}
+    counts["無登記日期"] = 0
+    for day, n in stats.get("backlog", {}).items():
+        if day < 0:
+            counts["無登記日期"] += n
+            continue
+        age = today_n - day
+        counts[next(label for lim, label in BACKLOG_BUCKETS if lim is None or age <= lim)] += n
+    return pd.DataFrame({"等待時間": list(counts), "筆數": list(counts.values())})
+
+
+def stats_class_counts(stats: dict, year: int) -> dict:
+    """
+    指定學年各班級人數 {(conf/pend, 班級): 人數}，與 build_roster 相同的規則：
+    依生日推算，預計入學資訊指定這一學年時以它為準。
+    """
+    def dob_grade(c: int) -> str:
+        return _AGE_GRADE[min(max(int(year) - c, 1), 6)]
+
+    out = {}
+    for (kind, c), n in stats.get("cohort", {}).items():
+        g = dob_grade(c)
+        out[(kind, g)] = out.get((kind, g), 0) + n
+    for (kind, y, g, c), n in stats.get("plan", {}).items():
+        if y != int(year):
+            continue
+        out[(kind, g)] = out.get((kind, g), 0) + n
+        if c >= 0:
+            out[(kind, dob_grade(c))] -= n
+    return {k: n for k, n in out.items() if k[1] in GRADE_LIST and n}
+
+
+def stats_fill(stats: dict, years, cap_mixed: int, cap_toddler: int) -> pd.DataFrame:
+    # 各學年班級填滿率（確認入學 / 名額），另列含候補的人數
+    rows = []
+    for y in years:
+        cc = stats_class_counts(stats, y)
+        conf = {g: cc.get(("conf", g), 0) for g in GRADE_LIST}
+        pend = {g: cc.get(("pend", g), 0) for g in GRADE_LIST}
+        c_mix = sum(conf[g] for g in MIXED_GRADES)
+        rows.append({
+            "學年": int(y), **{g: conf[g] for g in MIXED_GRADES},
+            "小中大確認": c_mix,
+            "小中大填滿率": round(c_mix / cap_mixed, 3) if cap_mixed else 0.0,
+            "小中大含候補": c_mix + sum(pend[g] for g in MIXED_GRADES),
+            "幼幼確認": conf["幼幼班"],
+            "幼幼填滿率": round(conf["幼幼班"] / cap_toddler, 3) if cap_toddler else 0.0,
+            "幼幼含候補": conf["幼幼班"] + pend["幼幼班"],
+        })
+    return pd.DataFrame(rows)
+
+
+def calculate_admission_roadmap(dob: date):
+    cur_roc = current_academic_year()
 
     roadmap = []
     for i in range(6):
@@ -300,6 +2774,506 @@ def calculate_admission_roadmap(dob: date):
     return roadmap if roadmap else ["年齡不符"]
 
 
+# ---------- 搜尋索引 ----------
+# 搜尋欄位依排名先後：越前面的欄位命中，結果排越前面
+SEARCH_FIELDS = ["幼兒姓名", "電話", "家長稱呼", "推薦人", "報名狀態", "聯繫狀態",
+                 "重要性", "備註", "幼兒生日", "登記日期", "預計入學資訊"]
+# 自由文字欄位建 n-gram；其餘欄位值種類少，直接對「不重複值」比對再展開成列位置
+GRAM_FIELDS = ["幼兒姓名", "電話", "家長稱呼", "備註"]
+
+
+def _group_positions(values) -> dict:
+    # 值 → 出現的列位置（遞增）
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+    return {u: order[bounds[i]:bounds[i + 1]] for i, u in enumerate(uniques)}
+
+
+def _gram_codes(chars: np.ndarray, rows: np.ndarray):
+    # 單字 = 字碼；雙字 = (前字+1) << 21 | 後字（Unicode 字碼 < 2^21，不會和單字撞號）
+    pair = rows[1:] == rows[:-1]
+    bi = ((chars[:-1] + 1) << 21 | chars[1:])[pair]
+    return np.concatenate([chars, bi]), np.concatenate([rows, rows[1:][pair]])
+
+
+def _query_grams(q: str) -> list:
+    chars = np.frombuffer(q.encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+    if len(chars) == 1:
+        return chars.tolist()
+    return _gram_codes(chars, np.zeros(len(chars), dtype=np.int64))[0][len(chars):].tolist()
+
+
+def build_search_index(df: pd.DataFrame) -> dict:
+    """
+    每個資料版本建一次：
+      grams : 姓名 / 電話 / 備註的單字與雙字 n-gram → 列位置
+      values: 狀態、推薦人、日期等欄位的完全相符 postings（值 → 列位置）
+      phones: 電話數字鍵排序後的前綴 / 後綴查找表
+    """
+    fields = {f: df[f].str.lower().to_numpy(dtype=object) for f in SEARCH_FIELDS}
+    n = len(df)
+    codes, rows = [], []
+    for f in GRAM_FIELDS:
+        # 整欄串成一個字串轉成字碼陣列，向量化產生 n-gram，不逐列切字
+        vals = fields[f].tolist()
+        chars = np.frombuffer("".join(vals).encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+        c, r = _gram_codes(chars, np.repeat(np.arange(n), [len(v) for v in vals]))
+        codes.append(c)
+        rows.append(r)
+    key = np.sort(np.concatenate(codes) * max(n, 1) + np.concatenate(rows))
+    key = key[np.r_[True, key[1:] != key[:-1]]] if len(key) else key
+    gram, pos = np.divmod(key, max(n, 1))
+    cut = np.flatnonzero(np.diff(gram)) + 1
+    grams_idx = dict(zip(gram[np.r_[0, cut]].tolist(), np.split(pos, cut))) if len(key) else {}
+
+    values = {f: _group_positions(fields[f]) for f in SEARCH_FIELDS if f not in GRAM_FIELDS}
+
+    keys = df["phone_key"].to_numpy(dtype=object)
+    fwd = sorted(zip(keys, range(len(keys))))
+    rev = sorted(zip((k[::-1] for k in keys), range(len(keys))))
+
+    return {
+        "ids": df.index.to_numpy(dtype=object),
+        "fields": fields,
+        "grams": grams_idx,
+        "values": values,
+        "phone_fwd": ([k for k, _ in fwd], np.array([i for _, i in fwd], dtype=np.int64)),
+        "phone_rev": ([k for k, _ in rev], np.array([i for _, i in rev], dtype=np.int64)),
+    }
+
+
+def _phone_range(table: tuple, q: str) -> np.ndarray:
+    keys, pos = table
+    lo = bisect.bisect_left(keys, q)
+    hi = bisect.bisect_left(keys, q + "\uffff")
+    return pos[lo:hi]
+
+
+def search_index(idx: dict, kw: str, within=None, with_rank: bool = False):
+    """
+    回傳命中的列位置（依命中欄位排名），結果與逐欄位子字串比對相同，
+    另外電話可用純數字前綴 / 後綴查（不受分隔符號影響）。
+    within 為上一次結果的列位置：查詢字串是上次的延伸時只需在上次結果內篩選。
+    with_rank=True 時回傳 (列位置, 各列排名)。
+    """
+    q = _safe_str(kw).lower()
+    n = len(idx["ids"])
+    if not q:
+        return (np.arange(n), np.zeros(n, dtype=np.int64)) if with_rank else np.arange(n)
+
+    if within is not None:
+        cand = np.asarray(within, dtype=np.int64)
+    else:
+        grams = set(_query_grams(q))
+        cand = None
+        for g in sorted(grams, key=lambda g: len(idx["grams"].get(g, ()))):
+            p = idx["grams"].get(g)
+            if p is None:
+                cand = np.empty(0, dtype=np.int64)
+                break
+            cand = p if cand is None else np.intersect1d(cand, p, assume_unique=True)
+            if not len(cand):
+                break
+
+    rank = np.full(n, len(SEARCH_FIELDS) * 2, dtype=np.int64)
+    if cand is not None and len(cand):
+        for f in GRAM_FIELDS:
+            r = SEARCH_FIELDS.index(f)
+            vals = pd.Series(idx["fields"][f][cand])
+            hit = vals.str.contains(q, regex=False).to_numpy()
+            full = vals.eq(q).to_numpy()
+            score = np.where(full, r * 2, np.where(hit, r * 2 + 1, rank[cand]))
+            rank[cand] = np.minimum(rank[cand], score)
+
+    # 其餘欄位：只比對不重複值（完全相符排在部分相符前面）
+    for f, postings in idx["values"].items():
+        r = SEARCH_FIELDS.index(f)
+        for v, p in postings.items():
+            if q in v:
+                rank[p] = np.minimum(rank[p], r * 2 + (v != q))
+
+    # 電話數字前綴 / 後綴
+    digits = re.sub(r"\D", "", q)
+    if len(digits) >= 3 and not re.sub(r"[\d\s\-()+]", "", q):
+        tel = SEARCH_FIELDS.index("電話") * 2
+        # 電話查找表一律全表查（bisect 很便宜），不受 within 限制
+        hits = np.concatenate([_phone_range(idx["phone_fwd"], digits), _phone_range(idx["phone_rev"], digits[::-1])])
+        rank[hits] = np.minimum(rank[hits], tel)
+
+    matched = np.flatnonzero(rank < len(SEARCH_FIELDS) * 2)
+    matched = matched[np.argsort(rank[matched], kind="stable")]
+    return (matched, rank[matched]) if with_rank else matched
+
+
+# 搜尋索引隨變動事件增量維護：整表索引（base）建好之後動過的列在 base 中標為失效，
+# 最新內容另外放在 extra 逐列比對；extra 太多時丟掉，下次搜尋整表重建。
+SEARCH_EXTRA_MAX = 2000
+
+
+def _search_init(frame: pd.DataFrame) -> dict:
+    idx = build_search_index(frame)
+    return {"base": idx, "gen": uuid.uuid4().hex, "where": pd.Index(idx["ids"]),
+            "dead": np.zeros(len(frame), dtype=bool), "extra": {}, "next": len(frame)}
+
+
+def _search_apply(state: dict, batch: dict):
+    old, new = batch["old"], batch["new"]
+    if len(state["extra"]) + len(new) > SEARCH_EXTRA_MAX:
+        return None
+    dead = state["dead"].copy()
+    at = state["where"].get_indexer(old.index)
+    dead[at[at >= 0]] = True
+    extra = dict(state["extra"])
+    for rid in old.index.difference(new.index):
+        extra.pop(rid, None)
+    # 排序鍵 = 在共用表中的先後：原地修改的列沿用原位置，新增的列接在最後
+    existed = set(old.index)
+    nxt = state["next"]
+    lower = {f: new[f].str.lower().tolist() for f in SEARCH_FIELDS}
+    phones = new["phone_key"].tolist()
+    for i, rid in enumerate(new.index):
+        if rid in existed:
+            key = extra[rid]["key"] if rid in extra else state["where"].get_loc(rid)
+        else:
+            key, nxt = nxt, nxt + 1
+        extra[rid] = {"key": key, "fields": {f: lower[f][i] for f in SEARCH_FIELDS}, "phone": phones[i]}
+    return {**state, "dead": dead, "extra": extra, "next": nxt}
+
+
+def _row_search_rank(ent: dict, q: str) -> int:
+    # 與 search_index 相同的排名規則，逐列比對（只用於 extra 的少數列）
+    if not q:
+        return 0
+    best = len(SEARCH_FIELDS) * 2
+    for r, f in enumerate(SEARCH_FIELDS):
+        v = ent["fields"][f]
+        if q in v:
+            best = min(best, r * 2 + (v != q))
+    digits = re.sub(r"\D", "", q)
+    if len(digits) >= 3 and not re.sub(r"[\d\s\-()+]", "", q):
+        if ent["phone"].startswith(digits) or ent["phone"].endswith(digits):
+            best = min(best, SEARCH_FIELDS.index("電話") * 2)
+    return best
+
+
+def _search_merge(state: dict, q: str, pos: np.ndarray, rank: np.ndarray) -> list:
+    # base 的命中扣掉已失效的列，再與 extra 的命中合併，依 (排名, 共用表先後) 排序
+    ids = state["base"]["ids"]
+    keep = ~state["dead"][pos]
+    pos, rank = pos[keep], rank[keep]
+    hits = [(r, e["key"], rid) for rid, e in state["extra"].items()
+            for r in (_row_search_rank(e, q),) if r < len(SEARCH_FIELDS) * 2]
+    if not hits:
+        return ids[pos].tolist()
+    all_ids = np.concatenate([ids[pos], np.array([rid for _, _, rid in hits], dtype=object)])
+    all_rank = np.concatenate([rank, [r for r, _, _ in hits]])
+    all_key = np.concatenate([pos, [k for _, k, _ in hits]])
+    return all_ids[np.lexsort((all_key, all_rank))].tolist()
+
+
+def _search_probe(state: dict, frame: pd.DataFrame) -> dict:
+    # 一致性檢查用的查詢：固定字詞 + 從資料中平均取幾筆的姓名 / 電話末四碼 / 備註
+    qs = ["", "確認", "已聯繫", "09"]
+    for _, r in frame.iloc[::max(1, len(frame) // 10)].head(10).iterrows():
+        qs += [r["幼兒姓名"][:1], r["幼兒姓名"], r["phone_key"][-4:], r["備註"][:2]]
+    qs = [q.lower() for q in dict.fromkeys(qs)]
+    return {q: _search_merge(state, q, *search_index(state["base"], q, with_rank=True)) for q in qs}
+
+
+subscribe_changes("搜尋索引", _search_init, _search_apply, _search_probe)
+
+
+def search_registrations(kw: str) -> list:
+    """
+    搜尋框用：回傳依命中欄位排序的紀錄ID。存檔後不重建索引（見 _search_apply）。
+    若這次的關鍵字包含上次的關鍵字（多打一個字），整表索引只在上次結果中篩選。
+    """
+    state = derived_state("搜尋索引")
+    q = _safe_str(kw).lower()
+    prev = st.session_state.get("_search_prev")
+    within = None
+    if prev and prev["gen"] == state["gen"] and prev["q"] and prev["q"] in q:
+        within = prev["pos"]
+    pos, rank = search_index(state["base"], q, within=within, with_rank=True)
+    st.session_state["_search_prev"] = {"gen": state["gen"], "q": q, "pos": pos}
+    return _search_merge(state, q, pos, rank)
+
+
+# ---------- 家庭索引與重複報名 ----------
+# 姓名相似度達此值才可能是同一位幼兒。同電話的兄弟姊妹 / 雙胞胎常只差一個字（三字姓名約 0.67），
+# 和打錯一個字分不出來，寧可漏報也不能把兩個孩子合併刪掉；同電話而生日都有填且不同，一律不算
+DUP_NAME_RATIO_OTHER = 0.8
+# 區塊超過此筆數（例如共用的代表號）不做兩兩比對
+DUP_BLOCK_MAX = 50
+# 姓名只取前幾個字建區塊鍵
+DUP_NAME_CHARS = 8
+# 合併時保留哪一筆：狀態越前面越優先，同狀態保留登記日期較新的
+DUP_KEEP_ORDER = ["確認入學", "排隊等待", "預約參觀", "確定不收"]
+DUP_SHOW_COLS = ["幼兒姓名", "幼兒生日", "家長稱呼", "電話", "報名狀態", "登記日期", "備註"]
+
+
+def _name_key(s) -> str:
+    s = re.sub(r"\s+", "", _safe_str(s)).lower()
+    return "" if s == "(未填)" else s
+
+
+def _name_ratio(a: str, b: str) -> float:
+    if not a or not b:
+        return 0.0
+    return 1.0 if a == b else SequenceMatcher(None, a, b, autojunk=False).ratio()
+
+
+def _dup_reason(same_phone: bool, dob_a: int, dob_b: int, ratio: float) -> str:
+    # dob_a / dob_b 為 _day_number 的日數，-1 = 未填
+    known = dob_a >= 0 and dob_b >= 0
+    if ratio < DUP_NAME_RATIO_OTHER or (known and dob_a != dob_b):
+        return ""
+    if same_phone:
+        return "同電話、同生日、姓名相近" if known else "同電話、姓名相近（生日未填）"
+    if known:
+        return "同生日、姓名相近（電話不同）"
+    return ""
+
+
+def _day_number(d) -> int:
+    # 生日 → 自 1900/1/1 起的日數（16 位元內），無效為 -1
+    return (d - date(1900, 1, 1)).days if d and d.year >= 1900 else -1
+
+
+def _pair_keys(day, first, second):
+    # 區塊鍵 = 日數 << 42 | 前字 << 21 | 後字（字碼 < 2^21）
+    return day << 42 | first << 21 | second
+
+
+def build_household_index(df: pd.DataFrame) -> dict:
+    """
+    每個資料版本建一次：
+      phone   : 電話數字鍵 → 列位置（同一家庭）
+      dob_pair: 生日 + 姓名中依序的兩個字 → 列位置
+    電話不同時要姓名相似度 ≥ DUP_NAME_RATIO_OTHER 才算重複，這樣的兩個名字一定有兩個字依序相同，
+    所以只需在區塊內比對，不必整表兩兩比較。
+    """
+    names = [_name_key(v) for v in df["幼兒姓名"].tolist()]
+    day = ((df["dob"] - pd.Timestamp(1900, 1, 1)).dt.days).fillna(-1).to_numpy(dtype=np.int64)
+    day = np.where(day < 0, -1, day)
+
+    phones = df["phone_key"].to_numpy(dtype=object)
+    phone_idx = {k: p for k, p in _group_positions(phones).items() if k}
+
+    # 和搜尋索引一樣整欄一次轉成字碼陣列，再依字的位置組合 (i, j) 向量化產生鍵
+    lens = np.array([min(len(v), DUP_NAME_CHARS) for v in names], dtype=np.int64)
+    start = np.r_[0, np.cumsum([len(v) for v in names])[:-1]].astype(np.int64) if names else lens
+    chars = np.frombuffer("".join(names).encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+    keys, rows = [], []
+    one = np.flatnonzero((lens == 1) & (day >= 0))
+    keys.append(_pair_keys(day[one], chars[start[one]], chars[start[one]]))
+    rows.append(one)
+    for i in range(DUP_NAME_CHARS):
+        for j in range(i + 1, DUP_NAME_CHARS):
+            r = np.flatnonzero((lens > j) & (day >= 0))
+            if not len(r):
+                break
+            keys.append(_pair_keys(day[r], chars[start[r] + i], chars[start[r] + j]))
+            rows.append(r)
+    key, rows = np.concatenate(keys), np.concatenate(rows)
+    order = np.lexsort((rows, key))
+    key, rows = key[order], rows[order]
+    first = np.r_[True, (key[1:] != key[:-1]) | (rows[1:] != rows[:-1])] if len(key) else np.empty(0, dtype=bool)
+    key, rows = key[first], rows[first]
+    dob_pair = {k: rows[p] for k, p in _group_positions(key).items()}
+
+    return {"ids": df.index.to_numpy(dtype=object), "names": names, "dob": day,
+            "phones": phones, "phone": phone_idx, "dob_pair": dob_pair}
+
+
+def match_household(idx: dict, phone: str, name: str, dob: date = None) -> list:
+    """
+    新報名比對既有資料：回傳 [(列位置, 原因)]，同電話的其他幼兒（兄弟姊妹）不算重複。
+    """
+    pk = re.sub(r"\D", "", normalize_phone(phone))
+    nk = _name_key(name)
+    dk = _day_number(dob)
+
+    none = np.empty(0, dtype=np.int64)
+    cand = [idx["phone"].get(pk, none)] if pk else []
+    if dk >= 0:
+        c = [ord(ch) for ch in nk[:DUP_NAME_CHARS]]
+        pairs = [(c[0], c[0])] if len(c) == 1 else [(c[i], c[j]) for i in range(len(c)) for j in range(i + 1, len(c))]
+        cand += [idx["dob_pair"].get(_pair_keys(dk, a, b), none) for a, b in set(pairs)]
+    out = []
+    for i in sorted(set(np.concatenate(cand).tolist()) if cand else ()):
+        reason = _dup_reason(bool(pk) and idx["phones"][i] == pk, dk, int(idx["dob"][i]),
+                             _name_ratio(nk, idx["names"][i]))
+        if reason:
+            out.append((i, reason))
+    return out
+
+
+def _block_pairs(postings) -> np.ndarray:
+    # 區塊內兩兩組合（i < j），同樣大小的區塊一起展開；過大的區塊略過
+    by_size = {}
+    for p in postings:
+        if 2 <= len(p) <= DUP_BLOCK_MAX:
+            by_size.setdefault(len(p), []).append(p)
+    out = [np.empty((0, 2), dtype=np.int64)]
+    for size, blocks in by_size.items():
+        a, b = np.triu_indices(size, 1)
+        m = np.stack(blocks)
+        out.append(np.stack([m[:, a].ravel(), m[:, b].ravel()], axis=1))
+    return np.unique(np.sort(np.concatenate(out), axis=1), axis=0)
+
+
+def find_duplicate_groups(df: pd.DataFrame, idx: dict) -> pd.DataFrame:
+    """
+    整表重複檢查：區塊內成對比對後用 union-find 串成群組，每組建議保留一筆。
+    回傳每筆紀錄一列：群組、建議（保留 / 併入）、原因與顯示欄位。
+    """
+    pairs = _block_pairs(list(idx["phone"].values()) + list(idx["dob_pair"].values()))
+    parent = {}
+
+    def find(x):
+        while parent.get(x, x) != x:
+            parent[x] = parent.get(parent[x], parent[x])
+            x = parent[x]
+        return x
+
+    reasons = {}
+    for i, j in pairs.tolist():
+        reason = _dup_reason(idx["phones"][i] != "" and idx["phones"][i] == idx["phones"][j],
+                             int(idx["dob"][i]), int(idx["dob"][j]),
+                             _name_ratio(idx["names"][i], idx["names"][j]))
+        if not reason:
+            continue
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+        reasons.setdefault(i, set()).add(reason)
+        reasons.setdefault(j, set()).add(reason)
+
+    cols = ["群組", "建議", "原因", ID_COL, VER_COL] + DUP_SHOW_COLS
+    if not reasons:
+        return pd.DataFrame(columns=cols)
+
+    pos = np.array(sorted(reasons), dtype=np.int64)
+    out = df.iloc[pos][[VER_COL] + DUP_SHOW_COLS].copy()
+    out[ID_COL] = out.index
+    out["原因"] = ["、".join(sorted(reasons[i])) for i in pos.tolist()]
+    root = np.array([find(i) for i in pos.tolist()])
+    out["群組"] = pd.factorize(root)[0] + 1
+
+    # 保留：狀態優先序 → 登記日期新 → 版本高
+    rank = df["報名狀態"].iloc[pos].map({s: i for i, s in enumerate(DUP_KEEP_ORDER)}).fillna(len(DUP_KEEP_ORDER))
+    out["_rank"] = rank.to_numpy()
+    out["_reg"] = df["reg_date"].iloc[pos].to_numpy()
+    out["_ver"] = df[VER_COL].iloc[pos].map(_as_version).to_numpy()
+    out = out.sort_values(["群組", "_rank", "_reg", "_ver"], ascending=[True, True, False, False], na_position="last")
+    out["建議"] = np.where(out["群組"].duplicated(), "併入", "保留")
+    return out[cols].reset_index(drop=True)
+
+
+def merge_duplicate_patches(groups: pd.DataFrame) -> list:
+    """
+    把重複群組合併成修改清單：保留的那筆補上空白欄位、備註合併，其餘刪除。
+    """
+    patches = []
+    for _, g in groups.groupby("群組", sort=False):
+        keep, rest = g.iloc[0], g.iloc[1:]
+        changes = {}
+        for c in DUP_SHOW_COLS:
+            if c == "備註":
+                notes = [n for n in dict.fromkeys(_safe_str(v) for v in g["備註"]) if n]
+                merged = "；".join(notes)
+                if merged != _safe_str(keep["備註"]):
+                    changes["備註"] = merged
+            elif not _safe_str(keep[c]):
+                fill = next((_safe_str(v) for v in rest[c] if _safe_str(v)), "")
+                if fill:
+                    changes[c] = fill
+        if changes:
+            patches.append({"id": keep[ID_COL], "base": keep[VER_COL], "set": changes})
+        patches += [{"id": r[ID_COL], "base": r[VER_COL], "delete": True} for _, r in rest.iterrows()]
+    return patches
+
+
+HOUSEHOLD_FIELDS = ("幼兒姓名", "電話", "幼兒生日")
+
+
+def _merge_postings(a: dict, b: dict, offset: int) -> dict:
+    out = dict(a)
+    for k, p in b.items():
+        out[k] = np.concatenate([a[k], p + offset]) if k in a else p + offset
+    return out
+
+
+def _household_apply(state: dict, batch: dict):
+    # 索引的值是列位置：只改了其他欄位（狀態、備註…）原樣沿用；只有新增（接在共用表最後）就把新列建索引併進來；
+    # 有刪除（後面的列位置會移動）或改了姓名 / 電話 / 生日就丟掉，下次用到再整表重建
+    old, new, frame, ev = batch["old"], batch["new"], batch["frame"], batch["events"]
+    if not old.index.isin(new.index).all():
+        return None
+    if ((ev["op"] == "update") & ev["欄位"].isin(HOUSEHOLD_FIELDS)).any():
+        return None
+    offset = len(state["ids"])
+    if offset == len(frame):
+        return state
+    add = build_household_index(frame.iloc[offset:])
+    return {
+        "ids": np.concatenate([state["ids"], add["ids"]]),
+        "names": state["names"] + add["names"],
+        "dob": np.concatenate([state["dob"], add["dob"]]),
+        "phones": np.concatenate([state["phones"], add["phones"]]),
+        "phone": _merge_postings(state["phone"], add["phone"], offset),
+        "dob_pair": _merge_postings(state["dob_pair"], add["dob_pair"], offset),
+    }
+
+
+def _household_probe(state: dict, frame: pd.DataFrame) -> dict:
+    return {
+        "ids": state["ids"].tolist(), "names": state["names"], "dob": state["dob"].tolist(),
+        "phones": state["phones"].tolist(),
+        "phone": {k: p.tolist() for k, p in state["phone"].items()},
+        "dob_pair": {int(k): p.tolist() for k, p in state["dob_pair"].items()},
+    }
+
+
+subscribe_changes("家庭索引", build_household_index, _household_apply, _household_probe)
+
+
+@st.cache_data(max_entries=2)
+def _duplicate_groups(version: int) -> pd.DataFrame:
+    return find_duplicate_groups(*_derived("家庭索引"))
+
+
+def find_possible_duplicates(phone: str, name: str, dob: date = None) -> pd.DataFrame:
+    """
+    報名時用：回傳可能重複的既有紀錄（含「原因」欄）。
+    """
+    df, idx = _derived("家庭索引")
+    with perf_span("重複比對"):
+        hits = match_household(idx, phone, name, dob)
+    out = df.iloc[[i for i, _ in hits]][DUP_SHOW_COLS].copy()
+    out["原因"] = [r for _, r in hits]
+    return out
+
+
+def household_records(phone: str) -> pd.DataFrame:
+    """
+    同一電話（家庭）已有的報名紀錄。
+    """
+    pk = re.sub(r"\D", "", normalize_phone(phone))
+    if not pk:
+        return pd.DataFrame(columns=DUP_SHOW_COLS)
+    df, idx = _derived("家庭索引")
+    return df.iloc[idx["phone"].get(pk, np.empty(0, dtype=np.int64))][DUP_SHOW_COLS]
+
+
+def duplicate_groups() -> pd.DataFrame:
+    _ensure_local_data()
+    with perf_span("重複檢查"):
+        return _duplicate_groups(get_data_version())
+
+
 # ==========================================
 # 3. 暫存與提交邏輯
 # ==========================================
@@ -338,7 +3312,6 @@ def submit_all_cb():
         st.session_state["msg_error"] = "❌ 家長與電話必填"
         return
 
-    cur_df = load_registered_data()
     rows = []
 
     p_title = _safe_str(st.session_state.get("input_p_title"))
@@ -357,11 +3330,13 @@ def submit_all_cb():
             "推薦人": referrer,
             "備註": _safe_str(c.get("備註")),
             "重要性": _safe_str(c.get("重要性")) or "中",
+            ID_COL: new_record_id(),
+            VER_COL: "1",
         })
 
-    new_df = pd.concat([cur_df, pd.DataFrame(rows)], ignore_index=True)
-
-    if sync_data_to_gsheets(new_df):
+    with perf_span("儲存"):
+        ok = insert_records(rows)
+    if ok:
         st.session_state["msg_ok"] = f"✅ 成功新增 {len(rows)} 筆資料"
         st.session_state.temp_children = []
         st.session_state.input_p_name = ""
@@ -370,9 +3345,156 @@ def submit_all_cb():
         st.session_state["msg_error"] = "儲存失敗，請檢查網路或權限。"
 
 
+# ---------- 資料管理中心：逐欄位變更追蹤 ----------
+# 卡片元件 key 前綴 → 欄位
+CARD_FIELDS = {
+    "name": "幼兒姓名", "dob": "幼兒生日", "pname": "家長稱呼", "phone": "電話",
+    "c": "聯繫狀態", "s": "報名狀態", "p": "預計入學資訊", "imp": "重要性", "n": "備註",
+}
+
+
+def card_value(field: str, v) -> str:
+    # 元件值 → 存檔文字
+    if field == "聯繫狀態":
+        return "已聯繫" if bool(v) else "未聯繫"
+    if field == "電話":
+        return normalize_phone(v)
+    if field == "重要性":
+        v = _safe_str(v)
+        return v if v in PRIO_OPTIONS else "中"
+    return _safe_str(v)
+
+
+def mark_dirty_cb(rid: str, field: str, key: str, base: str, orig: str, name: str):
+    """
+    卡片元件的 on_change：只記下被改的 (紀錄, 欄位)，改回原值就移除。
+    mgmt_dirty = {紀錄ID: {"base": 版本, "name": 幼兒姓名, "set": {欄位: 新值}, "delete": bool}}
+    """
+    dirty = st.session_state.setdefault("mgmt_dirty", {})
+    ent = dirty.setdefault(rid, {"base": base, "name": name, "set": {}, "delete": False})
+    if field == "刪除":
+        ent["delete"] = bool(st.session_state.get(key))
+    else:
+        v = card_value(field, st.session_state.get(key))
+        if v == orig:
+            ent["set"].pop(field, None)
+        else:
+            ent["set"][field] = v
+    if not ent["set"] and not ent["delete"]:
+        dirty.pop(rid, None)
+
+
+def _clear_card_widgets(rids, keep=()):
+    # 刪掉這些紀錄的卡片元件狀態，下次渲染時回到資料庫的值（rids 為 None = 全部，keep 內的除外）
+    rids = None if rids is None else set(rids)
+    keep = set(keep)
+    pfx = tuple(f"{w}_" for w in list(CARD_FIELDS) + ["del"])
+    for k in [k for k in st.session_state if isinstance(k, str) and k.startswith(pfx)]:
+        rid = k.rsplit("_", 1)[-1]
+        if (rids is None or rid in rids) and rid not in keep:
+            del st.session_state[k]
+
+
+def refresh_changed_records():
+    """
+    每次執行時比對本 session 上次看到的資料版本：其他人（或背景同步）動過的紀錄，
+    清掉其卡片元件狀態改顯示最新值，其餘卡片不動；尚未儲存的編輯保留，標記為 stale 提醒。
+    """
+    ver = get_data_version()
+    seen = st.session_state.get("seen_version")
+    st.session_state["seen_version"] = ver
+    if seen is None or seen == ver:
+        return
+    ids = changed_ids_since(seen)
+    dirty = st.session_state.get("mgmt_dirty") or {}
+    _clear_card_widgets(ids, keep=dirty)
+    for rid, ent in dirty.items():
+        if ids is None or rid in ids:
+            ent["stale"] = True
+    if ids is not None:
+        perf_count("他處變動紀錄", len(ids))
+
+
+def save_dirty_cb():
+    # 只把有記錄的變更組成修改，成本跟編輯數有關、跟資料量無關
+    dirty = st.session_state.get("mgmt_dirty") or {}
+    if not dirty:
+        st.session_state["mgmt_save_result"] = {"ok": True, "updated": [], "deleted": [], "conflicts": []}
+        return
+    patches = []
+    for rid, ent in dirty.items():
+        if ent["delete"]:
+            patches.append({"id": rid, "base": ent["base"], "delete": True})
+        else:
+            patches.append({"id": rid, "base": ent["base"], "set": dict(ent["set"])})
+
+    with perf_span("儲存"):
+        res = apply_record_patches(patches)
+    perf_count("儲存欄位數", sum(len(p.get("set", {})) or 1 for p in patches))
+    res["names"] = {rid: ent["name"] for rid, ent in dirty.items()}
+    st.session_state["mgmt_save_result"] = res
+    if res["ok"]:
+        # 已存 / 衝突 / 無實際變更的都清掉，卡片改顯示最新資料
+        _clear_card_widgets(dirty)
+        dirty.clear()
+
+
+def discard_dirty_cb():
+    dirty = st.session_state.get("mgmt_dirty") or {}
+    _clear_card_widgets(dirty)
+    dirty.clear()
+
+
+def resolve_conflict_cb(rid: str, keep_local: bool):
+    st.session_state["msg_ok"] = resolve_cloud_conflict(rid, keep_local)
+
+
+def archive_now_cb():
+    try:
+        n = archive_records()
+        st.session_state["msg_ok"] = f"🗄️ 已封存 {n} 筆（確定不收逾 {ARCHIVE_REJECT_GRACE_DAYS} 天、已畢業 / 超齡）"
+    except Exception as e:
+        st.session_state["msg_error"] = f"封存失敗：{e}"
+
+
+@st.cache_resource
+def start_prefetch() -> dict:
+    """
+    登入畫面顯示時就在背景暖機：載入 gspread、建立雲端連線、（首次）下載資料、讀入資料表。
+    每個程序只跑一次，登入後的第一個畫面直接用快取。
+    """
+    state = {"done": threading.Event()}
+
+    def run():
+        t0 = time.perf_counter()
+        try:
+            load_registered_data()
+        except Exception:
+            pass
+        finally:
+            _mark_startup("背景預取", time.perf_counter() - t0)
+            perf_flush_background("prefetch")
+            state["done"].set()
+
+    t = threading.Thread(target=run, name="prefetch", daemon=True)
+    state["thread"] = t
+    t.start()
+    return state
+
+
 # ==========================================
 # 4. 主程式與選單
 # ==========================================
+# 登入表單擋住之前先開始預取，輸入密碼的時間拿來連雲端 / 讀資料
+start_prefetch()
+if not check_password():
+    st.stop()
+perf_begin_run()
+if not _cloud_enabled():
+    # 有雲端時定期封存交給同步執行緒；只用本機庫時登入後檢查一次（未到期只讀一個設定值）
+    maybe_archive()
+refresh_changed_records()
+
 st.title("🏫 幼兒園新生管理系統")
 
 # 顯示訊息（不使用 toast / spinner）
@@ -384,13 +3506,90 @@ if st.session_state.get("msg_ok"):
     st.success(st.session_state["msg_ok"])
     st.session_state["msg_ok"] = None
 
-df = load_registered_data()
-
 menu = st.sidebar.radio(
     "功能導航",
-    ["👶 新增報名", "📂 資料管理中心", "🎓 學年快速查詢", "📅 未來入學預覽", "👩‍🏫 招生缺額與師資試算"],
+    ["👶 新增報名", "📥 批次匯入", "📂 資料管理中心", "🧩 重複報名檢查", "🎓 學年快速查詢", "📅 未來入學預覽", "👩‍🏫 招生缺額與師資試算",
+     "📊 招生分析"],
 )
 
+if _cloud_enabled():
+    _sync = get_sync_status()
+    _worker = get_sync_worker()
+    _sync_last = _gsheet_sync_state()["last"]
+    with st.sidebar.expander(f"☁️ 雲端同步（待送 {_sync['pending']} 筆）", expanded=bool(_sync["failed"])):
+        ok_at = _worker["last_success"]
+        st.caption(f"上次成功：{ok_at:%H:%M:%S}" if ok_at else "上次成功：尚無")
+        if _sync_last:
+            _sync_total = _gsheet_sync_state()["total"]
+            st.caption(
+                f"上次送出：{_sync_last['cells']} 格 / {_sync_last['requests']} 次請求"
+                f"（新增 {_sync_last['appended']} 列、刪除 {_sync_last['deleted']} 列）\n\n"
+                f"累計 {_sync_total['saves']} 批：{_sync_total['cells']} 格 / {_sync_total['requests']} 次請求"
+            )
+        if _worker["last_error"] and _sync["pending"]:
+            st.caption(f"重試中：{_worker['last_error']}")
+        if _sync["failed"]:
+            st.error(f"{_sync['failed']} 筆同步失敗：{_sync['failed_error']}")
+            st.button("🔁 重新送出失敗項目", on_click=retry_failed_sync)
+        if _sync["conflicts"]:
+            st.warning(f"{_sync['conflicts']} 筆因雲端已被他人修改而未寫入，本機版本已另外保留，請逐筆決定：")
+            for _c in list_cloud_conflicts().itertuples(index=False):
+                st.caption(f"{_c.幼兒姓名}：{_c.原因}（{_c.時間}）")
+                _k1, _k2 = st.columns(2)
+                _k1.button("保留我的版本", key=f"cf_keep_{_c[0]}", on_click=resolve_conflict_cb, args=(_c[0], True))
+                _k2.button("採用雲端版本", key=f"cf_drop_{_c[0]}", on_click=resolve_conflict_cb, args=(_c[0], False))
+
+        # 雲端閘道統計：每種請求的次數 / 錯誤 / 重試 / 延遲，以及配額節流等待
+        _gw = sheets_metrics()
+        if _gw["ops"]:
+            st.dataframe(
+                pd.DataFrame(
+                    [(op, m["calls"], m["errors"], m["retries"], m["sec"] / m["calls"], m["max"]) for op, m in _gw["ops"].items()],
+                    columns=["請求", "次數", "錯誤", "重試", "平均秒", "最大秒"],
+                ),
+                hide_index=True, use_container_width=True,
+            )
+            st.caption(f"配額節流等待累計 {_gw['throttled_sec']:.1f} 秒（每分鐘 {SHEETS_REQ_PER_MIN} 次）")
+        if _gw["last_error"]:
+            st.caption(f"最近的雲端錯誤：{_gw['last_error']}")
+
+if st.session_state.get("is_admin"):
+    with st.sidebar.expander("🛠️ 效能面板（管理者）"):
+        _last = st.session_state.get("_perf_last")
+        if _last:
+            st.markdown(f"**上一次執行**（{_last['page']}）：{_last['total']:.3f} 秒")
+            for _name, _sec in sorted(_last["spans"].items(), key=lambda kv: -kv[1]):
+                st.caption(f"{_name}：{_sec:.3f} 秒")
+            if _last["counters"]:
+                st.caption("、".join(f"{k} {v}" for k, v in _last["counters"].items()))
+
+        _proc = _perf_process()
+        with _proc["lock"]:
+            _agg = [(k, a[0], a[1] / a[0], a[2]) for k, a in _proc["agg"].items()]
+            _tot = dict(_proc["counters"])
+        if _agg:
+            st.markdown("**本程序累計**")
+            st.dataframe(
+                pd.DataFrame(_agg, columns=["量測點", "次數", "平均秒", "最大秒"]).sort_values("平均秒", ascending=False),
+                hide_index=True, use_container_width=True,
+            )
+            st.caption("累計：" + "、".join(f"{k} {v}" for k, v in _tot.items()))
+        if _proc["bg_last"]:
+            _bg = _proc["bg_last"]
+            st.caption(f"背景（{_bg['thread']} {_bg['ts'][11:]}）：" + "、".join(f"{k} {v:.3f} 秒" for k, v in _bg["spans"].items()))
+
+        _arc = get_archive_status()
+        st.markdown("**資料封存**")
+        st.caption(f"在用 {_arc['hot']} 筆、已封存 {_arc['archived']} 筆"
+                   + (f"（{_arc['pending']} 筆待送雲端）" if _arc["pending"] else "")
+                   + f"；上次封存：{_arc['last'] or '尚無'}（每 {ARCHIVE_EVERY_DAYS} 天自動執行）")
+        st.button("🗄️ 立即封存", key="archive_now", on_click=archive_now_cb)
+
+        st.markdown("**啟動耗時**")
+        for _stage, _sec in list(startup_timings().items()):
+            st.caption(f"{_stage}：{_sec:.3f} 秒")
+        st.caption(f"紀錄檔：{PERF_LOG}")
+
 # --- 頁面 1: 新增 ---
 if menu == "👶 新增報名":
     st.header("📝 新生報名登記")
@@ -402,6 +3601,12 @@ if menu == "👶 新增報名":
         st.selectbox("稱謂", ["先生", "小姐", "爸爸", "媽媽"], key="input_p_title")
         st.text_input("電話", key="input_phone")
         st.text_input("推薦人", key="input_referrer")
+        # 電話輸入後立刻查同一家庭已有的報名
+        if st.session_state.get("input_phone"):
+            family = household_records(st.session_state["input_phone"])
+            if not family.empty:
+                st.caption(f"📞 此電話已有 {len(family)} 筆報名：" + "、".join(
+                    f"{r['幼兒姓名']}（{r['幼兒生日']}，{r['報名狀態']}）" for _, r in family.iterrows()))
 
     with c2:
         st.success("👶 **幼兒資訊**")
@@ -418,6 +3623,12 @@ if menu == "👶 新增報名":
         rm_idx = None
         for i, c in enumerate(st.session_state.temp_children):
             st.text(f"{i+1}. {c['幼兒姓名']} ({c['幼兒生日']}) - {c['預計入學資訊']}")
+            dups = find_possible_duplicates(st.session_state.get("input_phone"), c["幼兒姓名"],
+                                            parse_roc_date_str(c["幼兒生日"]))
+            if not dups.empty:
+                st.warning("⚠️ 可能已報名過：" + "；".join(
+                    f"{r['幼兒姓名']}（{r['幼兒生日']}，{r['電話']}，{r['報名狀態']}）— {r['原因']}"
+                    for _, r in dups.iterrows()))
             if st.button("❌ 移除", key=f"rm_{i}"):
                 rm_idx = i
         if rm_idx is not None:
@@ -430,221 +3641,217 @@ elif menu == "📂 資料管理中心":
     st.header("📂 資料管理中心")
     col_search, col_dl = st.columns([4, 1])
 
-    kw = st_keyup("🔍 搜尋", placeholder="電話或姓名...", key="search_kw")
+    df = load_registered_data()
     if not df.empty:
-        col_dl.download_button("📥", df.to_csv(index=False).encode("utf-8-sig"), "data.csv")
-
-    if df.empty:
-        st.info("資料庫是空的。")
-    else:
-        disp = df.copy()
-        disp["original_index"] = disp.index
-
-        if kw:
-            mask = disp.astype(str).apply(lambda x: x.str.contains(kw, case=False, na=False)).any(axis=1)
-            disp = disp.loc[mask].copy()
-
-        disp["is_contacted"] = disp["聯繫狀態"].astype(str).eq("已聯繫")
-
-        t1, t2, t3 = st.tabs(["🔴 待聯繫", "🟢 已聯繫", "📁 全部資料"])
-
-        def render_status_cards(tdf: pd.DataFrame, key_pfx: str):
-            status_groups = {
-                "🔥 預約與參觀": ["預約參觀"],
-                "⏳ 排隊等待 (含其他)": ["排隊等待"],
-                "✅ 確認入學": ["確認入學"],
-                "❌ 確定不收": ["確定不收"],
-            }
-            known_list = ["預約參觀", "排隊等待", "確認入學", "確定不收"]
-
-            for group_name, status_list in status_groups.items():
-                if group_name == "⏳ 排隊等待 (含其他)":
-                    sub_df = tdf.loc[tdf["報名狀態"].isin(status_list) | ~tdf["報名狀態"].isin(known_list)].copy()
-                else:
-                    sub_df = tdf.loc[tdf["報名狀態"].isin(status_list)].copy()
-
-                if sub_df.empty:
-                    continue
-
-                prio_map = {"優": 0, "中": 1, "差": 2}
-                sub_df["sort_temp"] = sub_df["重要性"].map(prio_map).fillna(1)
-                sub_df = sub_df.sort_values(by=["sort_temp", "登記日期"], ascending=[True, False])
-
-                with st.expander(f"{group_name} (共 {len(sub_df)} 筆)", expanded=True):
-                    for _, r in sub_df.iterrows():
-                        oid = int(r["original_index"])
-                        uk = f"{key_pfx}_{oid}"
-
-                        with st.container(border=True):
-                            # 第一列：基本資料
-                            c_edit1, c_edit2, c_edit3, c_edit4 = st.columns(4)
-                            c_edit1.text_input("幼兒姓名", value=_safe_str(r["幼兒姓名"]), key=f"name_{uk}")
-                            c_edit2.text_input("生日 (民國/月/日)", value=_safe_str(r["幼兒生日"]), key=f"dob_{uk}")
-                            c_edit3.text_input("家長稱呼", value=_safe_str(r["家長稱呼"]), key=f"pname_{uk}")
-                            c_edit4.text_input("電話", value=_safe_str(r["電話"]), key=f"phone_{uk}")
-
-                            # 第二列：狀態 / 入學 / 優先
-                            r1, r2, r3, r4 = st.columns([1.2, 1.2, 1.5, 1])
-                            r1.checkbox("已聯繫", bool(r["is_contacted"]), key=f"c_{uk}")
-
-                            cur_stat = _safe_str(r["報名狀態"])
-                            ui_stat_idx = NEW_STATUS_OPTIONS.index(cur_stat) if cur_stat in NEW_STATUS_OPTIONS else NEW_STATUS_OPTIONS.index("排隊等待")
-                            r2.selectbox("狀態", NEW_STATUS_OPTIONS, index=ui_stat_idx, key=f"s_{uk}", label_visibility="collapsed")
-
-                            curr_plan = _safe_str(r["預計入學資訊"])
-                            plans = [curr_plan] if curr_plan else []
-                            dob_obj = parse_roc_date_str(r["幼兒生日"])
-                            if dob_obj:
-                                auto_plans = calculate_admission_roadmap(dob_obj)
-                                # 將目前值放在最前，但不重複
-                                for p in auto_plans:
-                                    if p not in plans:
-                                        plans.append(p)
-                            if not plans:
-                                plans = ["待確認"]
-
-                            p_idx = plans.index(curr_plan) if curr_plan in plans else 0
-                            r3.selectbox("入學年段", plans, index=p_idx, key=f"p_{uk}", label_visibility="collapsed")
-
-                            imp_val = _safe_str(r["重要性"])
-                            if imp_val not in ["優", "中", "差"]:
-                                imp_val = "中"
-                            r4.selectbox("優先", ["優", "中", "差"], index=["優", "中", "差"].index(imp_val), key=f"imp_{uk}", label_visibility="collapsed")
-
-                            # 第三列：備註
-                            n_val = _safe_str(r["備註"])
-                            st.text_area("備註", n_val, key=f"n_{uk}", height=68, placeholder="在此輸入備註...")
-
-                            # 底部：資訊與刪除
-                            b1, b2 = st.columns([5, 1])
-                            with b1:
-                                st.caption(f"登記日: {_safe_str(r['登記日期'])}")
-                            with b2:
-                                st.checkbox("刪除", key=f"del_{uk}")
-
-        def process_save_status(tdf: pd.DataFrame, key_pfx: str):
-            fulldf = load_registered_data().copy()
-            changes_made = False
-            indices_to_drop = []
-
-            for _, r in tdf.iterrows():
-                oid = int(r["original_index"])
-                uk = f"{key_pfx}_{oid}"
-
-                if st.session_state.get(f"del_{uk}"):
-                    indices_to_drop.append(oid)
-                    changes_made = True
-                    continue
-
-                # 讀取所有可編輯欄位
-                new_name = _safe_str(st.session_state.get(f"name_{uk}"))
-                new_dob = _safe_str(st.session_state.get(f"dob_{uk}"))
-                new_pname = _safe_str(st.session_state.get(f"pname_{uk}"))
-                new_phone = normalize_phone(st.session_state.get(f"phone_{uk}"))
-
-                new_contact = st.session_state.get(f"c_{uk}")
-                new_status = _safe_str(st.session_state.get(f"s_{uk}"))
-                new_plan = _safe_str(st.session_state.get(f"p_{uk}"))
-                new_note = _safe_str(st.session_state.get(f"n_{uk}"))
-                new_imp = _safe_str(st.session_state.get(f"imp_{uk}")) or "中"
-
-                # 逐一比對
-                if _safe_str(fulldf.at[oid, "幼兒姓名"]) != new_name:
-                    fulldf.at[oid, "幼兒姓名"] = new_name
-                    changes_made = True
-
-                if _safe_str(fulldf.at[oid, "幼兒生日"]) != new_dob:
-                    fulldf.at[oid, "幼兒生日"] = new_dob
-                    changes_made = True
-
-                if _safe_str(fulldf.at[oid, "家長稱呼"]) != new_pname:
-                    fulldf.at[oid, "家長稱呼"] = new_pname
-                    changes_made = True
-
-                if _safe_str(fulldf.at[oid, "電話"]) != new_phone:
-                    fulldf.at[oid, "電話"] = new_phone
-                    changes_made = True
-
-                if new_contact is not None:
-                    ncon_str = "已聯繫" if bool(new_contact) else "未聯繫"
-                    if _safe_str(fulldf.at[oid, "聯繫狀態"]) != ncon_str:
-                        fulldf.at[oid, "聯繫狀態"] = ncon_str
-                        changes_made = True
-
-                if new_status and _safe_str(fulldf.at[oid, "報名狀態"]) != new_status:
-                    fulldf.at[oid, "報名狀態"] = new_status
-                    changes_made = True
-
-                if new_plan and _safe_str(fulldf.at[oid, "預計入學資訊"]) != new_plan:
-                    fulldf.at[oid, "預計入學資訊"] = new_plan
-                    changes_made = True
-
-                if _safe_str(fulldf.at[oid, "備註"]) != new_note:
-                    fulldf.at[oid, "備註"] = new_note
-                    changes_made = True
-
-                if new_imp not in ["優", "中", "差"]:
-                    new_imp = "中"
-                if _safe_str(fulldf.at[oid, "重要性"]) != new_imp:
-                    fulldf.at[oid, "重要性"] = new_imp
-                    changes_made = True
-
-            if indices_to_drop:
-                fulldf = fulldf.drop(indices_to_drop)
-
-            if not changes_made:
-                st.info("系統沒有偵測到任何資料變更。")
-                return
-
-            if sync_data_to_gsheets(fulldf):
-                st.success("✅ 資料已成功更新並儲存！")
-                # 不 rerun：直接重新載入並讓下方顯示新資料
-                #（使用者若想刷新搜尋/分頁狀態，可手動切換頁籤）
-                st.session_state["__force_reload__"] = str(datetime.now())
+        # 匯出檔在按下下載時才產生（另一個執行緒），同一資料版本只產生一次
+        with col_dl.popover("📥 匯出"):
+            exp_kind = st.radio("格式", ["CSV（全部資料）", "Excel（分班 / 分狀態）"], key="export_kind")
+            if exp_kind.startswith("CSV"):
+                st.download_button("下載 CSV", lambda: export_bytes("csv"),
+                                   "報名資料.csv", mime="text/csv", use_container_width=True)
             else:
-                st.error("儲存失敗，請檢查網路或權限。")
+                exp_y = int(st.number_input("學年", value=current_academic_year() + 1, step=1, key="export_year"))
+                st.download_button("下載 Excel", lambda: export_bytes("xlsx", exp_y),
+                                   f"報名資料_{exp_y}學年.xlsx",
+                                   mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                                   use_container_width=True)
+
+    dirty = st.session_state.setdefault("mgmt_dirty", {})
+    card_groups = {
+        "🔥 預約與參觀": ["預約參觀"],
+        "⏳ 排隊等待 (含其他)": ["排隊等待"],
+        "✅ 確認入學": ["確認入學"],
+        "❌ 確定不收": ["確定不收"],
+    }
 
-        with t1:
-            target_data = disp.loc[~disp["is_contacted"]].copy()
-            if target_data.empty:
-                st.info("🎉 太棒了！目前沒有待聯繫的名單。")
-            else:
-                with st.form("form_t1"):
-                    render_status_cards(target_data, "t1")
-                    st.write("")
-                    submitted_t1 = st.form_submit_button("💾 儲存所有變更", type="primary", use_container_width=True)
-                if submitted_t1:
-                    process_save_status(target_data, "t1")
-
-        with t2:
-            target_data = disp.loc[disp["is_contacted"]].copy()
-            if target_data.empty:
-                st.info("目前沒有已聯繫的資料。")
-            else:
-                with st.form("form_t2"):
-                    render_status_cards(target_data, "t2")
-                    st.write("")
-                    submitted_t2 = st.form_submit_button("💾 儲存所有變更", type="primary", use_container_width=True)
-                if submitted_t2:
-                    process_save_status(target_data, "t2")
-
-        with t3:
-            if disp.empty:
-                st.info("資料庫是空的。")
+    def filter_view(view: str, kw: str, statuses=NEW_STATUS_OPTIONS) -> pd.DataFrame:
+        # 每次執行（含片段單獨重跑）都向共用資料表取最新的列；分頁與狀態群組由變動事件增量維護
+        vdf = view_partition(view, statuses)
+        if kw:
+            # 索引查詢（依命中欄位排名），不再逐欄位掃描整張表
+            with perf_span("搜尋篩選"):
+                hits = search_registrations(kw)
+                hits = pd.Series(range(len(hits)), index=hits)
+                vdf = vdf.loc[vdf.index.isin(hits.index)].copy()
+                vdf["search_rank"] = hits.reindex(vdf.index).to_numpy()
+        return vdf
+
+    def render_card(rid, r, uk: str, roadmaps: dict):
+        base = _safe_str(r[VER_COL])
+        name = _safe_str(r["幼兒姓名"])
+        ent = dirty.get(rid) or {"set": {}, "delete": False}
+
+        def orig(field: str) -> str:
+            # 與 card_value 相同的正規化，改回原值時才比得出「沒變」
+            if field == "聯繫狀態":
+                return "已聯繫" if bool(r["is_contacted"]) else "未聯繫"
+            if field == "重要性":
+                return card_value(field, r[field])
+            return _safe_str(r[field])
+
+        def val(field: str) -> str:
+            # 換頁回來時元件會重建，顯示尚未儲存的值
+            return ent["set"].get(field, orig(field))
+
+        perf_count("卡片列數")
+        perf_count("元件數", len(CARD_FIELDS) + 1)
+
+        def track(w: str, field: str) -> dict:
+            key = f"{w}_{uk}"
+            return {"key": key, "on_change": mark_dirty_cb, "args": (rid, field, key, base, orig(field), name)}
+
+        with st.container(border=True):
+            # 第一列：基本資料
+            c_edit1, c_edit2, c_edit3, c_edit4 = st.columns(4)
+            c_edit1.text_input("幼兒姓名", value=val("幼兒姓名"), **track("name", "幼兒姓名"))
+            c_edit2.text_input("生日 (民國/月/日)", value=val("幼兒生日"), **track("dob", "幼兒生日"))
+            c_edit3.text_input("家長稱呼", value=val("家長稱呼"), **track("pname", "家長稱呼"))
+            c_edit4.text_input("電話", value=val("電話"), **track("phone", "電話"))
+
+            # 第二列：狀態 / 入學 / 優先
+            r1, r2, r3, r4 = st.columns([1.2, 1.2, 1.5, 1])
+            r1.checkbox("已聯繫", val("聯繫狀態") == "已聯繫", **track("c", "聯繫狀態"))
+
+            cur_stat = val("報名狀態")
+            ui_stat_idx = NEW_STATUS_OPTIONS.index(cur_stat) if cur_stat in NEW_STATUS_OPTIONS else NEW_STATUS_OPTIONS.index("排隊等待")
+            r2.selectbox("狀態", NEW_STATUS_OPTIONS, index=ui_stat_idx, label_visibility="collapsed", **track("s", "報名狀態"))
+
+            curr_plan = val("預計入學資訊")
+            plans = [curr_plan] if curr_plan else []
+            auto_plans = roadmaps.get(rid)
+            if auto_plans:
+                # 將目前值放在最前，但不重複
+                for p in auto_plans:
+                    if p not in plans:
+                        plans.append(p)
+            if not plans:
+                plans = ["待確認"]
+
+            p_idx = plans.index(curr_plan) if curr_plan in plans else 0
+            r3.selectbox("入學年段", plans, index=p_idx, label_visibility="collapsed", **track("p", "預計入學資訊"))
+
+            imp_val = val("重要性")
+            r4.selectbox("優先", PRIO_OPTIONS, index=PRIO_OPTIONS.index(imp_val), label_visibility="collapsed", **track("imp", "重要性"))
+
+            # 第三列：備註
+            st.text_area("備註", val("備註"), height=68, placeholder="在此輸入備註...", **track("n", "備註"))
+
+            # 底部：資訊與刪除
+            b1, b2 = st.columns([5, 1])
+            with b1:
+                st.caption(f"登記日: {_safe_str(r['登記日期'])}")
+            with b2:
+                del_key = f"del_{uk}"
+                st.checkbox("刪除", ent["delete"], key=del_key, on_change=mark_dirty_cb,
+                            args=(rid, "刪除", del_key, base, "", name))
+
+    @perf_fragment("卡片群組")
+    def status_group_cards(view: str, key_pfx: str, gi: int, kw: str, page_size: int):
+        """
+        一個狀態群組（片段）：勾已聯繫、改欄位、換頁、收合都只重跑這個群組。
+        分頁顯示，只為目前這一頁建立元件，收合時完全不渲染；
+        資料每次重新向共用資料表取，其他人剛存的修改也會帶進來。
+        """
+        refresh_changed_records()
+        group_name, status_list = list(card_groups.items())[gi]
+        # status_group 已把未知狀態併入「排隊等待」
+        sub_df = filter_view(view, kw, status_list)
+        if sub_df.empty:
+            return
+
+        gk = f"{key_pfx}_g{gi}"
+        n_dirty = sum(1 for rid in dirty if rid in sub_df.index)
+        label = f"{group_name} (共 {len(sub_df)} 筆{f'，✏️ {n_dirty} 筆未儲存' if n_dirty else ''})"
+        if not st.toggle(label, value=True, key=f"open_{gk}"):
+            return
+
+        pages = max(1, math.ceil(len(sub_df) / page_size))
+        pk = f"page_{gk}"
+        if st.session_state.get(pk, 1) > pages:
+            st.session_state[pk] = pages
+        st.session_state.setdefault(pk, 1)
+
+        with st.container(border=True):
+            pg1, pg2 = st.columns([1, 4])
+            page = pg1.number_input("頁", min_value=1, max_value=pages, step=1, key=pk, label_visibility="collapsed")
+            lo = (int(page) - 1) * page_size
+            pg2.caption(f"第 {int(page)} / {pages} 頁（第 {lo + 1}–{min(lo + page_size, len(sub_df))} 筆）")
+
+            # 只排序、切出這一頁
+            if "search_rank" in sub_df.columns:
+                page_df = sub_df.sort_values(by="search_rank").iloc[lo:lo + page_size]
             else:
-                with st.form("form_t3"):
-                    render_status_cards(disp, "t3")
-                    st.write("")
-                    submitted_t3 = st.form_submit_button("💾 儲存所有變更", type="primary", use_container_width=True)
-                if submitted_t3:
-                    process_save_status(disp, "t3")
+                page_df = sub_df.sort_values(by=["prio", "reg_date"], ascending=[True, False]).iloc[lo:lo + page_size]
+            roadmaps = admission_roadmaps(page_df)
+
+            for rid, r in page_df.iterrows():
+                render_card(rid, r, f"{key_pfx}_{rid}", roadmaps)
+
+    @perf_fragment("資料管理")
+    def management_board():
+        """
+        搜尋、檢視切換、儲存列與各狀態群組（片段）：打字搜尋、換頁籤、儲存只重跑這一段，
+        不重跑側邊欄與頁首；各群組又各自是一個片段。
+        """
+        refresh_changed_records()
+        kw = st_keyup("🔍 搜尋", placeholder="電話或姓名...", key="search_kw")
+        with_archive = st.checkbox("包含封存資料（確定不收 / 已畢業）", key="search_archive")
+
+        if kw and with_archive:
+            # 封存資料唯讀顯示在最上面，只有勾選時才讀封存表
+            arc_hits = search_archive(kw)
+            with st.expander(f"🗄️ 封存資料：符合 {len(arc_hits)} 筆", expanded=bool(len(arc_hits))):
+                if arc_hits.empty:
+                    st.caption("封存資料中沒有符合的紀錄。")
+                else:
+                    st.dataframe(arc_hits.drop(columns=[ID_COL, VER_COL]), hide_index=True, use_container_width=True)
+
+        if load_registered_data().empty:
+            st.info("資料庫是空的。")
+            return
+
+        # 只渲染目前選到的頁籤（st.tabs 會把三個頁籤全部跑一遍）
+        tab_c, size_c = st.columns([4, 1])
+        tab = tab_c.radio("檢視", ["🔴 待聯繫", "🟢 已聯繫", "📁 全部資料"], horizontal=True,
+                          key="mgmt_tab", label_visibility="collapsed")
+        page_size = size_c.selectbox("每頁筆數", CARD_PAGE_SIZES, index=1, key="mgmt_page_size",
+                                     label_visibility="collapsed", format_func=lambda n: f"每頁 {n} 筆")
+
+        # 儲存列：只送出有記錄的變更。卡片在各群組片段內修改，未儲存筆數即時標在群組標題
+        res = st.session_state.pop("mgmt_save_result", None)
+        if res:
+            report_patch_result(res, res.get("names"))
+        sv1, sv2, sv3 = st.columns([3, 1, 1])
+        sv1.caption("修改會先暫存，按「💾 儲存變更」一次寫入；各群組標題標示未儲存的筆數。")
+        stale = [e["name"] or rid for rid, e in dirty.items() if e.get("stale")]
+        if stale:
+            sv1.warning(f"⚠️ {'、'.join(stale[:5])}{' 等' if len(stale) > 5 else ''} 已被其他人修改，"
+                        "儲存時會列為衝突；可先放棄變更再重新編輯。")
+        sv2.button("💾 儲存變更", type="primary", on_click=save_dirty_cb, use_container_width=True)
+        sv3.button("↩️ 放棄變更", on_click=discard_dirty_cb, use_container_width=True)
+
+        view, key_pfx, empty_msg = {
+            "🔴 待聯繫": ("uncontacted", "t1", "🎉 太棒了！目前沒有待聯繫的名單。"),
+            "🟢 已聯繫": ("contacted", "t2", "目前沒有已聯繫的資料。"),
+            "📁 全部資料": ("all", "t3", "資料庫是空的。"),
+        }[tab]
+        if filter_view(view, kw).empty:
+            st.info(empty_msg)
+            return
+        with perf_span(f"渲染：{tab[2:]}"):
+            for gi in range(len(card_groups)):
+                status_group_cards(view, key_pfx, gi, kw, int(page_size))
+
+    management_board()
 
 # --- 頁面 3: 學年查詢 ---
 elif menu == "🎓 學年快速查詢":
     st.header("🎓 學年段快速查詢")
     tab_q1, tab_q2 = st.tabs(["📅 生日查詢 (計算)", "📊 年度對照總表"])
 
-    with tab_q1:
+    @perf_fragment("生日查詢")
+    def quick_grade_check():
+        # 切換輸入方式 / 改生日只重跑這一段
         st.caption("輸入出生年月日，立即查看該生目前的學齡與未來入學規劃，無需建立資料。")
         c_mode = st.radio("選擇日期輸入方式", ["民國", "西元"], horizontal=True)
         dob = None
@@ -674,6 +3881,9 @@ elif menu == "🎓 學年快速查詢":
             else:
                 st.warning("年齡超出範圍或無法計算。")
 
+    with tab_q1:
+        quick_grade_check()
+
     with tab_q2:
         st.subheader("📊 各年份出生兒童入學對照表")
         cur_roc_year = date.today().year - 1911
@@ -702,125 +3912,99 @@ elif menu == "📅 未來入學預覽":
     st.caption(f"💡 系統依據生日自動推算 {search_y} 學年的班級。")
     st.divider()
 
-    if df.empty:
-        st.info("資料庫是空的。")
-    else:
-        roster = {k: {"conf": [], "pend": []} for k in ["托嬰中心", "幼幼班", "小班", "中班", "大班"]}
-        stats = {"tot": 0, "conf": 0, "pend": 0}
-        all_pending_list = []
-
-        for idx, row in df.iterrows():
-            if "確定不收" in _safe_str(row["報名狀態"]):
-                continue
-
-            grade = None
-            p_str = _safe_str(row["預計入學資訊"])
-            if f"{search_y} 學年" in p_str:
-                parts = p_str.split(" - ")
-                if len(parts) > 1:
-                    grade = parts[1].strip()
-
-            if not grade:
-                dob = parse_roc_date_str(row["幼兒生日"])
-                if dob:
-                    grade = get_grade_for_year(dob, int(search_y))
-
-            if grade not in roster:
-                continue
-
-            status = _safe_str(row["報名狀態"])
-            is_conf = "確認入學" in status
-
-            stats["tot"] += 1
-            item = row.to_dict()
-            item["idx"] = idx
-            item["班級"] = grade
-
-            if is_conf:
-                stats["conf"] += 1
-                roster[grade]["conf"].append(item)
-            else:
-                stats["pend"] += 1
-                roster[grade]["pend"].append(item)
-                all_pending_list.append(item)
-
-        c1, c2, c3 = st.columns(3)
-        c1.metric("✅ 確定入學", stats["conf"])
-        c2.metric("⏳ 潛在/排隊", stats["pend"])
-        c3.metric("📋 總符合人數", stats["tot"])
-
-        with st.expander(f"📋 查看全校【待確認】總表 (共{len(all_pending_list)}人) - 可直接編輯", expanded=False):
-            if not all_pending_list:
-                st.info("目前沒有待確認的學生。")
-            else:
-                p_all_df = pd.DataFrame(all_pending_list)
-                p_all_df["已聯繫"] = p_all_df["聯繫狀態"].astype(str).eq("已聯繫")
-
-                with st.form("master_pending_form"):
-                    edited_master = st.data_editor(
-                        p_all_df,
-                        column_order=["班級", "已聯繫", "報名狀態", "幼兒姓名", "家長稱呼", "電話", "備註"],
-                        column_config={
-                            "idx": None,
-                            "聯繫狀態": None,
-                            "班級": st.column_config.TextColumn(width="small", disabled=True),
-                            "已聯繫": st.column_config.CheckboxColumn(width="small"),
-                            "報名狀態": st.column_config.SelectboxColumn(options=NEW_STATUS_OPTIONS, width="medium"),
-                            "幼兒姓名": st.column_config.TextColumn(disabled=True),
-                            "家長稱呼": st.column_config.TextColumn(disabled=True),
-                            "電話": st.column_config.TextColumn(disabled=True),
-                            "備註": st.column_config.TextColumn(width="large"),
-                        },
-                        hide_index=True,
-                        use_container_width=True,
-                    )
-                    st.caption("ℹ️ 將狀態改為「確認入學」並儲存，學生就會移動到下方的確認名單。")
-                    if st.form_submit_button("💾 儲存待確認清單變更"):
-                        fulldf = load_registered_data().copy()
-                        chg = False
-                        for _, r in edited_master.iterrows():
-                            oid = int(r["idx"])
-                            ncon = "已聯繫" if bool(r["已聯繫"]) else "未聯繫"
-                            if _safe_str(fulldf.at[oid, "聯繫狀態"]) != ncon:
-                                fulldf.at[oid, "聯繫狀態"] = ncon
-                                chg = True
-                            if _safe_str(fulldf.at[oid, "報名狀態"]) != _safe_str(r["報名狀態"]):
-                                fulldf.at[oid, "報名狀態"] = _safe_str(r["報名狀態"])
-                                chg = True
-                            if _safe_str(fulldf.at[oid, "備註"]) != _safe_str(r["備註"]):
-                                fulldf.at[oid, "備註"] = _safe_str(r["備註"])
-                                chg = True
-
-                        if not chg:
-                            st.info("沒有任何變更。")
-                        else:
-                            if sync_data_to_gsheets(fulldf):
-                                st.success("✅ 更新成功")
+    @perf_fragment("入學名單")
+    def roster_board(search_y: int):
+        """
+        名單區（片段）：待確認總表儲存後只重跑這一段，統計與各班名單一起更新。
+        """
+        # 物化名單：同一學年 + 同一資料版本只算一次，切換學年來回不用重算
+        roster = get_roster(int(search_y))
+        if not roster["n_active"]:
+            st.info("資料庫是空的。")
+        else:
+            stats = {"conf": len(roster["conf"]), "pend": len(roster["pend"])}
+            stats["tot"] = stats["conf"] + stats["pend"]
+            all_pending = roster["pend"]
+
+            c1, c2, c3 = st.columns(3)
+            c1.metric("✅ 確定入學", stats["conf"])
+            c2.metric("⏳ 潛在/排隊", stats["pend"])
+            c3.metric("📋 總符合人數", stats["tot"])
+
+            with st.expander(f"📋 查看全校【待確認】總表 (共{len(all_pending)}人) - 可直接編輯", expanded=False):
+                if all_pending.empty:
+                    st.info("目前沒有待確認的學生。")
+                else:
+                    p_all_df = all_pending.reset_index(drop=True)
+                    p_all_df["idx"] = all_pending.index
+                    p_all_df["已聯繫"] = p_all_df["聯繫狀態"].astype(str).eq("已聯繫")
+
+                    with st.form("master_pending_form"):
+                        edited_master = st.data_editor(
+                            p_all_df,
+                            column_order=["班級", "已聯繫", "報名狀態", "幼兒姓名", "家長稱呼", "電話", "備註"],
+                            column_config={
+                                "idx": None,
+                                "聯繫狀態": None,
+                                ID_COL: None,
+                                VER_COL: None,
+                                "班級": st.column_config.TextColumn(width="small", disabled=True),
+                                "已聯繫": st.column_config.CheckboxColumn(width="small"),
+                                "報名狀態": st.column_config.SelectboxColumn(options=NEW_STATUS_OPTIONS, width="medium"),
+                                "幼兒姓名": st.column_config.TextColumn(disabled=True),
+                                "家長稱呼": st.column_config.TextColumn(disabled=True),
+                                "電話": st.column_config.TextColumn(disabled=True),
+                                "備註": st.column_config.TextColumn(width="large"),
+                            },
+                            hide_index=True,
+                            use_container_width=True,
+                        )
+                        st.caption("ℹ️ 將狀態改為「確認入學」並儲存，學生就會移動到下方的確認名單。")
+                        if st.form_submit_button("💾 儲存待確認清單變更"):
+                            orig = p_all_df.set_index("idx")
+                            patches = []
+                            for _, r in edited_master.iterrows():
+                                rid = _safe_str(r["idx"])
+                                o = orig.loc[rid]
+                                fields = {
+                                    "聯繫狀態": "已聯繫" if bool(r["已聯繫"]) else "未聯繫",
+                                    "報名狀態": _safe_str(r["報名狀態"]),
+                                    "備註": _safe_str(r["備註"]),
+                                }
+                                changes = {k: v for k, v in fields.items() if _safe_str(o[k]) != v}
+                                if changes:
+                                    patches.append({"id": rid, "base": _safe_str(o[VER_COL]), "set": changes})
+
+                            if not patches:
+                                st.info("沒有任何變更。")
                             else:
-                                st.error("❌ 更新失敗，請檢查網路或權限。")
+                                report_patch_result(apply_record_patches(patches), orig["幼兒姓名"].to_dict())
 
-        st.markdown("---")
-        st.subheader(f"🏆 {search_y} 學年度 - 確認入學名單 (僅顯示確認入學)")
+            st.markdown("---")
+            st.subheader(f"🏆 {search_y} 學年度 - 確認入學名單 (僅顯示確認入學)")
 
-        col_l, col_m, col_s = st.columns(3)
+            col_l, col_m, col_s = st.columns(3)
 
-        def render_board(column, title, data):
-            with column:
-                st.markdown(f"##### {title} ({len(data)}人)")
-                if not data:
-                    st.info("尚無名單")
-                else:
-                    disp_df = pd.DataFrame(data)[["幼兒姓名", "家長稱呼", "電話", "備註"]]
-                    st.dataframe(disp_df, hide_index=True, use_container_width=True)
+            def render_board(column, title, grade):
+                data = roster["by_grade"].get(grade, roster["conf"].iloc[0:0])
+                with column:
+                    st.markdown(f"##### {title} ({len(data)}人)")
+                    if data.empty:
+                        st.info("尚無名單")
+                    else:
+                        disp_df = data[["幼兒姓名", "家長稱呼", "電話", "備註"]]
+                        st.dataframe(disp_df, hide_index=True, use_container_width=True)
+
+            render_board(col_l, "🐘 大班", "大班")
+            render_board(col_m, "🦁 中班", "中班")
+            render_board(col_s, "🐰 小班", "小班")
 
-        render_board(col_l, "🐘 大班", roster["大班"]["conf"])
-        render_board(col_m, "🦁 中班", roster["中班"]["conf"])
-        render_board(col_s, "🐰 小班", roster["小班"]["conf"])
+            st.write("")
+            col_t, col_d, col_x = st.columns(3)
+            render_board(col_t, "🐥 幼幼班", "幼幼班")
+            render_board(col_d, "🍼 托嬰中心", "托嬰中心")
 
-        st.write("")
-        col_t, col_d, col_x = st.columns(3)
-        render_board(col_t, "🐥 幼幼班", roster["幼幼班"]["conf"])
-        render_board(col_d, "🍼 托嬰中心", roster["托嬰中心"]["conf"])
+    roster_board(int(search_y))
 
 # --- 頁面 5: 招生缺額與師資試算 ---
 elif menu == "👩‍🏫 招生缺額與師資試算":
@@ -830,100 +4014,300 @@ elif menu == "👩‍🏫 招生缺額與師資試算":
     cal_y = st.number_input("📅 預估學年 (目標)", value=date.today().year - 1911 + 1)
     ref_y = int(cal_y) - 1
 
-    ratio_mix = 12 if cal_y >= 115 else 15
-    ratio_label = "1:12 (新制)" if cal_y >= 115 else "1:15 (舊制)"
-    if cal_y >= 115:
-        st.caption(f"ℹ️ 系統偵測為 **115學年度** 以後，3-6歲師生比自動設定為 **{ratio_label}**。")
+    ratio_mix = mixed_ratio(int(cal_y))
+    ratio_label = f"1:{ratio_mix} (新制)" if cal_y >= RATIO_SWITCH_YEAR else f"1:{ratio_mix} (舊制)"
+    if cal_y >= RATIO_SWITCH_YEAR:
+        st.caption(f"ℹ️ 系統偵測為 **{RATIO_SWITCH_YEAR}學年度** 以後，3-6歲師生比自動設定為 **{ratio_label}**。")
+
+    @perf_fragment("師資試算")
+    def staffing_calculator(cal_y):
+        """
+        Step 1–2（片段）：調整人數 / 名額只重跑試算，不重跑頁首、側邊欄與多年度推估。
+        """
+        def get_prev_counts(year):
+            # 確認入學的班級人數取自增量維護的招生統計（與未來入學預覽的名單規則相同），不必建整份名單
+            counts = stats_class_counts(admission_stats(), year)
+            return {"幼幼": counts.get(("conf", "幼幼班"), 0), "小": counts.get(("conf", "小班"), 0),
+                    "中": counts.get(("conf", "中班"), 0)}
+
+        version = get_data_version()
+        if cal_y not in st.session_state["calc_memory"]:
+            st.session_state["calc_memory"][cal_y] = {"target_mixed": 90, "target_t": 16, "version": None}
+
+        data = st.session_state["calc_memory"][cal_y]
+        if data["version"] != version:
+            # 資料有存檔過：在校生人數重新帶入（目標名額保留）
+            db_data = get_prev_counts(ref_y)
+            data["prev_t"] = db_data["幼幼"]
+            data["prev_s"] = db_data["小"]
+            data["prev_m"] = db_data["中"]
+            data["version"] = version
+
+        if st.button(f"🔄 重置為 {ref_y} 學年資料庫數據"):
+            db_data = get_prev_counts(ref_y)
+            data["prev_t"] = db_data["幼幼"]
+            data["prev_s"] = db_data["小"]
+            data["prev_m"] = db_data["中"]
+
+        st.subheader(f"Step 1: 確認 {ref_y} 學年 (前一年) 在校生人數")
+        c1, c2, c3 = st.columns(3)
+        data["prev_t"] = c1.number_input(f"{ref_y} 幼幼班人數", value=int(data["prev_t"]), min_value=0)
+        data["prev_s"] = c2.number_input(f"{ref_y} 小班人數", value=int(data["prev_s"]), min_value=0)
+        data["prev_m"] = c3.number_input(f"{ref_y} 中班人數", value=int(data["prev_m"]), min_value=0)
 
-    def get_prev_counts(year):
-        c = {"幼幼": 0, "小": 0, "中": 0}
-        for _, r in df.iterrows():
-            if "確認入學" not in _safe_str(r["報名狀態"]):
-                continue
+        rising_students = int(data["prev_t"]) + int(data["prev_s"]) + int(data["prev_m"])
 
-            gr = None
-            p = _safe_str(r["預計入學資訊"])
-            if f"{year} 學年" in p:
-                parts = p.split(" - ")
-                if len(parts) > 1:
-                    gr = parts[1].strip()
-
-            if not gr:
-                dob = parse_roc_date_str(r["幼兒生日"])
-                if dob:
-                    gr = get_grade_for_year(dob, year)
-
-            if gr == "幼幼班":
-                c["幼幼"] += 1
-            elif gr == "小班":
-                c["小"] += 1
-            elif gr == "中班":
-                c["中"] += 1
-        return c
-
-    if cal_y not in st.session_state["calc_memory"]:
-        db_data = get_prev_counts(ref_y)
-        st.session_state["calc_memory"][cal_y] = {
-            "prev_t": db_data["幼幼"],
-            "prev_s": db_data["小"],
-            "prev_m": db_data["中"],
-            "target_mixed": 90,
-            "target_t": 16,
-        }
+        st.markdown("---")
+        st.subheader(f"Step 2: 設定 {cal_y} 學年 (預估年) 目標與計算")
+
+        col_mix, col_t = st.columns(2)
+
+        with col_mix:
+            st.markdown("### 🐘 3-6歲 (小中大) 混齡區")
+            st.write(f"預計直升舊生： **{rising_students}** 人")
+            data["target_mixed"] = st.number_input(f"{cal_y} 學年【小中大】核定總名額", value=int(data["target_mixed"]), min_value=0)
+            gap_mixed = int(data["target_mixed"]) - rising_students
+            teachers_mix = math.ceil(int(data["target_mixed"]) / ratio_mix) if int(data["target_mixed"]) > 0 else 0
+
+            st.markdown(f"""
+            <div class="metric-box">
+                <h4>還需招收</h4>
+                <h2 style="color: {'green' if gap_mixed >= 0 else 'red'}">{gap_mixed} 人</h2>
+                <hr>
+                <h4>所需師資 (3-6歲 {ratio_label})</h4>
+                <h2>{teachers_mix} 位</h2>
+            </div>
+            """, unsafe_allow_html=True)
+
+        with col_t:
+            st.markdown("### 🐥 2-3歲 (幼幼) 獨立區")
+            data["target_t"] = st.number_input(f"{cal_y} 學年【幼幼班】預計招收名額", value=int(data["target_t"]), min_value=0)
+            ratio_t = RATIO_TODDLER
+            teachers_t = math.ceil(int(data["target_t"]) / ratio_t) if int(data["target_t"]) > 0 else 0
+
+            st.markdown(f"""
+            <div class="metric-box">
+                <h4>預計招收</h4>
+                <h2 style="color: green">{int(data["target_t"])} 人</h2>
+                <hr>
+                <h4>所需師資 (2-3歲 1:8)</h4>
+                <h2>{teachers_t} 位</h2>
+            </div>
+            """, unsafe_allow_html=True)
 
-    data = st.session_state["calc_memory"][cal_y]
+        st.markdown("---")
+        st.caption(f"總結：{cal_y} 學年度全園需聘 **{teachers_mix + teachers_t}** 位老師 (不含托嬰)。")
+
+    @perf_fragment("多年度推估")
+    def enrollment_projection(cal_y):
+        # Step 3（片段）：改推估年數 / 情境表只重跑推估
+        data = st.session_state["calc_memory"][cal_y]
+        st.subheader(f"Step 3: {cal_y} 學年起多年度推估與情境比較")
+        st.caption("依生日（或預計入學資訊）把確認入學與候補中的幼兒逐年升班；排隊等待 / 預約參觀乘上轉換率計入。"
+                   "人數統計每次存檔後才重算，調整情境只重算該情境。")
+
+        horizon = st.slider("推估年數", 3, 5, 3, key="proj_horizon")
+        # 情境表的初始值只建一次（之後以表格內的編輯為準）
+        scen_cols = {"情境": "name", "小中大名額": "cap_mixed", "幼幼名額": "cap_toddler", "排隊轉換率": "conv_wait",
+                     "參觀轉換率": "conv_visit", "小中大師生比": "ratio_mixed", "幼幼師生比": "ratio_toddler"}
+        if "proj_base" not in st.session_state:
+            st.session_state["proj_base"] = pd.DataFrame([
+                {**PROJECTION_DEFAULTS, "name": n, "cap_mixed": int(data["target_mixed"]),
+                 "cap_toddler": int(data["target_t"]), "conv_wait": w, "conv_visit": v}
+                for n, w, v in [("保守", 0.3, 0.1), ("基準", 0.5, 0.2), ("積極", 0.8, 0.4)]
+            ]).rename(columns={v: k for k, v in scen_cols.items()})[list(scen_cols)]
+        scen_df = st.data_editor(
+            st.session_state["proj_base"],
+            num_rows="dynamic",
+            key="proj_scenarios",
+            column_config={
+                "小中大名額": st.column_config.NumberColumn(min_value=0, step=1),
+                "幼幼名額": st.column_config.NumberColumn(min_value=0, step=1),
+                "排隊轉換率": st.column_config.NumberColumn(min_value=0.0, max_value=1.0, step=0.05),
+                "參觀轉換率": st.column_config.NumberColumn(min_value=0.0, max_value=1.0, step=0.05),
+                "小中大師生比": st.column_config.NumberColumn(min_value=0, step=1, help="0 = 依學年套用 1:15 / 1:12"),
+                "幼幼師生比": st.column_config.NumberColumn(min_value=1, step=1),
+            },
+            hide_index=True,
+            use_container_width=True,
+        )
+        # 新增的列或清空的格子是 None / NaN（NaN 為真值，v or 0 擋不掉），數值欄一律轉數字、無效的當 0
+        nums = [k for k in scen_cols if k != "情境"]
+        scen_df = scen_df.assign(**{k: pd.to_numeric(scen_df[k], errors="coerce").fillna(0) for k in nums})
+        scenarios = [
+            {scen_cols[k]: (_safe_str(v) or f"情境{i + 1}") if k == "情境" else float(v) for k, v in r.items()}
+            for i, r in enumerate(scen_df.to_dict("records"))
+        ]
+        proj = project_enrollment(int(cal_y), horizon, scenarios)
+        if proj.empty:
+            st.info("請至少保留一個情境。")
+        else:
+            st.dataframe(proj, hide_index=True, use_container_width=True)
+            st.caption("小中大缺額（名額 - 預估人數，負數代表超收）")
+            st.line_chart(proj.pivot_table(index="學年", columns="情境", values="小中大缺額", aggfunc="first"))
 
-    if st.button(f"🔄 重置為 {ref_y} 學年資料庫數據"):
-        db_data = get_prev_counts(ref_y)
-        data["prev_t"] = db_data["幼幼"]
-        data["prev_s"] = db_data["小"]
-        data["prev_m"] = db_data["中"]
+    staffing_calculator(cal_y)
+    st.markdown("---")
+    enrollment_projection(cal_y)
+
+# --- 頁面 6: 批次匯入 ---
+elif menu == "📥 批次匯入":
+    st.header("📥 批次匯入報名資料")
+    st.caption("支援 CSV（UTF-8 / Big5）與 Excel（.xlsx，讀第一個工作表）。資料逐段讀取與整理，最後一次寫入。")
 
-    st.subheader(f"Step 1: 確認 {ref_y} 學年 (前一年) 在校生人數")
-    c1, c2, c3 = st.columns(3)
-    data["prev_t"] = c1.number_input(f"{ref_y} 幼幼班人數", value=int(data["prev_t"]), min_value=0)
-    data["prev_s"] = c2.number_input(f"{ref_y} 小班人數", value=int(data["prev_s"]), min_value=0)
-    data["prev_m"] = c3.number_input(f"{ref_y} 中班人數", value=int(data["prev_m"]), min_value=0)
+    up = st.file_uploader("選擇檔案", type=["csv", "xlsx"], key="import_file")
+    if up is not None:
+        try:
+            first = next(iter_import_chunks(up, up.name, chunk_rows=200), None)
+        except Exception as e:
+            first = None
+            st.error(f"無法讀取檔案：{e}")
+
+        if first is not None:
+            src_cols = list(first.columns)
+            guess = guess_import_mapping(src_cols)
+            st.subheader("欄位對應")
+            options = ["（不匯入）"] + src_cols
+            mapping = {}
+            map_cols = st.columns(4)
+            for i, target in enumerate(IMPORT_COLS):
+                g = guess.get(target)
+                pick = map_cols[i % 4].selectbox(target, options, index=options.index(g) if g else 0,
+                                                 key=f"imp_map_{up.name}_{target}")
+                mapping[target] = None if pick == "（不匯入）" else pick
+
+            if not (mapping["幼兒姓名"] or mapping["電話"]):
+                st.warning("至少要對應「幼兒姓名」或「電話」其中一欄。")
+            else:
+                st.subheader("預覽（前 5 筆，整理後）")
+                st.dataframe(prepare_import_chunk(first.head(5), mapping), hide_index=True, use_container_width=True)
+
+                if st.button("✅ 開始匯入", type="primary", use_container_width=True):
+                    status_line = st.empty()
+
+                    def _progress(n):
+                        status_line.caption(f"已整理 {n} 筆...")
+
+                    chunks = (prepare_import_chunk(c, mapping) for c in iter_import_chunks(up, up.name))
+                    res = import_registrations(chunks, progress=_progress)
+                    if res["ok"]:
+                        status_line.empty()
+                        st.success(f"✅ 已匯入 {res['rows']} 筆資料")
+                    else:
+                        st.error(f"匯入失敗，資料未寫入：{res['error']}")
+
+# --- 頁面 7: 重複報名檢查 ---
+elif menu == "🧩 重複報名檢查":
+    st.header("🧩 重複報名檢查")
+    st.caption("同電話且幼兒姓名相近、或同生日且姓名幾乎相同的紀錄視為同一位幼兒。"
+               "每組依狀態（確認入學 > 排隊等待 > 預約參觀 > 確定不收）與登記日期建議保留一筆。")
+
+    groups = duplicate_groups()
+    if groups.empty:
+        st.success("沒有找到疑似重複的報名。")
+    else:
+        n_groups = int(groups["群組"].nunique())
+        c1, c2 = st.columns(2)
+        c1.metric("疑似重複群組", n_groups)
+        c2.metric("可合併掉的紀錄", int(groups["建議"].eq("併入").sum()))
+
+        summary = groups.groupby("群組", sort=False).agg(
+            保留=("幼兒姓名", "first"),
+            電話=("電話", "first"),
+            併入=("幼兒姓名", lambda s: "、".join(s.iloc[1:])),
+            筆數=("幼兒姓名", "size"),
+            原因=("原因", "first"),
+        ).reset_index()
+        summary.insert(0, "合併", False)
+
+        with st.form("dup_merge_form"):
+            picked = st.data_editor(
+                summary,
+                column_config={"合併": st.column_config.CheckboxColumn(width="small")},
+                disabled=[c for c in summary.columns if c != "合併"],
+                hide_index=True,
+                use_container_width=True,
+            )
+            st.caption("ℹ️ 合併：保留的那筆補上空白欄位、備註合併，其餘紀錄刪除。")
+            if st.form_submit_button("🔗 合併勾選的群組"):
+                chosen = picked.loc[picked["合併"], "群組"].tolist()
+                if not chosen:
+                    st.info("沒有勾選任何群組。")
+                else:
+                    sel = groups[groups["群組"].isin(chosen)]
+                    report_patch_result(apply_record_patches(merge_duplicate_patches(sel)),
+                                        dict(zip(sel[ID_COL], sel["幼兒姓名"])))
 
-    rising_students = int(data["prev_t"]) + int(data["prev_s"]) + int(data["prev_m"])
+        with st.expander("📋 明細"):
+            st.dataframe(groups.drop(columns=[VER_COL]), hide_index=True, use_container_width=True)
 
-    st.markdown("---")
-    st.subheader(f"Step 2: 設定 {cal_y} 學年 (預估年) 目標與計算")
-
-    col_mix, col_t = st.columns(2)
-
-    with col_mix:
-        st.markdown("### 🐘 3-6歲 (小中大) 混齡區")
-        st.write(f"預計直升舊生： **{rising_students}** 人")
-        data["target_mixed"] = st.number_input(f"{cal_y} 學年【小中大】核定總名額", value=int(data["target_mixed"]), min_value=0)
-        gap_mixed = int(data["target_mixed"]) - rising_students
-        teachers_mix = math.ceil(int(data["target_mixed"]) / ratio_mix) if int(data["target_mixed"]) > 0 else 0
-
-        st.markdown(f"""
-        <div class="metric-box">
-            <h4>還需招收</h4>
-            <h2 style="color: {'green' if gap_mixed >= 0 else 'red'}">{gap_mixed} 人</h2>
-            <hr>
-            <h4>所需師資 (3-6歲 {ratio_label})</h4>
-            <h2>{teachers_mix} 位</h2>
-        </div>
-        """, unsafe_allow_html=True)
-
-    with col_t:
-        st.markdown("### 🐥 2-3歲 (幼幼) 獨立區")
-        data["target_t"] = st.number_input(f"{cal_y} 學年【幼幼班】預計招收名額", value=int(data["target_t"]), min_value=0)
-        ratio_t = 8
-        teachers_t = math.ceil(int(data["target_t"]) / ratio_t) if int(data["target_t"]) > 0 else 0
-
-        st.markdown(f"""
-        <div class="metric-box">
-            <h4>預計招收</h4>
-            <h2 style="color: green">{int(data["target_t"])} 人</h2>
-            <hr>
-            <h4>所需師資 (2-3歲 1:8)</h4>
-            <h2>{teachers_t} 位</h2>
-        </div>
-        """, unsafe_allow_html=True)
+# --- 頁面 8: 招生分析 ---
+elif menu == "📊 招生分析":
+    st.header("📊 招生分析")
+    st.caption("統計隨每次存檔增量更新（只加減變動的那幾筆），開啟本頁不重新掃描整張表；不含封存資料。")
 
-    st.markdown("---")
-    st.caption(f"總結：{cal_y} 學年度全園需聘 **{teachers_mix + teachers_t}** 位老師 (不含托嬰)。")
+    stats = admission_stats()
+    if not stats.get("status"):
+        st.info("資料庫是空的。")
+    else:
+        funnel = stats_funnel(stats)
+        backlog = stats_backlog(stats)
+        n_total = int(funnel["目前人數"].sum())
+        n_conf, n_rej = (int(funnel.loc[funnel["階段"].eq(s), "目前人數"].iloc[0]) for s in ("確認入學", "確定不收"))
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("報名總數", n_total)
+        m2.metric("確認入學", n_conf)
+        m3.metric("確認率（已決定者）", f"{n_conf / (n_conf + n_rej):.0%}" if n_conf + n_rej else "—")
+        m4.metric("待聯繫", int(backlog["筆數"].sum()))
+
+        c1, c2 = st.columns(2)
+        with c1:
+            st.subheader("🔻 轉換漏斗")
+            st.bar_chart(funnel.set_index("階段")["累計到達"])
+            st.dataframe(funnel, hide_index=True, use_container_width=True,
+                         column_config={"到達率": st.column_config.NumberColumn(format="percent")})
+        with c2:
+            st.subheader("📅 每月登記數")
+            monthly = stats_monthly(stats)
+            if monthly.empty:
+                st.caption("沒有登記日期。")
+            else:
+                st.bar_chart(monthly.set_index("月份"))
+
+        c3, c4 = st.columns(2)
+        with c3:
+            st.subheader("🤝 推薦人排行")
+            refs = stats_referrers(stats)
+            if refs.empty:
+                st.caption("沒有推薦人資料。")
+            else:
+                st.dataframe(refs, hide_index=True, use_container_width=True,
+                             column_config={"轉換率": st.column_config.NumberColumn(format="percent")})
+        with c4:
+            st.subheader("☎️ 待聯繫等待時間")
+            st.bar_chart(backlog.set_index("等待時間"))
+            st.caption("未聯繫且非確定不收的報名，依登記日期至今的天數分組。")
+
+        @perf_fragment("填滿率")
+        def fill_rate_board():
+            """
+            各學年班級填滿率（片段）：調整名額只重算這一塊。
+            """
+            st.subheader("🏫 各學年班級填滿率")
+            f1, f2, f3 = st.columns(3)
+            cap_mixed = f1.number_input("小中大名額", min_value=0, value=PROJECTION_DEFAULTS["cap_mixed"], key="fill_cap_mixed")
+            cap_toddler = f2.number_input("幼幼班名額", min_value=0, value=PROJECTION_DEFAULTS["cap_toddler"], key="fill_cap_toddler")
+            n_years = f3.number_input("顯示學年數", min_value=1, max_value=10, value=4, key="fill_years")
+            y0 = current_academic_year()
+            fill = stats_fill(admission_stats(), range(y0, y0 + int(n_years)), int(cap_mixed), int(cap_toddler))
+            pct = st.column_config.NumberColumn(format="percent")
+            st.dataframe(fill, hide_index=True, use_container_width=True,
+                         column_config={"小中大填滿率": pct, "幼幼填滿率": pct})
+            st.caption("人數依生日推算（預計入學資訊指定該學年時以其為準），與未來入學預覽的名單一致；含候補 = 加上非確定不收的其他報名。")
+
+        fill_rate_board()
+
+# 登入後第一個畫面完成的時間（登入那一次執行跑到這裡就是畫面可用）
+if "_login_t0" in st.session_state:
+    _mark_startup("登入→首頁可用", time.perf_counter() - st.session_state.pop("_login_t0"))
+perf_end_run(menu)
@@ -0,0 +1,411 @@
+"""
+效能基準測試：用合成的報名資料（1k / 10k / 100k 筆）量測主要流程每個階段的耗時與記憶體峰值。
+
+    python benchmark.py                       # 預設 1000 10000 100000 筆
+    python benchmark.py --sizes 1000 10000    # 指定筆數
+    python benchmark.py --json out.json       # 結果另存 JSON
+    python benchmark.py --baseline out.json   # 與先前結果比較，變慢超過門檻時以代碼 1 結束
+
+在暫存目錄執行（不會動到正式的本機庫 / 快照），雲端一律使用記憶體內的假工作表，不連網路。
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import runpy
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+
+# ==========================================
+# 合成資料
+# ==========================================
+SURNAMES = "陳林黃張李王吳劉蔡楊許鄭謝郭洪曾邱廖賴周徐蘇葉莊呂江何蕭羅高"
+GIVEN = "宇承恩子睿宥辰庭芯語彤晴安樂妍柏翔沐禾澄"
+STATUSES = ["預約參觀", "排隊等待", "確認入學", "確定不收", "候補中"]   # 最後一種為舊資料的非標準狀態
+STATUS_WEIGHTS = [20, 45, 25, 7, 3]
+NOTE_PHRASES = [
+    "家長希望安排上午參觀", "兄姊目前在園", "對花生過敏，午餐需留意", "需要娃娃車接送",
+    "預計明年搬到附近", "已繳交報名表", "想了解才藝課程與收費", "爺爺奶奶接送", "午睡需要小被子",
+    "曾就讀其他幼兒園", "雙語需求", "請於平日下午五點後聯絡",
+]
+
+
+def _roc_birthday(rng: random.Random) -> str:
+    y, m, d = rng.randint(108, 114), rng.randint(1, 12), rng.randint(1, 28)
+    fmt = rng.random()
+    if fmt < 0.75:
+        return f"{y}/{m:02d}/{d:02d}"
+    if fmt < 0.85:
+        return f"{y}-{m}-{d}"
+    if fmt < 0.93:
+        return f"{y}.{m:02d}.{d:02d}"
+    if fmt < 0.97:
+        return f"{y + 1911}/{m}/{d}"   # 誤填成西元年
+    return rng.choice(["", "不詳", "113/02/30"])
+
+
+def _phone(rng: random.Random) -> str:
+    n = rng.randint(0, 99999999)
+    fmt = rng.random()
+    if fmt < 0.35:
+        return f"9{n:08d}"   # Excel 吃掉開頭的 0，需要 normalize_phone
+    if fmt < 0.75:
+        return f"09{n:08d}"
+    if fmt < 0.9:
+        return f"09{n // 1000000:02d}-{n // 1000 % 1000:03d}-{n % 1000:03d}"
+    return f"(02)2{n % 1000:03d}-{n // 10000:04d}"
+
+
+def _note(rng: random.Random) -> str:
+    r = rng.random()
+    if r < 0.4:
+        return ""
+    if r < 0.9:
+        return rng.choice(NOTE_PHRASES)
+    # 長備註（數百字）
+    return "；".join(rng.choice(NOTE_PHRASES) for _ in range(rng.randint(15, 40)))
+
+
+def make_registrations(n: int, seed: int = 0) -> pd.DataFrame:
+    """
+    產生 n 筆 FINAL_COLS 格式的報名資料（紀錄ID / 版本留空，模擬舊資料）。
+    同一個 seed 產生的資料完全相同。
+    """
+    rng = random.Random(seed)
+    rows = []
+    for _ in range(n):
+        surname = rng.choice(SURNAMES)
+        status = rng.choices(STATUSES, STATUS_WEIGHTS)[0]
+        plan = ""
+        if rng.random() < 0.5:
+            plan = f"{rng.randint(114, 117)} 學年 - {rng.choice(['幼幼班', '小班', '中班', '大班'])}"
+        rows.append({
+            "報名狀態": status,
+            "聯繫狀態": rng.choice(["", "未聯繫", "已聯繫", "已聯繫"]),
+            "登記日期": f"{rng.randint(111, 115)}/{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}",
+            "幼兒姓名": surname + "".join(rng.choice(GIVEN) for _ in range(rng.choice([1, 2, 2, 2]))),
+            "家長稱呼": f"{surname} {rng.choice(['先生', '小姐', '媽媽', '爸爸'])}",
+            "電話": _phone(rng),
+            "幼兒生日": _roc_birthday(rng),
+            "預計入學資訊": plan,
+            "推薦人": rng.choice([""] * 8 + ["王老師", "舊生家長", "社區活動"]),
+            "備註": _note(rng),
+            "重要性": rng.choice(["優", "中", "中", "差", ""]),
+            "紀錄ID": "",
+            "版本": "",
+        })
+    return pd.DataFrame(rows)
+
+
+# ==========================================
+# 假工作表（只實作 app.py 用到的 gspread 方法）
+# ==========================================
+def _a1_to_rowcol(a1: str) -> tuple:
+    letters = "".join(ch for ch in a1 if ch.isalpha())
+    digits = "".join(ch for ch in a1 if ch.isdigit())
+    col = 0
+    for ch in letters.upper():
+        col = col * 26 + ord(ch) - 64
+    return (int(digits) if digits else 0), col
+
+
+class FakeSpreadsheet:
+    id = "fake-book"
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.extra = []
+
+    def worksheets(self) -> list:
+        self.ws.calls += 1
+        return [self.ws] + self.extra
+
+    def add_worksheet(self, title: str, rows: int = 1, cols: int = 26):
+        self.ws.calls += 1
+        ws = FakeWorksheet(title=title)
+        self.extra.append(ws)
+        return ws
+
+    def batch_update(self, body: dict):
+        self.ws.calls += 1
+        self.ws.rev += 1
+        for r in sorted(body["requests"], key=lambda r: -r["deleteDimension"]["range"]["startIndex"]):
+            rg = r["deleteDimension"]["range"]
+            del self.ws.rows[rg["startIndex"]:rg["endIndex"]]
+
+    def get_lastUpdateTime(self) -> str:
+        self.ws.calls += 1
+        return f"rev-{self.ws.rev}"
+
+
+class FakeWorksheet:
+    id = 0
+
+    def __init__(self, rows=None, title: str = "工作表1"):
+        self.title = title
+        self.rows = [list(r) for r in (rows or [])]
+        self.col_count = 26
+        self.calls = 0
+        self.rev = 0
+        self.spreadsheet = FakeSpreadsheet(self)
+
+    def get_all_values(self) -> list:
+        self.calls += 1
+        return [list(r) for r in self.rows]
+
+    def get(self, rng: str) -> list:
+        self.calls += 1
+        a, b = rng.split(":")
+        c1, c2 = _a1_to_rowcol(a)[1], _a1_to_rowcol(b)[1]
+        return [r[c1 - 1:c2] for r in self.rows]
+
+    def col_values(self, c: int) -> list:
+        self.calls += 1
+        return [r[c - 1] if len(r) >= c else "" for r in self.rows]
+
+    def batch_update(self, data: list, **kw):
+        self.calls += 1
+        self.rev += 1
+        for d in data:
+            row, col = _a1_to_rowcol(d["range"].split(":")[0])
+            target = self.rows[row - 1]
+            for k, v in enumerate(d["values"][0]):
+                while len(target) <= col - 1 + k:
+                    target.append("")
+                target[col - 1 + k] = v
+
+    def append_rows(self, values: list, **kw):
+        self.calls += 1
+        self.rev += 1
+        self.rows.extend(list(v) for v in values)
+
+    def append_row(self, values: list, **kw):
+        self.append_rows([values])
+
+    def add_cols(self, n: int):
+        self.calls += 1
+        self.col_count += n
+
+
+# ==========================================
+# 量測
+# ==========================================
+class Recorder:
+    def __init__(self, trace_memory: bool):
+        self.trace_memory = trace_memory
+        self.results = {}
+
+    def stage(self, name: str, fn, note: str = ""):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        t0 = time.perf_counter()
+        out = fn()
+        sec = time.perf_counter() - t0
+        peak = (tracemalloc.get_traced_memory()[1] - base) / 2 ** 20 if self.trace_memory else None
+        self.results[name] = {"sec": round(sec, 4), "peak_mb": None if peak is None else round(peak, 2), "note": note}
+        mem = f"{peak:9.1f} MB" if peak is not None else ""
+        print(f"  {name:<16}{sec:9.3f} s {mem}  {note}", flush=True)
+        return out
+
+
+def load_app() -> dict:
+    """
+    以 bare mode 執行 app.py（已登入、停在預設頁），回傳模組的全域命名空間。
+    """
+    import streamlit as st
+    st.session_state["password_correct"] = True
+    g = runpy.run_path(APP, run_name="app")
+    # run_path 回傳的是複本，函式實際使用的是自己的 __globals__
+    g = g["load_registered_data"].__globals__
+    g["start_prefetch"]()["done"].wait(60)
+    return g
+
+
+def render_management(n_rows: int) -> float:
+    # 以 Streamlit 內建的 AppTest 執行「資料管理中心 / 全部資料」，量第二次（快取已暖）的重新執行
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(APP, default_timeout=600)
+    at.session_state["password_correct"] = True
+    at.session_state["mgmt_tab"] = "📁 全部資料"
+    at.run()
+    at.sidebar.radio[0].set_value("📂 資料管理中心").run()
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+    t0 = time.perf_counter()
+    at.run()
+    return time.perf_counter() - t0
+
+
+def run_size(n: int, seed: int, trace_memory: bool, render: bool) -> dict:
+    import streamlit as st
+
+    print(f"\n== {n:,} 筆 ==", flush=True)
+    workdir = tempfile.mkdtemp(prefix=f"bench{n}_")
+    os.chdir(workdir)
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    g = load_app()
+    rec = Recorder(trace_memory)
+    rng = random.Random(seed)
+
+    raw = rec.stage("產生資料", lambda: make_registrations(n, seed))
+
+    def normalize():
+        save_df = g["_prepare_save_df"](g["_normalize_frame"](raw))
+        return save_df, g["_add_typed_columns"](save_df.set_index(g["ID_COL"], drop=False))
+    save_df, _ = rec.stage("整理欄位", normalize, "_normalize_frame + _prepare_save_df + 型別欄位")
+
+    rec.stage("整表儲存", lambda: g["sync_data_to_gsheets"](save_df), "sync_data_to_gsheets（本機庫）")
+
+    def cold_load():
+        g["_shared_store"].clear()
+        if os.path.exists(g["SNAPSHOT_FILE"]):
+            os.remove(g["SNAPSHOT_FILE"])
+        return g["load_registered_data"]()
+    df = rec.stage("載入（重建）", cold_load, "讀本機庫 + 型別欄位 + 寫快照")
+
+    def warm_load():
+        g["_shared_store"].clear()
+        return g["load_registered_data"]()
+    rec.stage("載入（快照）", warm_load, "讀磁碟快照")
+
+    idx = rec.stage("搜尋索引", lambda: g["derived_state"]("搜尋索引"), "整表建立，之後隨變動事件增量維護")["base"]
+    names = df["幼兒姓名"].sample(10, random_state=seed).tolist()
+    queries = [q[:1] for q in names] + names + ["09", "0912", "過敏", "確認入學", "113/0"]
+    rec.stage("關鍵字搜尋", lambda: [g["search_index"](idx, q) for q in queries], f"{len(queries)} 次查詢合計")
+
+    hh = rec.stage("家庭索引", lambda: g["build_household_index"](df), "電話 / 生日+姓名字 區塊")
+    rec.stage("重複檢查", lambda: g["find_duplicate_groups"](df, hh), "區塊內成對比對")
+
+    start = g["current_academic_year"]() + 1
+    counts = rec.stage("招生推估", lambda: g["cohort_counts"](df, list(range(start, start + 5))), "5 學年 × 年級 × 狀態")
+    scen = [{"name": f"s{i}", "conv_wait": i / 20} for i in range(20)]
+    rec.stage("情境試算", lambda: g["evaluate_scenarios"](counts, list(range(start, start + 5)), scen), "20 個情境一次計算")
+
+    def append_one():
+        row = make_registrations(1, seed + 1).iloc[0].to_dict()
+        row[g["ID_COL"]] = g["new_record_id"]()
+        assert g["insert_records"]([row])
+        return g["load_registered_data"]()
+    rec.stage("新增一筆", append_one, "insert_records + 重新載入（補讀新增列）")
+    rec.stage("載入（共用表）", g["load_registered_data"], "版本沒變：直接回傳同一份，不複製")
+    rec.stage("招生統計（建立）", g["admission_stats"], "冷啟動：整表計數一次")
+
+    if render:
+        sec = render_management(n)
+        rec.results["渲染卡片"] = {"sec": round(sec, 4), "peak_mb": None, "note": "AppTest 重新執行（含測試框架開銷）"}
+        print(f"  {'渲染卡片':<16}{sec:9.3f} s   AppTest 重新執行（含測試框架開銷）", flush=True)
+
+    ids = rng.sample(list(df.index), min(50, n))
+    patches = [{"id": rid, "base": df.at[rid, g["VER_COL"]], "set": {"備註": f"bench {i}", "重要性": "優"}}
+               for i, rid in enumerate(ids)]
+    res = rec.stage("儲存變更", lambda: g["apply_record_patches"](patches), f"{len(patches)} 筆逐列修改")
+    assert res["ok"], res
+    rec.stage("載入（修改後）", g["load_registered_data"], f"共用表只補讀 {len(patches)} 列")
+    rec.stage("招生統計（開啟）", g["admission_stats"], f"補讀時已增減 {len(patches)} 列的計數，不掃整表")
+
+    def search_after():
+        state = g["derived_state"]("搜尋索引")
+        return [g["_search_merge"](state, q.lower(), *g["search_index"](state["base"], q, with_rank=True))
+                for q in queries]
+    rec.stage("搜尋（修改後）", search_after, f"索引不重建，{len(patches)} 列另外比對；{len(queries)} 次查詢合計")
+    rec.stage("卡片分組（建立）", lambda: g["derived_state"]("分頁分組"), "每列一個代碼（是否已聯繫 × 狀態組），整表一次")
+    rec.stage("卡片分組", lambda: [g["view_partition"](v, g["NEW_STATUS_OPTIONS"][:1]) for v in ("uncontacted", "contacted", "all")],
+              "3 個頁籤的第一個狀態群組")
+    bad = rec.stage("一致性檢查", g["check_derived_consistency"], "增量維護的衍生結構 vs 整表重算")
+    assert not bad, bad
+
+    years = list(range(g["current_academic_year"](), g["current_academic_year"]() + 6))
+    active = g["query_registrations"]("active")
+    rec.stage("名單計算", lambda: [g["build_roster"](active, y) for y in years], f"{len(years)} 個學年，不經快取")
+
+    # 雲端：假工作表先放舊資料，再送出整表差異 / 佇列批次
+    after = g["load_registered_data"]()
+    sheet = FakeWorksheet([g["FINAL_COLS"]] + save_df[g["FINAL_COLS"]].values.tolist())
+    new_values = [g["FINAL_COLS"]] + after[g["FINAL_COLS"]].values.tolist()
+
+    def push_full():
+        diff = g["diff_sheet_values"](sheet.get_all_values(), new_values, key_col=g["FINAL_COLS"].index(g["ID_COL"]))
+        return g["push_sheet_diff"](sheet, diff, len(g["FINAL_COLS"]))
+    stats = rec.stage("雲端整表差異", push_full, "diff_sheet_values + push_sheet_diff")
+    rec.results["雲端整表差異"]["note"] += f"（{stats['cells']} 格 / {stats['requests']} 次請求）"
+
+    sheet = FakeWorksheet([g["FINAL_COLS"]] + save_df[g["FINAL_COLS"]].values.tolist())
+    before = save_df.set_index(g["ID_COL"], drop=False)
+    ops = [(rid, before.loc[rid, g["FINAL_COLS"]].tolist(), after.loc[rid, g["FINAL_COLS"]].tolist()) for rid in ids]
+    stats, conflicts = rec.stage("雲端佇列送出", lambda: g["_push_outbox_batch"](sheet, ops), f"{len(ops)} 筆")
+    assert not conflicts, conflicts
+    rec.results["雲端佇列送出"]["note"] += f"（{stats['cells']} 格 / {stats['requests']} 次請求）"
+
+    # 整條路徑經過雲端閘道：假試算表直接放進閘道的控制代碼快取
+    book = FakeSpreadsheet(FakeWorksheet([g["FINAL_COLS"]] + after[g["FINAL_COLS"]].values.tolist()))
+    gw = g["_sheets_gateway"]()
+    gw["book"], gw["sheets"] = book, {}
+    rec.stage("雲端整表下載", lambda: g["_pull_from_cloud"](force=True), "經閘道：列出工作表 + 修訂 + 整表讀取")
+    calls = sum(m["calls"] for m in g["sheets_metrics"]()["ops"].values())
+    rec.results["雲端整表下載"]["note"] += f"（閘道累計 {calls} 次請求）"
+
+    moved = rec.stage("封存", g["archive_records"], "確定不收 / 已畢業搬到封存表")
+    rec.results["封存"]["note"] += f"（{moved} 筆）"
+    rec.stage("載入（封存後）", g["load_registered_data"], "只剩在用資料")
+
+    return rec.results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    slower = []
+    for n, stages in results.items():
+        for name, r in stages.items():
+            old = baseline.get(n, {}).get(name)
+            if old and old["sec"] > 0.01 and r["sec"] > old["sec"] * threshold:
+                slower.append(f"{n} 筆 / {name}: {old['sec']:.3f}s → {r['sec']:.3f}s")
+    return slower
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="幼兒園新生管理系統效能基準測試")
+    ap.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--no-mem", action="store_true", help="不追蹤記憶體（tracemalloc 會讓耗時變長）")
+    ap.add_argument("--no-render", action="store_true", help="略過 AppTest 畫面渲染階段")
+    ap.add_argument("--json", help="結果另存 JSON")
+    ap.add_argument("--baseline", help="與先前的 JSON 結果比較")
+    ap.add_argument("--threshold", type=float, default=1.5, help="耗時超過基準的幾倍算退步（預設 1.5）")
+    args = ap.parse_args(argv)
+
+    logging.disable(logging.WARNING)   # bare mode 的 ScriptRunContext 警告
+    cwd = os.getcwd()
+    if not args.no_mem:
+        tracemalloc.start()
+    results = {}
+    try:
+        for n in args.sizes:
+            results[str(n)] = run_size(n, args.seed, not args.no_mem, not args.no_render)
+    finally:
+        os.chdir(cwd)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            slower = compare(results, json.load(f), args.threshold)
+        if slower:
+            print("\n⚠️ 效能退步：\n  " + "\n  ".join(slower))
+            return 1
+        print("\n與基準相比沒有退步。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+import logging
+import os
+import runpy
+
+import pandas as pd
+import pytest
+import streamlit as st
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """
+    在暫存目錄以 bare mode 執行一次 app.py（本機庫、快照都建在那裡），回傳模組的全域命名空間。
+    """
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("app"))
+    logging.disable(logging.WARNING)
+    st.session_state["password_correct"] = True
+    try:
+        # run_path 回傳的是全域命名空間的副本，取函式的 __globals__ 才能在測試中替換函式
+        g = runpy.run_path(APP, run_name="app")["load_registered_data"].__globals__
+        # 等背景預取跑完，免得它在之後的測試（雲端已換成假工作表時）才去拉資料
+        assert g["start_prefetch"]()["done"].wait(timeout=30)
+        yield g
+    finally:
+        os.chdir(cwd)
+
+
+def make_rows(app, rows: list) -> pd.DataFrame:
+    """以欄位字典建立與本機庫讀出來相同格式的資料表（未給的欄位為空字串），不含型別欄位。"""
+    full = [{**{c: "" for c in app["FINAL_COLS"]}, app["VER_COL"]: "1", **r} for r in rows]
+    for r in full:
+        r[app["ID_COL"]] = r[app["ID_COL"]] or app["new_record_id"]()
+    df = pd.DataFrame(full, columns=app["FINAL_COLS"])
+    df.index = pd.Index(df[app["ID_COL"]].tolist())
+    return df
+
+
+@pytest.fixture
+def fake_cloud(app, monkeypatch):
+    """
+    以 benchmark.py 的記憶體假工作表當雲端（內容為目前本機庫的資料），
+    背景同步執行緒換成不會啟動的假物件；測試結束後還原閘道狀態。
+    """
+    from benchmark import FakeWorksheet
+
+    import threading
+
+    local = app["load_registered_data"]()
+    ws = FakeWorksheet([app["FINAL_COLS"]] + local[app["FINAL_COLS"]].values.tolist())
+    gw = app["_sheets_gateway"]()
+    saved = {k: gw[k] for k in ("book", "sheets", "tokens")}
+    gw.update(book=ws.spreadsheet, sheets={None: ws}, tokens=1e9)
+    worker = {"wake": threading.Event(), "last_success": None, "last_error": None, "last_check": 0.0,
+              "force_pull": False, "appends_safe": False, "archive_appends_safe": False}
+    monkeypatch.setitem(app, "_cloud_enabled", lambda: True)
+    monkeypatch.setitem(app, "get_sync_worker", lambda: worker)
+    try:
+        yield ws, worker
+    finally:
+        gw.update(saved)
+        with app["_db"]() as conn:
+            conn.execute("DELETE FROM cloud_outbox")
+            conn.execute("DELETE FROM cloud_conflicts")
@@ -0,0 +1,70 @@
+import json
+
+from tests.conftest import make_rows
+
+
+def _queue_archive(app, rows):
+    id_c = app["FINAL_COLS"].index(app["ID_COL"])
+    with app["_db"]() as conn:
+        start = conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM archive_outbox").fetchone()[0]
+        conn.executemany("INSERT OR REPLACE INTO archive_outbox (rid, new, seq) VALUES (?, ?, ?)",
+                         [(r[id_c], json.dumps(r), start + i) for i, r in enumerate(rows)])
+
+
+def _sheet_ids(app, ws):
+    id_c = app["FINAL_COLS"].index(app["ID_COL"])
+    return [r[id_c] for r in ws.rows[1:]]
+
+
+def _outbox_size(app):
+    with app["_db"]() as conn:
+        return conn.execute("SELECT COUNT(*) FROM archive_outbox").fetchone()[0]
+
+
+def test_first_archive_push_after_restart_does_not_append_twice(app, fake_cloud):
+    from benchmark import FakeWorksheet
+
+    ws, worker = fake_cloud
+    rows = make_rows(app, [{"紀錄ID": app["new_record_id"](), "幼兒姓名": "封存甲"},
+                           {"紀錄ID": app["new_record_id"](), "幼兒姓名": "封存乙"}])[app["FINAL_COLS"]]
+    rows = rows.values.tolist()
+    # 上次程序已把第一筆附加到封存工作表，還沒刪掉佇列就結束了
+    arc = FakeWorksheet([app["FINAL_COLS"], rows[0]], title=app["ARCHIVE_SHEET"])
+    ws.spreadsheet.extra.append(arc)
+    ids = [r[app["FINAL_COLS"].index(app["ID_COL"])] for r in rows]
+    assert all(ids) and len(set(ids)) == 2
+    _queue_archive(app, rows)
+    assert _outbox_size(app) == 2
+
+    app["_push_archive_outbox"](worker)
+    # 已在雲端的那筆不能再附加一次：每個紀錄ID 恰好一列
+    assert _sheet_ids(app, arc) == ids
+    assert _outbox_size(app) == 0
+    assert worker["archive_appends_safe"]
+
+    # 同一程序之後的第一次送出直接附加，不必先讀雲端的編號欄
+    third = make_rows(app, [{"紀錄ID": app["new_record_id"](), "幼兒姓名": "封存丙"}])[app["FINAL_COLS"]].values.tolist()
+    _queue_archive(app, third)
+    calls = arc.calls
+    app["_push_archive_outbox"](worker)
+    assert _sheet_ids(app, arc) == ids + [third[0][app["FINAL_COLS"].index(app["ID_COL"])]]
+    assert arc.calls == calls + 1
+
+
+def test_worker_archives_only_after_first_download(app, fake_cloud, monkeypatch):
+    import time
+
+    ws, worker = fake_cloud
+    runs = []
+    monkeypatch.setitem(app, "maybe_archive", lambda: runs.append(1) or 0)
+    worker["last_check"] = time.time()   # 不做雲端修訂檢查
+    with app["_db"]() as conn:
+        conn.execute("DELETE FROM cloud_outbox")
+
+    # 首次雲端下載還沒完成：主表可能還是空的，不封存（也不記下封存日期）
+    app["_sync_worker_step"](worker)
+    assert runs == []
+
+    worker["seeded"] = True
+    app["_sync_worker_step"](worker)
+    assert runs == [1]
@@ -0,0 +1,57 @@
+from tests.conftest import make_rows
+
+
+def test_derived_structures_follow_patch_sequence(app, monkeypatch):
+    published = []
+    publish = app["_publish_changes"]
+
+    def spy(derived, old, old_pos, new, frame):
+        published.append(sorted(derived))
+        return publish(derived, old, old_pos, new, frame)
+
+    monkeypatch.setitem(app, "_publish_changes", spy)
+    monkeypatch.setitem(app, "_cloud_enabled", lambda: False)
+    names = list(app["_FEED_SUBSCRIBERS"])
+    assert "家庭索引" in names
+
+    def check(step):
+        # 先讓所有衍生結構都建好，下一步的變動才會走增量更新
+        for n in names:
+            app["derived_state"](n)
+        assert app["check_derived_consistency"]() == {}, step
+
+    def version(rid):
+        return app["load_registered_data"]().at[rid, app["VER_COL"]]
+
+    check("初始")
+    rows = make_rows(app, [
+        {"幼兒姓名": "張小安", "電話": "0933-000111", "幼兒生日": "111/02/03", "登記日期": "113/01/10"},
+        {"幼兒姓名": "張小平", "電話": "0933-000111", "幼兒生日": "112/09/09", "登記日期": "113/01/10"},
+        {"幼兒姓名": "李大同", "電話": "0944-555666", "幼兒生日": "111/06/06", "報名狀態": "確定不收",
+         "登記日期": "100/01/01"},
+    ])
+    a, b, c = rows.index
+    assert app["insert_records"]([r for _, r in rows.iterrows()])
+    check("新增")
+    assert published and set(names) <= set(published[-1])
+    assert len(app["household_records"]("0933000111")) == 2
+    assert app["find_possible_duplicates"]("0933-000111", "張小安", None)["幼兒姓名"].tolist() == ["張小安"]
+
+    # 只改狀態：家庭索引不必重建
+    hh = app["derived_state"]("家庭索引")
+    n = len(published)
+    app["apply_record_patches"]([{"id": a, "base": version(a), "set": {"聯繫狀態": "已聯繫", "備註": "下午來電"}}])
+    check("修改狀態")
+    assert len(published) > n and app["derived_state"]("家庭索引") is hh
+
+    app["apply_record_patches"]([{"id": b, "base": version(b), "set": {"幼兒姓名": "張小萍", "電話": "0933-999888"}}])
+    check("修改姓名電話")
+    assert len(app["household_records"]("0933000111")) == 1
+
+    app["apply_record_patches"]([{"id": a, "base": version(a), "delete": True}])
+    check("刪除")
+    assert a not in app["load_registered_data"]().index
+
+    assert app["archive_records"]() >= 1
+    check("封存")
+    assert c not in app["load_registered_data"]().index
@@ -0,0 +1,54 @@
+from datetime import date
+
+import pytest
+
+from tests.conftest import make_rows
+
+
+@pytest.fixture
+def family(app):
+    def build(rows):
+        df = app["_add_typed_columns"](make_rows(app, rows))
+        return df, app["build_household_index"](df)
+    return build
+
+
+SIBLINGS = [
+    {"幼兒姓名": "王小明", "電話": "0912-345678", "幼兒生日": "110/03/05"},
+    {"幼兒姓名": "王小華", "電話": "0912345678", "幼兒生日": "112/07/20"},
+]
+TWINS = [
+    {"幼兒姓名": "陳宇恩", "電話": "0922-111222", "幼兒生日": "111/05/01"},
+    {"幼兒姓名": "陳宇晴", "電話": "0922-111222", "幼兒生日": "111/05/01"},
+]
+
+
+def test_siblings_on_same_phone_are_not_duplicates(app, family):
+    df, idx = family(SIBLINGS)
+    assert app["find_duplicate_groups"](df, idx).empty
+    assert app["match_household"](idx, "0912-345678", "王小美", date(2024, 1, 9)) == []
+
+
+def test_twins_are_not_duplicates(app, family):
+    df, idx = family(TWINS)
+    groups = app["find_duplicate_groups"](df, idx)
+    assert groups.empty
+    assert app["merge_duplicate_patches"](groups) == []
+
+
+def test_same_child_registered_twice_is_duplicate(app, family):
+    df, idx = family(SIBLINGS + [{"幼兒姓名": "王 小明", "電話": "0912 345 678", "幼兒生日": "110/03/05"}])
+    groups = app["find_duplicate_groups"](df, idx)
+    assert sorted(groups["幼兒姓名"]) == ["王 小明", "王小明"]
+    assert groups["原因"].iloc[0] == "同電話、同生日、姓名相近"
+
+
+def test_missing_birthday_needs_closer_name(app, family):
+    df, idx = family([{"幼兒姓名": "王小明", "電話": "0912-345678"},
+                      {"幼兒姓名": "王小華", "電話": "0912-345678"},
+                      {"幼兒姓名": "王小明", "電話": "0912-345678", "幼兒生日": "110/03/05"}])
+    groups = app["find_duplicate_groups"](df, idx)
+    assert sorted(groups["幼兒姓名"]) == ["王小明", "王小明"]
+    assert set(groups["原因"]) == {"同電話、姓名相近（生日未填）"}
+    hits = app["match_household"](idx, "0912345678", "王小華", None)
+    assert [r for _, r in hits] == ["同電話、姓名相近（生日未填）"]
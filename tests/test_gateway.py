@@ -0,0 +1,125 @@
+from types import SimpleNamespace
+
+import pytest
+
+from benchmark import FakeWorksheet
+
+
+class _ApiError(Exception):
+    """與 gspread.exceptions.APIError 相同，帶有 HTTP 回應。"""
+
+    def __init__(self, status: int):
+        super().__init__(f"HTTP {status}")
+        self.response = SimpleNamespace(status_code=status)
+
+
+def _flaky(errors: list, result="ok"):
+    # 依序拋出 errors 中的錯誤，之後回傳 result
+    calls = []
+
+    def fn(*args, **kwargs):
+        calls.append(args)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+
+    return fn, calls
+
+
+@pytest.fixture
+def gateway(app, monkeypatch):
+    """
+    乾淨的閘道狀態與假時鐘：time.sleep 只推進時鐘並記下等待秒數，抖動固定為 1 倍。
+    """
+    clock = {"now": 1000.0, "sleeps": []}
+
+    def sleep(sec):
+        clock["sleeps"].append(sec)
+        clock["now"] += sec
+
+    monkeypatch.setattr(app["time"], "sleep", sleep)
+    monkeypatch.setattr(app["time"], "monotonic", lambda: clock["now"])
+    monkeypatch.setattr(app["random"], "random", lambda: 0.5)
+    gw = app["_sheets_gateway"]()
+    saved = {k: gw[k] for k in ("tokens", "refill_at", "book", "sheets", "ops", "throttled_sec", "last_error")}
+    gw.update(tokens=1e9, refill_at=clock["now"], book=None, sheets={}, ops={}, throttled_sec=0.0, last_error="")
+    try:
+        yield gw, clock
+    finally:
+        gw.update(saved)
+
+
+def test_rate_limited_call_is_retried_with_backoff(app, gateway):
+    gw, clock = gateway
+    fn, calls = _flaky([_ApiError(429), _ApiError(429)])
+    assert app["sheets_call"]("append_rows", fn, [["x"]], idempotent=False) == "ok"
+    assert len(calls) == 3
+    assert clock["sleeps"] == [1.0, 2.0]
+    m = app["sheets_metrics"]()["ops"]["append_rows"]
+    assert (m["calls"], m["errors"], m["retries"]) == (3, 2, 2)
+    assert "429" in app["sheets_metrics"]()["last_error"]
+
+
+def test_server_error_is_retried_only_when_idempotent(app, gateway):
+    gw, clock = gateway
+    fn, calls = _flaky([_ApiError(503)])
+    assert app["sheets_call"]("get_all_values", fn) == "ok"
+    assert len(calls) == 2
+
+    # 新增列若在 5xx 後重送，伺服器可能其實已經寫入，會重複
+    fn, calls = _flaky([_ApiError(503)])
+    with pytest.raises(_ApiError):
+        app["sheets_call"]("append_rows", fn, idempotent=False)
+    assert len(calls) == 1
+    m = app["sheets_metrics"]()["ops"]["append_rows"]
+    assert (m["calls"], m["errors"], m["retries"]) == (1, 1, 0)
+
+
+def test_gives_up_after_max_retries(app, gateway):
+    gw, clock = gateway
+    n = app["SHEETS_MAX_RETRIES"]
+    fn, calls = _flaky([_ApiError(429)] * (n + 1))
+    with pytest.raises(_ApiError):
+        app["sheets_call"]("get", fn)
+    assert len(calls) == n + 1
+    assert app["sheets_metrics"]()["ops"]["get"]["retries"] == n
+
+
+def test_token_bucket_throttles_after_burst(app, gateway):
+    gw, clock = gateway
+    gw["tokens"] = float(app["SHEETS_BURST"])
+    fn, calls = _flaky([])
+    for _ in range(app["SHEETS_BURST"]):
+        app["sheets_call"]("get", fn)
+    assert clock["sleeps"] == []
+
+    # 桶子空了：下一個請求等一個權杖補進來的時間
+    app["sheets_call"]("get", fn)
+    wait = 60 / app["SHEETS_REQ_PER_MIN"]
+    assert clock["sleeps"] == [pytest.approx(wait)]
+    assert app["sheets_metrics"]()["throttled_sec"] == pytest.approx(wait)
+    assert len(calls) == app["SHEETS_BURST"] + 1
+
+
+def test_worksheet_handles_are_cached_until_not_found(app, gateway):
+    gw, clock = gateway
+    ws = FakeWorksheet([app["FINAL_COLS"]])
+    ws.spreadsheet.extra.append(FakeWorksheet([app["FINAL_COLS"]], title="封存"))
+    gw["book"] = ws.spreadsheet
+
+    assert app["open_worksheet"]() is ws
+    assert app["open_worksheet"]("封存") is ws.spreadsheet.extra[0]
+    assert app["open_worksheet"]() is ws
+    assert ws.calls == 1   # 只列出一次工作表
+    assert app["sheets_metrics"]()["ops"]["worksheets"]["calls"] == 1
+
+    # 不存在的工作表：create=True 時建立並寫入標題列，之後也走快取
+    new = app["open_worksheet"]("新表", create=True)
+    assert new.rows == [app["FINAL_COLS"]]
+    assert app["open_worksheet"]("新表") is new
+
+    # 檔案被移走（404）：控制代碼清掉，下次重新開啟
+    fn, _ = _flaky([_ApiError(404)])
+    with pytest.raises(_ApiError):
+        app["sheets_call"]("get_all_values", fn)
+    assert gw["book"] is None and gw["sheets"] == {}
@@ -0,0 +1,98 @@
+import threading
+import time
+
+from tests.conftest import make_rows
+
+
+def _row(app, rid):
+    with app["_db"]() as conn:
+        return app["_db_read_ids"](conn, [rid]).loc[rid]
+
+
+def _outbox(app, table="cloud_outbox"):
+    with app["_db"]() as conn:
+        return {r[0] for r in conn.execute(f"SELECT rid FROM {table}")}
+
+
+class _Stop(BaseException):
+    pass
+
+
+def test_worker_survives_errors(app, monkeypatch):
+    calls = []
+    stop = threading.Event()
+
+    def boom(worker):
+        if stop.is_set():
+            raise _Stop   # 不是 Exception，迴圈接不住，讓執行緒結束；之後的測試才不會被它搶著同步
+        calls.append(1)
+        raise OSError("database is locked")
+
+    monkeypatch.setitem(app, "_sync_worker_step", boom)
+    worker = {"wake": threading.Event(), "last_error": None}
+    def run():
+        try:
+            app["_sync_worker_loop"](worker)
+        except _Stop:
+            pass
+
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    for _ in range(2):
+        worker["wake"].set()
+        deadline = time.time() + 5
+        n = len(calls)
+        while len(calls) == n and time.time() < deadline:
+            time.sleep(0.05)
+    assert len(calls) >= 2 and t.is_alive()
+    assert "database is locked" in worker["last_error"]
+    stop.set()
+    worker["wake"].set()
+    t.join(timeout=5)
+    assert not t.is_alive()
+
+
+def test_conflict_keeps_local_edit_until_resolved(app, monkeypatch, fake_cloud):
+    rid = app["new_record_id"]()
+    monkeypatch.setitem(app, "_cloud_enabled", lambda: False)
+    assert app["insert_records"]([make_rows(app, [{"紀錄ID": rid, "幼兒姓名": "林小雨"}]).iloc[0].to_dict()])
+    ws, worker = fake_cloud
+    monkeypatch.setitem(app, "_cloud_enabled", lambda: True)
+    ws.rows.append(_row(app, rid)[app["FINAL_COLS"]].tolist())
+
+    # 本機改名（版本 1 → 2）的同時，雲端被別人改成版本 5
+    res = app["apply_record_patches"]([{"id": rid, "base": "1", "set": {"幼兒姓名": "林小雨（本機）"}}])
+    assert res["updated"] == [rid]
+    ver_c, name_c = app["FINAL_COLS"].index(app["VER_COL"]), app["FINAL_COLS"].index("幼兒姓名")
+    ws.rows[-1][ver_c], ws.rows[-1][name_c] = "5", "林小雨（雲端）"
+
+    app["_sync_worker_step"](worker)
+    assert rid not in _outbox(app)
+    assert rid in _outbox(app, "cloud_conflicts")
+    assert worker["force_pull"]
+    assert app["get_sync_status"]()["conflicts"] == 1
+    # 雲端資料還沒拉回來之前不處理
+    assert "尚未取回" in app["resolve_cloud_conflict"](rid, True)
+
+    app["_sync_worker_step"](worker)   # 佇列已空：強制拉取，主表那一列換成雲端版本
+    assert _row(app, rid)["幼兒姓名"] == "林小雨（雲端）"
+    assert rid in _outbox(app, "cloud_conflicts")
+
+    assert "保留本機" in app["resolve_cloud_conflict"](rid, True)
+    assert _row(app, rid)["幼兒姓名"] == "林小雨（本機）"
+    assert _row(app, rid)[app["VER_COL"]] == "6"
+    assert rid in _outbox(app) and not _outbox(app, "cloud_conflicts")
+
+    app["_sync_worker_step"](worker)
+    assert not _outbox(app)
+    assert ws.rows[-1][name_c] == "林小雨（本機）" and ws.rows[-1][ver_c] == "6"
+
+
+def test_conflict_take_cloud_drops_local_copy(app, monkeypatch, fake_cloud):
+    ws, worker = fake_cloud
+    rid = app["new_record_id"]()
+    with app["_db"]() as conn:
+        app["_save_conflict"](conn, rid, None, "雲端已被他人修改")
+    assert app["list_cloud_conflicts"]()["幼兒姓名"].tolist() == ["（本機已刪除）"]
+    assert app["resolve_cloud_conflict"](rid, False) == "已採用雲端版本。"
+    assert not _outbox(app, "cloud_conflicts")